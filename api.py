@@ -0,0 +1,163 @@
+import json
+import threading
+import uuid
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from utils import format_coords
+
+
+API_HOST = '127.0.0.1'
+API_DELAY = 1
+MAX_WAIT = 60
+MAX_DEADLINES = 100
+SECTIONS = ('shields', 'reins', 'tracks', 'deadlines')
+
+
+class Snapshot(namedtuple('Snapshot', 'guild_id version etag bodies')):
+    # bodies holds the encoded JSON of every section, None being the whole guild
+    __slots__ = ()
+
+
+def format_time(value):
+    return value.isoformat() if value is not None else None
+
+
+def build_snapshot(guild_id, version, shields, reins, preys, now, nonce):
+    # runs on a worker thread, the records are immutable so no lock is needed
+    _shields = [{
+        'user_id': _shield.user_id,
+        'name': _shield.name,
+        'display_name': _shield.display_name,
+        'entered': format_time(_shield.entered),
+        'expires': format_time(_shield.expires),
+    } for _shield in sorted(shields, key=lambda _s: _s.expires)]
+
+    _reins = [{
+        'user_id': _rein.user_id,
+        'name': _rein.name,
+        'display_name': _rein.display_name,
+        'entered': format_time(_rein.entered),
+    } for _rein in sorted(reins, key=lambda _r: _r.entered)]
+
+    _tracks = []
+    _deadlines = []
+    for _prey in preys:
+        _deadline = _prey.get_deadline()
+        _tracks.append({
+            'prey_name': _prey.prey_name,
+            'user_id': _prey.user_id,
+            'coords': format_coords(_prey.coords),
+            'entered': format_time(_prey.entered),
+            'marks': list(_prey.marks),
+            'notified': [_mark for _mark in _prey.marks if _prey.is_notified(_mark)],
+            'next_deadline': format_time(_deadline),
+        })
+        if _deadline is not None and _deadline >= now:
+            _deadlines.append((_deadline, 'track', _prey.prey_name))
+    _tracks.sort(key=lambda _t: (_t['next_deadline'] is None, _t['next_deadline'] or ''))
+
+    for _shield in shields:
+        _deadline = _shield.get_deadline()
+        if _deadline is not None and _deadline >= now:
+            _deadlines.append((_deadline, 'shield', _shield.user_id))
+    _deadlines.sort(key=lambda _d: _d[0])
+    _deadlines = [{'at': format_time(_at), 'kind': _kind, 'key': _key} for _at, _kind, _key in _deadlines[:MAX_DEADLINES]]
+
+    _sections = {'shields': _shields, 'reins': _reins, 'tracks': _tracks, 'deadlines': _deadlines}
+    _header = {'guild_id': guild_id, 'version': version, 'generated': format_time(now)}
+    _bodies = {_name: json.dumps(dict(_header, **{_name: _value})).encode('utf-8') for _name, _value in _sections.items()}
+    _bodies[None] = json.dumps(dict(_header, **_sections)).encode('utf-8')
+    # versions restart with the process, the nonce keeps an old ETag from matching
+    return Snapshot(guild_id, version, f'"{nonce}-{guild_id}-{version}"', _bodies)
+
+
+class SnapshotStore(object):
+    # written from the event loop, read from the server threads
+    def __init__(self):
+        super(SnapshotStore, self).__init__()
+        self.nonce = uuid.uuid4().hex[:8]
+        self._snapshots = {}
+        self._changed = threading.Condition()
+
+    def publish(self, snapshot):
+        with self._changed:
+            self._snapshots[snapshot.guild_id] = snapshot
+            self._changed.notify_all()
+
+    def get(self, guild_id):
+        return self._snapshots.get(guild_id)
+
+    def wait(self, guild_id, etag, timeout):
+        with self._changed:
+            self._changed.wait_for(lambda: getattr(self._snapshots.get(guild_id), 'etag', etag) != etag, timeout)
+            return self._snapshots.get(guild_id)
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        _url = urlsplit(self.path)
+        _parts = [_part for _part in _url.path.split('/') if _part]
+        if not 2 <= len(_parts) <= 3 or _parts[0] != 'api' or not _parts[1].isdigit() or (len(_parts) == 3 and _parts[2] not in SECTIONS):
+            self._reply(404)
+            return
+
+        _guild_id = int(_parts[1])
+        _section = _parts[2] if len(_parts) == 3 else None
+        _snapshot = self.server.store.get(_guild_id)
+        if _snapshot is None:
+            self._reply(404)
+            return
+
+        _etags = [_etag.strip() for _etag in self.headers.get('If-None-Match', '').split(',')]
+        if _snapshot.etag in _etags:
+            # long polling: hold the request until the guild changes or the wait runs out
+            _wait = parse_qs(_url.query).get('wait')
+            if _wait and _wait[0].isdigit():
+                _snapshot = self.server.store.wait(_guild_id, _snapshot.etag, min(int(_wait[0]), MAX_WAIT))
+
+        if _snapshot.etag in _etags:
+            self._reply(304, etag=_snapshot.etag)
+        else:
+            self._reply(200, _snapshot.bodies[_section], _snapshot.etag)
+
+    def _reply(self, status, body=b'', etag=None):
+        self.send_response(status)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        if status == 200:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TazdingoApi(object):
+    def __init__(self, store, port, host=API_HOST):
+        super(TazdingoApi, self).__init__()
+        self.store = store
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        self._server = ThreadingHTTPServer((self.host, self.port), ApiHandler)
+        self._server.daemon_threads = True
+        self._server.store = self.store
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name='tazdingo-api', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,90 @@
+import asyncio
+import heapq
+import itertools
+from datetime import datetime, timedelta, timezone
+
+
+SETTLE_STEPS = 20
+
+
+class TazdingoClock(object):
+    def now(self):
+        return datetime.now(timezone.utc)
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+    async def wait(self, event, timeout=None):
+        if timeout is None:
+            await event.wait()
+            return True
+
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+class VirtualClock(TazdingoClock):
+    def __init__(self, start=None):
+        super(VirtualClock, self).__init__()
+        self._now = start or datetime.now(timezone.utc)
+        self._sleepers = []
+        self._counter = itertools.count()
+
+    def now(self):
+        return self._now
+
+    async def sleep(self, seconds):
+        await self.wait(None, seconds)
+
+    async def wait(self, event, timeout=None):
+        if event is not None and event.is_set():
+            return True
+
+        _waiters = []
+        if timeout is not None:
+            _future = asyncio.get_event_loop().create_future()
+            heapq.heappush(self._sleepers, (self._now + timedelta(seconds=timeout), next(self._counter), _future))
+            _waiters.append(_future)
+        if event is not None:
+            _waiters.append(asyncio.ensure_future(event.wait()))
+
+        try:
+            await asyncio.wait(_waiters, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for _waiter in _waiters:
+                _waiter.cancel()
+        return event is not None and event.is_set()
+
+    def next_wakeup(self):
+        while self._sleepers and self._sleepers[0][2].done():
+            heapq.heappop(self._sleepers)
+        if not self._sleepers:
+            return None
+        return self._sleepers[0][0]
+
+    def advance(self, until=None):
+        # jumps straight to the next sleeper instead of waiting for it
+        _wakeup = self.next_wakeup()
+        if _wakeup is None or (until is not None and _wakeup > until):
+            if until is not None:
+                self._now = max(self._now, until)
+            return False
+
+        self._now = max(self._now, _wakeup)
+        while self._sleepers and self._sleepers[0][0] <= self._now:
+            _deadline, _seq, _future = heapq.heappop(self._sleepers)
+            if not _future.done():
+                _future.set_result(None)
+        return True
+
+    async def settle(self):
+        for _idx in range(SETTLE_STEPS):
+            await asyncio.sleep(0)
+
+    async def run_until(self, until):
+        await self.settle()
+        while self.advance(until):
+            await self.settle()
@@ -1,6 +1,6 @@
 import os
 import sys
-from django.core.wsgi import get_wsgi_application
+import django
 
 
 # Django specific settings
@@ -12,8 +12,8 @@ else:
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", _settings)
 
-# Ensure settings are read
-application = get_wsgi_application()
+# Ensure settings are read and the models registered, without the WSGI stack
+django.setup()
 
 # Your application specific imports
 from django.conf import settings
@@ -3,29 +3,117 @@ from django.db import models
 from polymorphic.models import PolymorphicModel
 
 
+class Guild(models.Model):
+    guild_id = models.BigIntegerField(primary_key=True)
+    shields_channel_id = models.BigIntegerField(null=True)
+    alerts_channel_id = models.BigIntegerField(null=True)
+    board_channel_id = models.BigIntegerField(null=True)
+    board_message_id = models.BigIntegerField(null=True)
+    shield_reminders = models.CharField(max_length=255, default='')  # seconds before expiry, empty for the defaults
+    prey_durations = models.CharField(max_length=255, default='')  # seconds after tracking, empty for the defaults
+
+
 class Shield(PolymorphicModel):
+    guild_id = models.BigIntegerField()
     name = models.CharField(max_length=255)
-    user_id = models.IntegerField(primary_key=True)
+    user_id = models.IntegerField()
     display_name = models.CharField(max_length=255)
     entered = models.DateTimeField()
     expires = models.DateTimeField()
-    expired_notification = models.BooleanField(default=False)  # expired shield notification
-    expiring_notification = models.BooleanField(default=False)  # shield is expiring soon (<1h)
+    reminders = models.CharField(max_length=255, default='')  # seconds before expiry
+    notified = models.IntegerField(default=0)  # one bit per reminder already sent
+
+    class Meta:
+        unique_together = (('guild_id', 'user_id'),)
+        indexes = [
+            models.Index(fields=['guild_id', 'expires']),
+        ]
 
 
 class Reinforcement(PolymorphicModel):
+    guild_id = models.BigIntegerField()
     name = models.CharField(max_length=255)
-    user_id = models.IntegerField(primary_key=True)
+    user_id = models.IntegerField()
     display_name = models.CharField(max_length=255)
     entered = models.DateTimeField()
 
+    class Meta:
+        unique_together = (('guild_id', 'user_id'),)
+
 
 class Prey(models.Model):
+    guild_id = models.BigIntegerField()
     user_id = models.IntegerField()
-    prey_name = models.CharField(max_length=255, primary_key=True)
+    prey_name = models.CharField(max_length=255)
     coords = models.CharField(max_length=255, null=True, validators=[int_list_validator])
     entered = models.DateTimeField()
-    four_notification = models.BooleanField(default=False)
-    eight_notification = models.BooleanField(default=False)
-    twelve_notification = models.BooleanField(default=False)
-    twenty_four_notification = models.BooleanField(default=False)
+    marks = models.CharField(max_length=255, default='')  # seconds after tracking
+    notified = models.IntegerField(default=0)  # one bit per mark already announced
+
+    class Meta:
+        unique_together = (('guild_id', 'prey_name'),)
+        indexes = [
+            models.Index(fields=['guild_id', 'entered']),
+            models.Index(fields=['guild_id', 'user_id']),
+        ]
+
+
+class Event(models.Model):
+    guild_id = models.BigIntegerField()
+    kind = models.CharField(max_length=16)
+    user_id = models.IntegerField()
+    subject = models.CharField(max_length=255)
+    created = models.DateTimeField()
+    duration = models.IntegerField(null=True)  # seconds, meaning depends on the kind
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['guild_id', 'user_id', 'created']),
+            models.Index(fields=['guild_id', 'subject', 'created']),
+            models.Index(fields=['created']),
+        ]
+
+
+class EventCount(models.Model):
+    guild_id = models.BigIntegerField()
+    day = models.DateField()
+    kind = models.CharField(max_length=16)
+    count = models.IntegerField(default=0)
+    duration = models.BigIntegerField(default=0)  # sum of the events' durations
+
+    class Meta:
+        unique_together = (('guild_id', 'day', 'kind'),)
+
+
+class PreyEstimate(models.Model):
+    # how many times each shield duration was observed for a prey
+    guild_id = models.BigIntegerField()
+    prey_name = models.CharField(max_length=255)
+    counts = models.CharField(max_length=255, default='')  # seconds,count pairs
+
+    class Meta:
+        unique_together = (('guild_id', 'prey_name'),)
+
+
+class MemberSettings(models.Model):
+    guild_id = models.BigIntegerField()
+    user_id = models.IntegerField()
+    shield_reminders = models.CharField(max_length=255, default='')  # seconds before expiry, empty for the guild's
+
+    class Meta:
+        unique_together = (('guild_id', 'user_id'),)
+
+
+class Lease(models.Model):
+    # held by the one process allowed to send alerts
+    name = models.CharField(max_length=64, primary_key=True)
+    holder = models.CharField(max_length=255)
+    expires = models.FloatField()  # unix time
+
+
+class Change(models.Model):
+    # rows written by a process, for the other processes to reload
+    origin = models.CharField(max_length=255)
+    model = models.CharField(max_length=32)
+    key = models.CharField(max_length=255)  # JSON list of the natural key values
+    created = models.FloatField(db_index=True)  # unix time
@@ -0,0 +1,209 @@
+import io
+import re
+from collections import OrderedDict
+
+from utils import get_member_name, parse_coords, parse_time
+
+
+PARAM_RE = re.compile(r"^(?P<optional>\[)?<(?P<name>\w+):(?P<type>[\w|]+)>(?P<variadic>\.\.\.)?(?(optional)\])$")
+
+
+class CommandError(Exception):
+    pass
+
+
+class UnknownCommandError(CommandError):
+    pass
+
+
+class ArgumentError(CommandError):
+    def __init__(self, command, message=""):
+        super(ArgumentError, self).__init__(message or f"usage: {command.usage}")
+        self.command = command
+
+
+class PermissionDeniedError(CommandError):
+    def __init__(self, command):
+        super(PermissionDeniedError, self).__init__(f"{command.name} not allowed")
+        self.command = command
+
+
+def parse_time_argument(token, message):
+    _seconds = parse_time(token)
+    if _seconds is None:
+        raise ValueError(token)
+    return _seconds
+
+
+def parse_member_argument(token, message):
+    return get_member_name(token, message.mentions)
+
+
+def parse_coords_argument(token, message):
+    _coords = parse_coords(token)
+    if _coords is None:
+        raise ValueError(token)
+    return _coords
+
+
+def parse_int_argument(token, message):
+    return int(token)
+
+
+def parse_radius_argument(token, message):
+    _radius = int(token)
+    if _radius < 0:
+        raise ValueError(token)
+    return _radius
+
+
+def parse_page_argument(token, message):
+    if not token.isdigit() or not int(token):
+        raise ValueError(token)
+    return int(token)
+
+
+ARGUMENT_TYPES = {
+    'time': parse_time_argument,
+    'member': parse_member_argument,
+    'coords': parse_coords_argument,
+    'int': parse_int_argument,
+    'page': parse_page_argument,
+    'radius': parse_radius_argument,
+}
+
+
+def get_choice_argument(choices):
+    def parse_choice_argument(token, message):
+        if token not in choices:
+            raise ValueError(token)
+        return token
+    return parse_choice_argument
+
+
+class Param(object):
+    __slots__ = ('name', 'parser', 'optional', 'variadic', 'display')
+
+    def __init__(self, name, parser, optional=False, variadic=False, display=None):
+        self.name = name
+        self.parser = parser
+        self.optional = optional
+        self.variadic = variadic
+        self.display = display
+
+
+def compile_spec(spec):
+    _params = []
+    for _token in spec.split():
+        _m = PARAM_RE.match(_token)
+        if not _m:
+            raise ValueError(f"invalid argument spec {_token!r}")
+
+        _name, _type = _m.group('name'), _m.group('type')
+        if _type in ARGUMENT_TYPES:
+            _parser = ARGUMENT_TYPES[_type]
+            _display = f"<{_name}>"
+        else:
+            _parser = get_choice_argument(set(_type.split('|')))
+            _display = _type
+
+        _optional, _variadic = bool(_m.group('optional')), bool(_m.group('variadic'))
+        if _variadic:
+            _display = f"{_display}..."
+        if _optional:
+            _display = f"[{_display}]"
+        _params.append(Param(_name, _parser, _optional, _variadic, _display))
+    return _params
+
+
+class Command(object):
+    __slots__ = ('name', 'handler', 'params', 'aliases', 'permission', 'help', 'section')
+
+    def __init__(self, name, handler, spec="", aliases=(), permission=None, help="", section=""):
+        self.name = name
+        self.handler = handler
+        self.params = compile_spec(spec)
+        self.aliases = tuple(aliases)
+        self.permission = permission
+        self.help = help
+        self.section = section
+
+    @property
+    def usage(self):
+        return " ".join([self.name] + [_param.display for _param in self.params])
+
+    def parse(self, args, message):
+        _kwargs = {}
+        _idx = 0
+        for _param in self.params:
+            if _param.variadic:
+                _values = []
+                for _token in args[_idx:]:
+                    try:
+                        _values.append(_param.parser(_token, message))
+                    except ValueError:
+                        raise ArgumentError(self)
+                _idx = len(args)
+                if _values:
+                    _kwargs[_param.name] = _values
+                elif not _param.optional:
+                    raise ArgumentError(self)
+            elif _idx < len(args):
+                try:
+                    _kwargs[_param.name] = _param.parser(args[_idx], message)
+                    _idx += 1
+                except ValueError:
+                    # optional arguments are skipped when the token belongs to the next one
+                    if not _param.optional:
+                        raise ArgumentError(self)
+            elif not _param.optional:
+                raise ArgumentError(self)
+
+        if _idx < len(args):
+            raise ArgumentError(self)
+        return _kwargs
+
+
+class CommandRegistry(object):
+    def __init__(self):
+        super(CommandRegistry, self).__init__()
+        self._commands = {}
+        self._sections = OrderedDict()
+
+    def __len__(self):
+        # commands, not names, aliases point at the command they belong to
+        return sum(len(_commands) for _commands in self._sections.values())
+
+    def __contains__(self, name):
+        return name in self._commands
+
+    def register(self, name, handler, spec="", aliases=(), permission=None, help="", section="General"):
+        _command = Command(name, handler, spec, aliases, permission, help, section)
+        for _name in (name,) + _command.aliases:
+            self._commands[_name] = _command
+        self._sections.setdefault(section, []).append(_command)
+        return _command
+
+    def get(self, name):
+        return self._commands.get(name)
+
+    def resolve(self, name, args, message, context=None):
+        _command = self._commands.get(name)
+        if _command is None:
+            raise UnknownCommandError(name)
+
+        if _command.permission is not None and not _command.permission(context, message):
+            raise PermissionDeniedError(_command)
+
+        return _command, _command.parse(args, message)
+
+    def get_help(self):
+        _help = io.StringIO()
+        for _idx, (_section, _commands) in enumerate(self._sections.items()):
+            if _idx:
+                _help.write("\n\n")
+            _help.write(f"{_section} commands:")
+            _width = max(len(_command.usage) for _command in _commands)
+            for _command in _commands:
+                _help.write(f"\n  {_command.usage:<{_width}}  {_command.help}")
+        return _help.getvalue()
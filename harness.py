@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+
+GUILD_ID = 1000
+SHIELDS_CHANNEL_ID = 2000
+ALERTS_CHANNEL_ID = 2001
+OWNER_ID = 1
+
+_ids = itertools.count(10 ** 6)
+
+
+class FakeGuild(object):
+    def __init__(self, id, owner_id=OWNER_ID):
+        self.id = id
+        self.owner_id = owner_id
+
+
+class FakeMember(object):
+    def __init__(self, id, guild, name=None):
+        self.id = id
+        self.guild = guild
+        self.name = name or f"member{id}"
+        self.display_name = self.name
+        self.roles = []
+
+    @property
+    def mention(self):
+        return f"<@!{self.id}>"
+
+
+class FakeMessage(object):
+    def __init__(self, content, author, channel, mentions=None):
+        self.id = next(_ids)
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.mentions = mentions or []
+        self.attachments = []
+        self.reactions = []
+
+    async def add_reaction(self, emoji):
+        self.channel.stats['reactions'] += 1
+        self.reactions.append(emoji)
+
+    async def edit(self, content=None):
+        self.channel.stats['edits'] += 1
+        self.content = content
+
+    async def pin(self):
+        pass
+
+    async def unpin(self):
+        pass
+
+
+class FakeAttachment(object):
+    def __init__(self, filename, data):
+        self.filename = filename
+        self.size = len(data)
+        self.data = data
+
+    async def read(self):
+        return self.data
+
+
+class FakeChannel(object):
+    def __init__(self, id, guild, stats):
+        self.id = id
+        self.guild = guild
+        self.stats = stats
+        self.messages = {}
+
+    async def send(self, content, file=None):
+        self.stats['sends'] += 1
+        self.stats['sent_chars'] += len(content)
+        _message = FakeMessage(content, None, self)
+        if file is not None:
+            _message.attachments.append(file)
+        self.messages[_message.id] = _message
+        return _message
+
+    async def fetch_message(self, id):
+        return self.messages[id]
+
+
+def get_percentile(values, percentile):
+    if not values:
+        return 0.0
+    _values = sorted(values)
+    _idx = min(int(round(percentile / 100 * (len(_values) - 1))), len(_values) - 1)
+    return _values[_idx]
+
+
+def setup_django():
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'settings.testing'
+    import conf
+    from django.core.management import call_command
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+
+def reset_database():
+    # the in-memory database lives as long as the process, tests start and end with it empty
+    from django.apps import apps
+    from django.db import connection
+    with connection.cursor() as _cursor:
+        for _model in apps.get_app_config('data').get_models():
+            _cursor.execute(f"DELETE FROM {_model._meta.db_table}")
+
+
+def generate_stream(members, tracks, seed=0):
+    _random = random.Random(seed)
+    _stream = [(OWNER_ID, "$bind")]
+    for _idx in range(members):
+        _author = OWNER_ID + 1 + _idx
+        if _random.random() < 0.8:
+            _stream.append((_author, f"$shield {_random.randint(1, 23)}h{_random.randint(0, 59)}m"))
+        else:
+            _stream.append((_author, "$rein"))
+
+    for _idx in range(tracks):
+        _author = OWNER_ID + 1 + _random.randrange(max(members, 1))
+        _coords = f"{_random.randint(0, 999)},{_random.randint(0, 999)}"
+        _shields = " ".join(str(_s) for _s in sorted(_random.sample([4, 8, 12, 24], _random.randint(1, 4))))
+        _stream.append((_author, f"$track prey{_idx} {_coords} {_shields}"))
+
+    _reads = []
+    for _idx in range(max(members, tracks) // 10 + 1):
+        _author = OWNER_ID + 1 + _random.randrange(max(members, 1))
+        _reads.append((_author, _random.choice(["$hive", "$tracks", "$status", f"$near {_random.randint(0, 999)},{_random.randint(0, 999)}", f"$lose prey{_random.randrange(max(tracks, 1))}", "$unshield", "$recall", "$history", f"$history prey{_random.randrange(max(tracks, 1))}", "$summary"])))
+
+    _random.shuffle(_reads)
+    return _stream + _reads
+
+
+def load_stream(path):
+    _stream = []
+    with open(path) as _f:
+        for _line in _f:
+            _line = _line.strip()
+            if _line:
+                _record = json.loads(_line)
+                _stream.append((_record['author'], _record['content']))
+    return _stream
+
+
+def get_client_class():
+    from tazdingo import TazdingoClient
+    from outbox import TazdingoOutbox
+
+    class HarnessClient(TazdingoClient):
+        def __init__(self, clock=None):
+            super(HarnessClient, self).__init__(clock)
+            self.outbox = TazdingoOutbox(throttle=False)
+            self.alerts_due = 0
+            self.alerts_lags = []
+            self.stats = defaultdict(int)
+            self.guild = FakeGuild(GUILD_ID)
+            self.channels = {
+                SHIELDS_CHANNEL_ID: FakeChannel(SHIELDS_CHANNEL_ID, self.guild, self.stats),
+                ALERTS_CHANNEL_ID: FakeChannel(ALERTS_CHANNEL_ID, self.guild, self.stats),
+            }
+            self.members = {}
+            self.online.set()
+
+        def get_channel(self, id):
+            return self.channels.get(id)
+
+        async def wait_until_ready(self):
+            pass
+
+        def get_member(self, id):
+            _member = self.members.get(id)
+            if _member is None:
+                _member = self.members[id] = FakeMember(id, self.guild)
+            return _member
+
+    return HarnessClient
+
+
+def track_alerts(client):
+    _pop_due = client.scheduler.pop_due
+
+    def pop_due(now):
+        _due = _pop_due(now)
+        if _due:
+            client.alerts_due += len(_due)
+            client.alerts_lags.append(client.scheduler.lag)
+        return _due
+
+    client.scheduler.pop_due = pop_due
+
+
+async def replay(client, stream):
+    _channel = client.channels[SHIELDS_CHANNEL_ID]
+    _latencies = defaultdict(list)
+    _start = time.perf_counter()
+    for _author, _content in stream:
+        _message = FakeMessage(_content, client.get_member(_author), _channel)
+        _command_start = time.perf_counter()
+        await client.on_message(_message)
+        _latencies[_content.split()[0].lower()].append(time.perf_counter() - _command_start)
+        if _content == "$bind":
+            client.partitions[GUILD_ID].config.alerts_channel_id = ALERTS_CHANNEL_ID
+    return time.perf_counter() - _start, _latencies
+
+
+async def simulate(client, days, outage=0):
+    # the real notifier and board loops run against the virtual clock, which
+    # jumps from one deadline to the next instead of sleeping
+    _start = time.perf_counter()
+    if outage:
+        # alerts due while the gateway is away are caught up in one go
+        from tazdingo import CATCH_UP_LAG
+        client.online.clear()
+        await client.clock.run_until(client.clock.now() + timedelta(hours=outage))
+        _catch_ups = client.catch_ups
+        # only an alert overdue by CATCH_UP_LAG starts a catch up
+        _overdue = client.scheduler.next_deadline()
+        _catch_up = _overdue is not None and (client.clock.now() - _overdue).total_seconds() >= CATCH_UP_LAG
+        client.online.set()
+        # the catch up flush runs on real time, the virtual clock waits for it
+        while _catch_up and client.catch_ups == _catch_ups:
+            await asyncio.sleep(0.01)
+        await client.persistence.flush()
+    await client.clock.run_until(client.clock.now() + timedelta(days=days))
+    return time.perf_counter() - _start
+
+
+async def run(client, args):
+    if args.replay:
+        _stream = load_stream(args.replay)
+    else:
+        _stream = generate_stream(args.members, args.tracks, args.seed)
+
+    _elapsed, _latencies = await replay(client, _stream)
+    _sends = client.stats['sends']
+    _alerts_elapsed = await simulate(client, args.days, args.outage)
+    await client.persistence.flush()
+    await client.outbox.join()
+    for _task in (client.background_task, client.persistence_task, client.boards_task, client.lease_task, client.maintenance_task):
+        _task.cancel()
+
+    _all = [_latency for _values in _latencies.values() for _latency in _values]
+    _report = {
+        'commands': len(_all),
+        'commands_per_second': len(_all) / _elapsed if _elapsed else 0.0,
+        'p50_ms': get_percentile(_all, 50) * 1000,
+        'p99_ms': get_percentile(_all, 99) * 1000,
+        'per_command': {
+            _cmd: {
+                'count': len(_values),
+                'p50_ms': get_percentile(_values, 50) * 1000,
+                'p99_ms': get_percentile(_values, 99) * 1000,
+            } for _cmd, _values in sorted(_latencies.items())
+        },
+        'load_seconds': client.load_time,
+        'purged': client.purged,
+        'simulated_days': args.days,
+        'alerts_due': client.alerts_due,
+        'alerts_seconds': _alerts_elapsed,
+        'alerts_lag_p50_s': get_percentile(client.alerts_lags, 50),
+        'alerts_lag_max_s': max(client.alerts_lags, default=0.0),
+        'alerts_sends': client.stats['sends'] - _sends,
+        'outage_hours': args.outage,
+        'catch_ups': client.catch_ups,
+        'db_flushes': client.persistence.flushes,
+        'db_objects': client.persistence.flushed_objects,
+        'db_seconds': client.persistence.flush_latency_total,
+        'sends': client.stats['sends'],
+        'reactions': client.stats['reactions'],
+        'edits': client.stats['edits'],
+        'outbox_merged': client.outbox.merged,
+        'outbox_dropped': client.outbox.dropped,
+    }
+    return _report
+
+
+def print_report(report):
+    print(f"commands   {report['commands']} ({report['commands_per_second']:.0f}/s)")
+    print(f"latency    p50 {report['p50_ms']:.3f}ms  p99 {report['p99_ms']:.3f}ms")
+    for _cmd, _stats in report['per_command'].items():
+        print(f"  {_cmd:<12} {_stats['count']:>7}  p50 {_stats['p50_ms']:.3f}ms  p99 {_stats['p99_ms']:.3f}ms")
+    print(f"startup    state loaded in {report['load_seconds']:.3f}s ({report['purged']} preys purged)")
+    print(f"alerts     {report['alerts_due']} due over {report['simulated_days']}d simulated in {report['alerts_seconds']:.3f}s (lag p50 {report['alerts_lag_p50_s']:.3f}s, max {report['alerts_lag_max_s']:.3f}s)")
+    print(f"catch-up   {report['catch_ups']} after {report['outage_hours']}h offline, {report['alerts_sends']} alert sends")
+    print(f"db         {report['db_flushes']} flushes, {report['db_objects']} objects, {report['db_seconds']:.3f}s")
+    print(f"outbound   {report['sends']} sends, {report['reactions']} reactions, {report['edits']} edits ({report['outbox_merged']} merged, {report['outbox_dropped']} dropped)")
+
+
+def main():
+    _parser = argparse.ArgumentParser(description="Replays command streams through Taz'dingo and reports timings.")
+    _parser.add_argument('--members', type=int, default=1000)
+    _parser.add_argument('--tracks', type=int, default=10000)
+    _parser.add_argument('--seed', type=int, default=0)
+    _parser.add_argument('--days', type=float, default=1, help="simulated time to run the alert loop for")
+    _parser.add_argument('--outage', type=float, default=0, help="hours the bot is offline before the alert loop runs")
+    _parser.add_argument('--replay', help="JSONL file of {\"author\": <id>, \"content\": <text>} records")
+    _parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    _parser.add_argument('--max-p99', type=float, help="fail when the p99 handler latency exceeds this many ms")
+    _args = _parser.parse_args()
+
+    setup_django()
+    _loop = asyncio.get_event_loop()
+    # the initial load runs before the loop, like client.run() does
+    from clock import VirtualClock
+    client = get_client_class()(VirtualClock())
+    client.initialize()
+    track_alerts(client)
+    _report = _loop.run_until_complete(run(client, _args))
+
+    if _args.json:
+        print(json.dumps(_report, indent=2))
+    else:
+        print_report(_report)
+
+    if _args.max_p99 is not None and _report['p99_ms'] > _args.max_p99:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
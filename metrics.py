@@ -0,0 +1,152 @@
+import asyncio
+import bisect
+import traceback
+
+
+METRICS_HOST = '127.0.0.1'
+METRICS_PREFIX = 'tazdingo'
+# upper bounds in seconds, from 50us to 10s
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LAG_BUCKETS = (0.01, 0.1, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{_name}="{_value}"' for _name, _value in labels) + "}"
+
+
+class Histogram(object):
+    # fixed buckets, observing is a bisect and a few additions
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the quantile, the largest value for the last one
+        if not self.count:
+            return 0.0
+        _rank = q * self.count
+        _seen = 0
+        for _idx, _count in enumerate(self.counts):
+            _seen += _count
+            if _seen >= _rank and _count:
+                return min(self.buckets[_idx], self.max) if _idx < len(self.buckets) else self.max
+        return self.max
+
+
+class TazdingoMetrics(object):
+    def __init__(self):
+        super(TazdingoMetrics, self).__init__()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self._callbacks = {}
+
+    def _key(self, name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        _key = self._key(name, labels)
+        _histogram = self.histograms.get(_key)
+        if _histogram is None:
+            _histogram = self.histograms[_key] = Histogram(buckets)
+        _histogram.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        _key = self._key(name, labels)
+        self.counters[_key] = self.counters.get(_key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.gauges[self._key(name, labels)] = value
+
+    def register(self, name, fn):
+        # gauges read from their owner only when rendered, they cost nothing otherwise
+        self._callbacks[name] = fn
+
+    def get_histogram(self, name, **labels):
+        return self.histograms.get(self._key(name, labels))
+
+    def get_histograms(self, name):
+        return [(dict(_labels), _histogram) for (_name, _labels), _histogram in sorted(self.histograms.items(), key=lambda _i: _i[0]) if _name == name]
+
+    def render(self):
+        # text exposition format, readable by prometheus and by humans
+        _lines = []
+        for _type, _values in (('counter', self.counters), ('gauge', self.gauges)):
+            _last = None
+            for (_name, _labels), _value in sorted(_values.items()):
+                if _name != _last:
+                    _lines.append(f"# TYPE {METRICS_PREFIX}_{_name} {_type}")
+                    _last = _name
+                _lines.append(f"{METRICS_PREFIX}_{_name}{format_labels(_labels)} {_value}")
+
+        for _name, _fn in sorted(self._callbacks.items()):
+            _lines.append(f"# TYPE {METRICS_PREFIX}_{_name} gauge")
+            _lines.append(f"{METRICS_PREFIX}_{_name} {_fn()}")
+
+        _last = None
+        for (_name, _labels), _histogram in sorted(self.histograms.items()):
+            if _name != _last:
+                _lines.append(f"# TYPE {METRICS_PREFIX}_{_name} histogram")
+                _last = _name
+            _seen = 0
+            for _bound, _count in zip(_histogram.buckets + ('+Inf',), _histogram.counts):
+                _seen += _count
+                _lines.append(f"{METRICS_PREFIX}_{_name}_bucket{format_labels(_labels + (('le', _bound),))} {_seen}")
+            _lines.append(f"{METRICS_PREFIX}_{_name}_sum{format_labels(_labels)} {_histogram.sum}")
+            _lines.append(f"{METRICS_PREFIX}_{_name}_count{format_labels(_labels)} {_histogram.count}")
+        return "\n".join(_lines) + "\n"
+
+
+class MetricsServer(object):
+    # a bare HTTP/1.0 responder, bound to localhost, for scrapers and curl
+    def __init__(self, metrics, port, host=METRICS_HOST):
+        super(MetricsServer, self).__init__()
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        if not self.port:
+            self.port = self._server.sockets[0].getsockname()[1]
+
+    async def _handle(self, reader, writer):
+        try:
+            _request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+
+            _parts = _request.decode('latin-1').split()
+            if len(_parts) >= 2 and _parts[0] == 'GET' and _parts[1] in ('/', '/metrics'):
+                _status, _body = "200 OK", self.metrics.render()
+            else:
+                _status, _body = "404 Not Found", "not found\n"
+
+            _body = _body.encode('utf-8')
+            writer.write(f"HTTP/1.0 {_status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(_body)}\r\n\r\n".encode('latin-1') + _body)
+            await writer.drain()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            writer.close()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
@@ -0,0 +1,207 @@
+import asyncio
+import time
+import traceback
+from collections import deque
+
+from utils import MESSAGE_LIMIT
+
+
+SEND_RATE = 5
+SEND_PER = 5.0
+REACTION_RATE = 1
+REACTION_PER = 0.25
+# a failed delivery is tried again this many times, waiting twice as long each time
+SEND_RETRIES = 2
+RETRY_DELAY = 1.0
+SEND = 'send'
+REACT = 'react'
+
+
+class TokenBucket(object):
+    def __init__(self, rate, per):
+        super(TokenBucket, self).__init__()
+        self.rate = rate
+        self.per = per
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate / self.per)
+        self._updated = now
+
+    def get_delay(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        self._refill(now)
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) * self.per / self.rate
+
+    def consume(self):
+        self._tokens -= 1
+
+
+class OutboxItem(object):
+    __slots__ = ('kind', 'target', 'content', 'mentions', 'merge', 'file', 'attempts', 'enqueued')
+
+    def __init__(self, kind, target, content, mentions=None, merge=False, file=None):
+        self.kind = kind
+        self.target = target
+        self.content = content
+        self.mentions = mentions
+        self.merge = merge
+        self.file = file
+        self.attempts = 0
+        self.enqueued = time.monotonic()
+
+    def render(self):
+        if self.mentions is None:
+            return self.content
+        return f"{' '.join(self.mentions)} {self.content}"
+
+
+class TazdingoOutbox(object):
+    def __init__(self, throttle=True, retry_delay=RETRY_DELAY):
+        super(TazdingoOutbox, self).__init__()
+        self.throttle = throttle
+        self.retry_delay = retry_delay
+        self.sent = 0
+        self.merged = 0
+        self.dropped = 0
+        self.throttled = 0
+        self.latency = 0.0
+        self.latency_max = 0.0
+        self.latency_total = 0.0
+        self._queues = {}
+        self._buckets = {}
+        self._workers = {}
+        self._alerts = {}
+        self._reactions = set()
+
+    @property
+    def depth(self):
+        return sum(len(_queue) for _queue in self._queues.values())
+
+    @property
+    def latency_avg(self):
+        if not self.sent:
+            return 0.0
+        return self.latency_total / self.sent
+
+    def send(self, channel, content, merge=False):
+        _queue = self._get_queue(channel)
+        if merge and _queue:
+            # consecutive mergeable messages are sent as one, one per line
+            _last = _queue[-1]
+            if _last.kind == SEND and _last.merge and len(_last.content) + len(content) + 1 <= MESSAGE_LIMIT:
+                _last.content = f"{_last.content}\n{content}"
+                self.merged += 1
+                return
+        self._push(channel, OutboxItem(SEND, channel, content, merge=merge))
+
+    def upload(self, channel, content, get_file):
+        # a file is closed once sent, failed or not, so each attempt gets a new one
+        self._push(channel, OutboxItem(SEND, channel, content, file=get_file))
+
+    def alert(self, channel, mention, content):
+        # pending alerts sharing the same text collect mentions instead of queueing a new message
+        _key = (channel.id, content)
+        _item = self._alerts.get(_key)
+        if _item is not None and len(_item.render()) + len(mention) + 1 <= MESSAGE_LIMIT:
+            if mention not in _item.mentions:
+                _item.mentions.append(mention)
+            self.merged += 1
+            return
+        _item = OutboxItem(SEND, channel, content, mentions=[mention])
+        self._alerts[_key] = _item
+        self._push(channel, _item)
+
+    def react(self, message, emoji):
+        _key = (message.id, emoji)
+        if _key in self._reactions:
+            self.dropped += 1
+            return
+        self._reactions.add(_key)
+        self._push(message.channel, OutboxItem(REACT, message, emoji))
+
+    async def join(self):
+        while self._workers:
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
+
+    def _get_queue(self, channel):
+        _queue = self._queues.get(channel.id)
+        if _queue is None:
+            _queue = self._queues[channel.id] = deque()
+        return _queue
+
+    def _get_bucket(self, channel_id, kind):
+        _bucket = self._buckets.get((channel_id, kind))
+        if _bucket is None:
+            if kind == REACT:
+                _bucket = TokenBucket(REACTION_RATE, REACTION_PER)
+            else:
+                _bucket = TokenBucket(SEND_RATE, SEND_PER)
+            self._buckets[(channel_id, kind)] = _bucket
+        return _bucket
+
+    def _push(self, channel, item):
+        self._get_queue(channel).append(item)
+        if channel.id not in self._workers:
+            self._workers[channel.id] = asyncio.ensure_future(self._work(channel.id))
+
+    async def _deliver(self, item):
+        if item.kind == REACT:
+            await item.target.add_reaction(item.content)
+        elif item.file is not None:
+            await item.target.send(item.render(), file=item.file())
+        else:
+            await item.target.send(item.render())
+
+    async def _work(self, channel_id):
+        _queue = self._queues[channel_id]
+        try:
+            while _queue:
+                _item = _queue[0]
+                _bucket = self._get_bucket(channel_id, _item.kind)
+                _delay = _bucket.get_delay() if self.throttle else 0
+                if _delay:
+                    self.throttled += 1
+                    await asyncio.sleep(_delay)
+                    continue
+
+                _queue.popleft()
+                _bucket.consume()
+                if _item.mentions is not None:
+                    # an overflowing alert may have replaced this one as the item to merge into
+                    _key = (channel_id, _item.content)
+                    if self._alerts.get(_key) is _item:
+                        del self._alerts[_key]
+
+                try:
+                    await self._deliver(_item)
+                except Exception:
+                    traceback.print_exc()
+                    if _item.attempts < SEND_RETRIES:
+                        _item.attempts += 1
+                        _queue.appendleft(_item)
+                        await asyncio.sleep(self.retry_delay * 2 ** (_item.attempts - 1))
+                        continue
+                    self.dropped += 1
+                    _delivered = False
+                else:
+                    _delivered = True
+
+                if _item.kind == REACT:
+                    self._reactions.discard((_item.target.id, _item.content))
+                if not _delivered:
+                    continue
+
+                _latency = time.monotonic() - _item.enqueued
+                self.sent += 1
+                self.latency = _latency
+                self.latency_max = max(self.latency_max, _latency)
+                self.latency_total += _latency
+        finally:
+            del self._workers[channel_id]
+            if not _queue:
+                del self._queues[channel_id]
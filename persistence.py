@@ -0,0 +1,139 @@
+import asyncio
+import time
+import traceback
+
+from metrics import TazdingoMetrics
+from storage import get_natural_key
+
+
+FLUSH_DELAY = 1
+FLUSH_THRESHOLD = 100
+# a row is written again this many times before it is given up on
+FLUSH_RETRIES = 3
+
+
+class TazdingoPersistence(object):
+    def __init__(self, storage, delay=FLUSH_DELAY, threshold=FLUSH_THRESHOLD, metrics=None):
+        super(TazdingoPersistence, self).__init__()
+        self.storage = storage
+        self.metrics = metrics or TazdingoMetrics()
+        self.delay = delay
+        self.threshold = threshold
+        self.flushes = 0
+        self.flushed_objects = 0
+        self.flush_latency = 0.0
+        self.flush_latency_max = 0.0
+        self.flush_latency_total = 0.0
+        self._pending = {}
+        self._appended = []
+        # failed writes of the requeued rows, the appended ones are always at the front
+        self._attempts = {}
+        self._appended_attempts = []
+        self._lock = asyncio.Lock()
+        self._dirty = asyncio.Event()
+        self._full = asyncio.Event()
+
+    def __len__(self):
+        return len(self._pending) + len(self._appended)
+
+    def save(self, obj):
+        self._enqueue(obj, False)
+
+    def delete(self, obj):
+        self._enqueue(obj, True)
+
+    def append(self, obj):
+        # log rows are never coalesced, every one of them is inserted
+        self._appended.append(obj)
+        self._changed()
+
+    def get_appended(self):
+        return list(self._appended)
+
+    def _enqueue(self, obj, deleted):
+        # later operations on the same row replace the earlier ones
+        _key = (type(obj),) + get_natural_key(obj)
+        self._pending[_key] = (obj, deleted)
+        self._attempts.pop(_key, None)
+        self._changed()
+
+    def _changed(self):
+        self._dirty.set()
+        if len(self) >= self.threshold:
+            self._full.set()
+
+    async def run(self):
+        while True:
+            await self._dirty.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.delay)
+            except asyncio.TimeoutError:
+                pass
+
+            try:
+                await self.flush()
+            except Exception:
+                traceback.print_exc()
+
+    async def flush(self):
+        async with self._lock:
+            self._dirty.clear()
+            self._full.clear()
+            if not self._pending and not self._appended:
+                return
+
+            _pending, self._pending = self._pending, {}
+            _appended, self._appended = self._appended, []
+            _attempts, self._attempts = self._attempts, {}
+            _appended_attempts, self._appended_attempts = self._appended_attempts, []
+            _start = time.perf_counter()
+            try:
+                await self.storage.write(
+                    [_obj for _obj, _deleted in _pending.values() if not _deleted],
+                    [_obj for _obj, _deleted in _pending.values() if _deleted],
+                    _appended,
+                )
+            except Exception:
+                self.metrics.inc('db_flush_errors_total')
+                self._requeue(_pending, _attempts, _appended, _appended_attempts)
+                self._dirty.set()
+                raise
+
+            _elapsed = time.perf_counter() - _start
+            self.flushes += 1
+            self.flushed_objects += len(_pending) + len(_appended)
+            self.flush_latency = _elapsed
+            self.flush_latency_max = max(self.flush_latency_max, _elapsed)
+            self.flush_latency_total += _elapsed
+            self.metrics.observe('db_flush_seconds', _elapsed)
+            self.metrics.inc('db_flushed_objects_total', len(_pending) + len(_appended))
+
+    def _requeue(self, pending, attempts, appended, appended_attempts):
+        # rows that keep failing are dropped rather than holding back every later write
+        _dropped = 0
+        for _key, _value in pending.items():
+            if _key in self._pending:
+                # a newer write made meanwhile replaces the failed one
+                continue
+            _attempt = attempts.get(_key, 0) + 1
+            if _attempt > FLUSH_RETRIES:
+                _dropped += 1
+                continue
+            self._pending[_key] = _value
+            self._attempts[_key] = _attempt
+
+        _appended_attempts = [_attempt + 1 for _attempt in appended_attempts] + [1] * (len(appended) - len(appended_attempts))
+        _kept = [(_obj, _attempt) for _obj, _attempt in zip(appended, _appended_attempts) if _attempt <= FLUSH_RETRIES]
+        _dropped += len(appended) - len(_kept)
+        self._appended[:0] = [_obj for _obj, _attempt in _kept]
+        self._appended_attempts = [_attempt for _obj, _attempt in _kept]
+
+        if _dropped:
+            print(f"Dropped {_dropped} rows after {FLUSH_RETRIES} failed flushes")
+            self.metrics.inc('db_dropped_objects_total', _dropped)
+
+    @property
+    def flush_latency_avg(self):
+        if not self.flushes:
+            return 0.0
+        return self.flush_latency_total / self.flushes
@@ -0,0 +1,133 @@
+from collections import namedtuple
+
+from reminders import format_seconds, get_shield_thresholds, get_thresholds, parse_seconds
+from utils import format_coords, parse_coords
+
+
+class Record(object):
+    # in-memory state is kept as immutable tuples, data.models is only used by the storage
+    __slots__ = ()
+
+    def to_values(self):
+        # column values by model attribute name, the storage writes these directly
+        return self._asdict()
+
+    def to_model(self):
+        from django.apps import apps
+        return apps.get_model('data', type(self).__name__)(**self.to_values())
+
+
+class Shield(Record, namedtuple('Shield', 'guild_id user_id name display_name entered expires reminders notified')):
+    # reminders are the lead times this shield was set with, latest first
+    __slots__ = ()
+
+    @classmethod
+    def from_model(cls, obj):
+        return cls(obj.guild_id, obj.user_id, obj.name, obj.display_name, obj.entered, obj.expires, parse_seconds(obj.reminders), obj.notified)
+
+    def to_values(self):
+        _values = self._asdict()
+        _values['reminders'] = format_seconds(self.reminders)
+        return _values
+
+    @property
+    def thresholds(self):
+        return get_shield_thresholds(self.reminders)
+
+    def get_deadline(self):
+        return self.thresholds.get_next(self.expires, self.notified)
+
+
+class Reinforcement(Record, namedtuple('Reinforcement', 'guild_id user_id name display_name entered')):
+    __slots__ = ()
+
+    @classmethod
+    def from_model(cls, obj):
+        return cls(obj.guild_id, obj.user_id, obj.name, obj.display_name, obj.entered)
+
+
+class Prey(Record, namedtuple('Prey', 'guild_id user_id prey_name coords entered marks notified')):
+    # marks are the shield durations tracked for this prey, shortest first
+    __slots__ = ()
+
+    @classmethod
+    def from_model(cls, obj):
+        return cls(obj.guild_id, obj.user_id, obj.prey_name, parse_coords(obj.coords), obj.entered, parse_seconds(obj.marks), obj.notified)
+
+    def to_values(self):
+        _values = self._asdict()
+        _values['coords'] = format_coords(self.coords)
+        _values['marks'] = format_seconds(self.marks)
+        return _values
+
+    @property
+    def thresholds(self):
+        return get_thresholds(self.marks)
+
+    def get_deadline(self, now=None):
+        return self.thresholds.get_next(self.entered, self.notified, now)
+
+    @property
+    def fully_notified(self):
+        return self.notified == self.thresholds.mask
+
+    def is_notified(self, mark):
+        return bool(self.notified & (1 << self.marks.index(mark)))
+
+    def notify(self, index):
+        return self._replace(notified=self.thresholds.fire(self.notified, index))
+
+
+class Event(Record, namedtuple('Event', 'guild_id kind user_id subject created duration')):
+    __slots__ = ()
+
+    @classmethod
+    def from_model(cls, obj):
+        return cls(obj.guild_id, obj.kind, obj.user_id, obj.subject, obj.created, obj.duration)
+
+
+class PreyEstimate(Record, namedtuple('PreyEstimate', 'guild_id prey_name counts')):
+    # how often each shield duration was observed, as (seconds, count) pairs
+    __slots__ = ()
+
+    @classmethod
+    def from_model(cls, obj):
+        _counts = parse_seconds(obj.counts)
+        return cls(obj.guild_id, obj.prey_name, tuple(zip(_counts[::2], _counts[1::2])))
+
+    def to_values(self):
+        return {'guild_id': self.guild_id, 'prey_name': self.prey_name, 'counts': format_seconds(_value for _pair in self.counts for _value in _pair)}
+
+    @property
+    def total(self):
+        return sum(_count for _mark, _count in self.counts)
+
+    def observe(self, mark):
+        _counts = dict(self.counts)
+        _counts[mark] = _counts.get(mark, 0) + 1
+        return self._replace(counts=tuple(sorted(_counts.items())))
+
+    def get_share(self, mark):
+        _total = self.total
+        if not _total:
+            return None
+        return dict(self.counts).get(mark, 0) / _total
+
+    def get_ranked(self, marks):
+        # most observed first, shorter shields win ties
+        _counts = dict(self.counts)
+        return sorted(marks, key=lambda _mark: (-_counts.get(_mark, 0), _mark))
+
+    def get_likely(self, marks, min_share):
+        return tuple(_mark for _mark in marks if self.get_share(_mark) >= min_share)
+
+
+class MemberSettings(Record, namedtuple('MemberSettings', 'guild_id user_id shield_reminders')):
+    __slots__ = ()
+
+    @classmethod
+    def from_model(cls, obj):
+        return cls(obj.guild_id, obj.user_id, parse_seconds(obj.shield_reminders))
+
+    def to_values(self):
+        return {'guild_id': self.guild_id, 'user_id': self.user_id, 'shield_reminders': format_seconds(self.shield_reminders)}
@@ -0,0 +1,84 @@
+import bisect
+import functools
+from datetime import timedelta
+
+
+# seconds before a shield expires, 0 is the expiry itself
+DEFAULT_SHIELD_REMINDERS = (3600, 0)
+# seconds after a prey was tracked at which its shield may drop
+DEFAULT_PREY_DURATIONS = (4 * 3600, 8 * 3600, 12 * 3600, 24 * 3600)
+MAX_THRESHOLDS = 16
+MAX_THRESHOLD_SECONDS = 7 * 24 * 3600
+
+
+@functools.lru_cache(maxsize=256)
+def parse_seconds(string):
+    if not string:
+        return ()
+    return tuple(int(_value) for _value in string.split(','))
+
+
+def format_seconds(seconds):
+    return ",".join(str(_value) for _value in seconds)
+
+
+def get_shield_reminders(leads):
+    # the expiry itself is always announced, later reminders come first
+    return tuple(sorted(set(leads) | {0}, reverse=True))
+
+
+def get_prey_durations(durations):
+    return tuple(sorted(set(durations)))
+
+
+def is_valid(seconds):
+    return 0 < len(seconds) <= MAX_THRESHOLDS and all(0 <= _value <= MAX_THRESHOLD_SECONDS for _value in seconds)
+
+
+def get_observed(durations, seconds):
+    # a shield seen to be down after this long lasted the longest duration that fits
+    _idx = bisect.bisect_right(durations, seconds) - 1
+    return durations[_idx] if _idx >= 0 else None
+
+
+class Thresholds(object):
+    # fired state is a bitset over the offsets, bit i standing for offsets[i]
+    __slots__ = ('offsets', 'deltas', 'mask')
+
+    def __init__(self, offsets):
+        super(Thresholds, self).__init__()
+        self.offsets = offsets
+        self.deltas = [timedelta(seconds=_offset) for _offset in offsets]
+        self.mask = (1 << len(offsets)) - 1
+
+    def get_passed(self, base, now):
+        return (1 << bisect.bisect_right(self.deltas, now - base)) - 1
+
+    def get_due(self, base, fired, now):
+        # the latest passed threshold that has not fired yet
+        _due = self.get_passed(base, now) & ~fired
+        if not _due:
+            return None
+        return _due.bit_length() - 1
+
+    def get_next(self, base, fired, now=None):
+        # the earliest threshold that has not fired yet, at or after now when given
+        _pending = self.mask & ~fired
+        if now is not None:
+            _pending &= ~((1 << bisect.bisect_left(self.deltas, now - base)) - 1)
+        if not _pending:
+            return None
+        return base + self.deltas[(_pending & -_pending).bit_length() - 1]
+
+    def fire(self, fired, index):
+        # a threshold also covers the earlier ones
+        return fired | ((2 << index) - 1)
+
+
+@functools.lru_cache(maxsize=None)
+def get_thresholds(offsets):
+    return Thresholds(offsets)
+
+
+def get_shield_thresholds(reminders):
+    return get_thresholds(tuple(-_lead for _lead in reminders))
@@ -0,0 +1,85 @@
+import asyncio
+import heapq
+import itertools
+
+from clock import TazdingoClock
+
+
+class TazdingoScheduler(object):
+    def __init__(self, clock=None):
+        super(TazdingoScheduler, self).__init__()
+        self.clock = clock or TazdingoClock()
+        self.lag = 0.0
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def schedule(self, key, deadline):
+        if deadline is None:
+            self.cancel(key)
+            return
+
+        _head = self.next_deadline()
+        _entry = (deadline, next(self._counter), key)
+        self._entries[key] = _entry
+        heapq.heappush(self._heap, _entry)
+
+        # stale entries are dropped lazily, rebuild once they dominate the heap
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = list(self._entries.values())
+            heapq.heapify(self._heap)
+
+        if _head is None or deadline < _head:
+            self._wakeup.set()
+
+    def cancel(self, key):
+        self._entries.pop(key, None)
+
+    def deadline(self, key):
+        _entry = self._entries.get(key)
+        if _entry is None:
+            return None
+        return _entry[0]
+
+    def next_deadline(self):
+        while self._heap:
+            _entry = self._heap[0]
+            if self._entries.get(_entry[2]) is _entry:
+                return _entry[0]
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now):
+        _due = []
+        self.lag = 0.0
+        while self._heap and self._heap[0][0] <= now:
+            _entry = heapq.heappop(self._heap)
+            if self._entries.get(_entry[2]) is _entry:
+                del self._entries[_entry[2]]
+                _due.append(_entry[2])
+                # how late the earliest due entry is being handled
+                self.lag = max(self.lag, (now - _entry[0]).total_seconds())
+        return _due
+
+    async def wait(self, now, max_delay=None):
+        _deadline = self.next_deadline()
+        self._wakeup.clear()
+
+        if _deadline is None:
+            _timeout = max_delay
+        else:
+            _timeout = max((_deadline - now).total_seconds(), 0)
+            if max_delay is not None:
+                _timeout = min(_timeout, max_delay)
+
+        if _timeout == 0:
+            return
+
+        await self.clock.wait(self._wakeup, _timeout)
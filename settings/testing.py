@@ -0,0 +1,38 @@
+import os
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# shared cache keeps a single in-memory database across the ORM threads
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'file:tazdingo?mode=memory&cache=shared',
+    }
+}
+
+INSTALLED_APPS = (
+    'data',
+    'polymorphic',
+    'django.contrib.contenttypes',
+)
+
+USE_TZ = True
+TIME_ZONE = 'GMT'
+
+SECRET_KEY = 'testing'
+TAZDINGO_TOKEN = ''
+GUILD_ID = 0
+SHIELDS_CHANNEL_ID = 0
+ALERTS_CHANNEL_ID = 0
+DEVELOPMENT = True
+OWNER = 1
+OWNERS_ROLE = 0
+VISION_WORKERS = 2  # processes reading timer screenshots
+METRICS_PORT = None  # serves /metrics on localhost when set
+API_PORT = None  # serves the read-only JSON API when set
+API_HOST = '127.0.0.1'
+ROLE = 'all'  # 'commands' or 'notifier' to split the bot over several processes
+SYNC_CHANGES = False  # required when more than one process shares the database
+SHARD_ID = None
+SHARD_COUNT = None  # set on command processes to split the guilds between them
+EVENT_RETENTION_DAYS = 365  # history older than this is deleted, None keeps it all
@@ -0,0 +1,491 @@
+import asyncio
+import json
+import sqlite3
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from metrics import TazdingoMetrics
+from records import Record
+from reminders import DEFAULT_PREY_DURATIONS, DEFAULT_SHIELD_REMINDERS, format_seconds
+
+
+CACHED_STATEMENTS = 64
+BUSY_TIMEOUT = 5000
+LOAD_BATCH_SIZE = 500
+DEFAULT_DB_ALIAS = 'default'
+# sqlite3 binds these as they are, only the remaining field types go through django
+NATIVE_FIELD_TYPES = ('AutoField', 'BigAutoField', 'BigIntegerField', 'BooleanField', 'CharField', 'ForeignKey', 'IntegerField', 'TextField')
+
+# keyed by model name so importing this module does not need django set up
+NATURAL_KEYS = {
+    'Guild': ('guild_id',),
+    'Shield': ('guild_id', 'user_id'),
+    'Reinforcement': ('guild_id', 'user_id'),
+    'Prey': ('guild_id', 'prey_name'),
+    'PreyEstimate': ('guild_id', 'prey_name'),
+    'MemberSettings': ('guild_id', 'user_id'),
+    'Lease': ('name',),
+    'EventCount': ('guild_id', 'day', 'kind'),
+}
+# append-only tables, rows are only ever inserted
+LOG_MODELS = ('Event', 'Change')
+# rows other processes follow through the change table
+SHARED_MODELS = ('Guild', 'Shield', 'Reinforcement', 'Prey', 'PreyEstimate', 'MemberSettings')
+# tables from before guilds existed, rebuilt under their natural keys when opened
+LEGACY_MODELS = ('Shield', 'Reinforcement', 'Prey')
+# the fixed alerts legacy rows were flagged for, in the order of the defaults
+LEGACY_SHIELD_FLAGS = ('expiring_notification', 'expired_notification')
+LEGACY_PREY_FLAGS = ('four_notification', 'eight_notification', 'twelve_notification', 'twenty_four_notification')
+CHANGES_BATCH_SIZE = 1000
+RETENTION_BATCH_SIZE = 500
+
+
+class LegacyDatabaseError(Exception):
+    pass
+
+
+def get_natural_key(obj):
+    return tuple(getattr(obj, _field) for _field in NATURAL_KEYS[type(obj).__name__])
+
+
+def get_prep(field):
+    if field.get_internal_type() in NATIVE_FIELD_TYPES:
+        return field.attname, None
+    return field.attname, field.get_db_prep_save
+
+
+class ModelTable(object):
+    # the statements are built once per model so sqlite3 keeps reusing their prepared form
+    def __init__(self, model, connection):
+        super(ModelTable, self).__init__()
+        from django.contrib.contenttypes.models import ContentType
+
+        _key_names = NATURAL_KEYS.get(model.__name__, ())
+        self.model = model
+        self.fields = model._meta.concrete_fields
+        self.key_fields = [model._meta.get_field(_name) for _name in _key_names]
+        self.write_fields = [_field for _field in self.fields if not (_field.primary_key and _field.name not in _key_names)]
+        # the content type is the same for every row, so it is never read back
+        self.load_fields = [_field for _field in self.fields if _field.attname != 'polymorphic_ctype_id']
+        self.load_attnames = [_field.attname for _field in self.load_fields]
+
+        _table = self.name = model._meta.db_table
+        _columns = ", ".join(_field.column for _field in self.write_fields)
+        _placeholders = ", ".join("?" for _field in self.write_fields)
+        _keys = ", ".join(_field.column for _field in self.key_fields)
+        _updates = ", ".join(f"{_field.column} = excluded.{_field.column}" for _field in self.write_fields if _field not in self.key_fields)
+        _where = " AND ".join(f"{_field.column} = ?" for _field in self.key_fields)
+
+        self.select_sql = f"SELECT {', '.join(_field.column for _field in self.load_fields)} FROM {_table}"
+        self.insert_sql = f"INSERT INTO {_table} ({_columns}) VALUES ({_placeholders})"
+        self.delete_sql = self.upsert_sql = self.increment_sql = None
+        if self.key_fields:
+            self.delete_sql = f"DELETE FROM {_table} WHERE {_where}"
+            if _updates:
+                self.upsert_sql = f"{self.insert_sql} ON CONFLICT ({_keys}) DO UPDATE SET {_updates}"
+                # counters add the incoming values instead of replacing them
+                _increments = ", ".join(f"{_field.column} = {_field.column} + excluded.{_field.column}" for _field in self.write_fields if _field not in self.key_fields)
+                self.increment_sql = f"{self.insert_sql} ON CONFLICT ({_keys}) DO UPDATE SET {_increments}"
+            else:
+                self.upsert_sql = f"{self.insert_sql} ON CONFLICT ({_keys}) DO NOTHING"
+
+        self.write_preps = [get_prep(_field) for _field in self.write_fields]
+        self.key_preps = [get_prep(_field) for _field in self.key_fields]
+
+        self.converters = []
+        for _field in self.load_fields:
+            _col = _field.get_col(_table)
+            self.converters.append(connection.ops.get_db_converters(_col) + _col.get_db_converters(connection))
+
+        self.ctype_id = None
+        if hasattr(model, 'polymorphic_ctype_id'):
+            self.ctype_id = ContentType.objects.get_for_model(model, for_concrete_model=False).pk
+
+    def from_row(self, row, connection):
+        _values = []
+        for _value, _converters in zip(row, self.converters):
+            for _converter in _converters:
+                _value = _converter(_value, None, connection)
+            _values.append(_value)
+        _obj = self.model.from_db(DEFAULT_DB_ALIAS, self.load_attnames, _values)
+        if self.ctype_id is not None:
+            _obj.polymorphic_ctype_id = self.ctype_id
+        return _obj
+
+    def _get_params(self, values, preps, connection):
+        _params = []
+        for _attname, _prep in preps:
+            _value = values.get(_attname)
+            if _prep is not None and _value is not None:
+                _value = _prep(_value, connection)
+            _params.append(_value)
+        return _params
+
+    def get_params(self, values, connection):
+        if self.ctype_id is not None and values.get('polymorphic_ctype_id') is None:
+            values['polymorphic_ctype_id'] = self.ctype_id
+        return self._get_params(values, self.write_preps, connection)
+
+    def get_key_params(self, values, connection):
+        return self._get_params(values, self.key_preps, connection)
+
+
+def get_legacy_marks(row, now):
+    # an untracked shield was flagged from the start, one that did not pass yet cannot have been announced
+    _entered = datetime.fromisoformat(row['entered']).replace(tzinfo=timezone.utc).timestamp()
+    _flags = dict(zip(DEFAULT_PREY_DURATIONS, (bool(row[_flag]) for _flag in LEGACY_PREY_FLAGS)))
+    _marks = [_mark for _mark, _flag in _flags.items() if not _flag or _entered + _mark <= now] or list(DEFAULT_PREY_DURATIONS)
+    _notified = sum(1 << _idx for _idx, _mark in enumerate(_marks) if _flags[_mark])
+    return format_seconds(_marks), _notified
+
+
+def get_values(obj):
+    # records skip building a model instance, models already hold their values by attribute name
+    if isinstance(obj, Record):
+        return obj.to_values()
+    return obj.__dict__
+
+
+class TazdingoStorage(object):
+    def __init__(self, database=None, metrics=None, origin=None, guild_id=None):
+        super(TazdingoStorage, self).__init__()
+        self.database = database
+        # the guild rows of a legacy table are given, it only ever served one
+        self.guild_id = guild_id
+        self.metrics = metrics or TazdingoMetrics()
+        # writes are recorded in the change table only when other processes follow them
+        self.origin = origin
+        self.journal_mode = None
+        self._tables = {}
+        self._schemas = {}
+        self._connection = None
+        self._reader = None
+        self._ops = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tazdingo-db')
+        self._reader_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tazdingo-db-reader')
+
+    def open(self):
+        # table metadata and content types come from the ORM once, then the
+        # worker threads own the only connections used at runtime
+        from django.apps import apps
+        from django.db import connections
+
+        self._ops = connections[DEFAULT_DB_ALIAS]
+        if self.database is None:
+            self.database = self._ops.settings_dict['NAME']
+        for _name in tuple(NATURAL_KEYS) + LOG_MODELS:
+            self._tables[_name] = ModelTable(apps.get_model('data', _name), self._ops)
+        for _name in LEGACY_MODELS:
+            with self._ops.schema_editor(collect_sql=True) as _editor:
+                _editor.create_model(self._tables[_name].model)
+            self._schemas[_name] = _editor.collected_sql
+        self._executor.submit(self._connect).result()
+        self._reader_executor.submit(self._connect_reader).result()
+
+    def _open_connection(self):
+        _connection = sqlite3.connect(
+            self.database,
+            uri=self.database.startswith('file:'),
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=CACHED_STATEMENTS,
+        )
+        _connection.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT}")
+        return _connection
+
+    def _connect(self):
+        self._connection = self._open_connection()
+        self.journal_mode = self._connection.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+        self._connection.execute("PRAGMA synchronous = NORMAL")
+        self._upgrade_tables()
+        self._create_indexes()
+
+    def _upgrade_tables(self):
+        # syncdb leaves existing tables alone, so ones missing a column are
+        # rebuilt from the model's schema with their rows copied over
+        for _name, _schema in self._schemas.items():
+            _table = self._tables[_name]
+            _legacy = {_row[1] for _row in self._connection.execute(f"PRAGMA table_info({_table.name})")}
+            _fields = [_field for _field in _table.write_fields if not _field.primary_key]
+            if not _legacy or all(_field.column in _legacy for _field in _fields):
+                continue
+            if 'guild_id' not in _legacy and not self.guild_id:
+                # guessing would move the rows to a guild nobody can reach
+                raise LegacyDatabaseError(f"{_table.name} is from before guilds, set GUILD_ID to the guild it belongs to")
+
+            _create, _indexes = _schema[0], _schema[1:]
+            _columns = ", ".join(_field.column for _field in _fields)
+            _placeholders = ", ".join("?" for _field in _fields)
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._connection.execute(f"ALTER TABLE {_table.name} RENAME TO {_table.name}_legacy")
+                self._connection.execute(_create)
+                _cursor = self._connection.execute(f"SELECT * FROM {_table.name}_legacy")
+                _names = [_column[0] for _column in _cursor.description]
+                _rows = []
+                for _row in _cursor:
+                    _values = self._get_legacy_values(_name, dict(zip(_names, _row)))
+                    _rows.append([_values[_field.column] for _field in _fields])
+                self._connection.executemany(f"INSERT INTO {_table.name} ({_columns}) VALUES ({_placeholders})", _rows)
+                # the old indexes go with the old table, their names are reused
+                self._connection.execute(f"DROP TABLE {_table.name}_legacy")
+                for _sql in _indexes:
+                    self._connection.execute(_sql)
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    def _get_legacy_values(self, name, row):
+        _table = self._tables[name]
+        _values = {}
+        for _field in _table.write_fields:
+            if _field.column in row:
+                _values[_field.column] = row[_field.column]
+            elif _field.column == 'guild_id':
+                _values[_field.column] = self.guild_id
+            else:
+                _values[_field.column] = _field.get_default()
+
+        if name == 'Shield' and LEGACY_SHIELD_FLAGS[0] in row:
+            _values['reminders'] = format_seconds(DEFAULT_SHIELD_REMINDERS)
+            _values['notified'] = sum(1 << _idx for _idx, _flag in enumerate(LEGACY_SHIELD_FLAGS) if row[_flag])
+        elif name == 'Prey' and LEGACY_PREY_FLAGS[0] in row:
+            _values['marks'], _values['notified'] = get_legacy_marks(row, time.time())
+        return _values
+
+    def _create_indexes(self):
+        # tables created before an index was added to their model never got it from syncdb
+        for _table in self._tables.values():
+            _meta = _table.model._meta
+            for _index in _meta.indexes:
+                _columns = ", ".join(_meta.get_field(_name).column for _name in _index.fields)
+                self._connection.execute(f"CREATE INDEX IF NOT EXISTS {_index.name} ON {_table.name} ({_columns})")
+
+    def _connect_reader(self):
+        # with WAL, queries on this connection never wait for a flush to commit
+        self._reader = self._open_connection()
+        self._reader.execute("PRAGMA query_only = 1")
+        self._reader.execute("PRAGMA read_uncommitted = 1")
+
+    async def _run(self, executor, fn, *args):
+        # covers the wait for the worker thread as well as the query itself
+        _start = time.perf_counter()
+        try:
+            return await asyncio.get_event_loop().run_in_executor(executor, fn, *args)
+        finally:
+            self.metrics.observe('db_call_seconds', time.perf_counter() - _start, call=fn.__name__.lstrip('_'))
+
+    async def _call(self, fn, *args):
+        return await self._run(self._executor, fn, *args)
+
+    async def _read(self, fn, *args):
+        return await self._run(self._reader_executor, fn, *args)
+
+    async def load(self, model, batch_size=LOAD_BATCH_SIZE):
+        # rows are streamed in batches, each one converted on the worker
+        _table = self._tables[model.__name__]
+        _cursor = await self._read(self._reader.execute, _table.select_sql)
+        try:
+            while True:
+                _objs = await self._read(self._fetch, _table, _cursor, batch_size)
+                if not _objs:
+                    break
+                for _obj in _objs:
+                    yield _obj
+        finally:
+            await self._read(_cursor.close)
+
+    async def upsert(self, objs):
+        await self._call(self._write, objs, ())
+
+    async def delete(self, objs):
+        await self._call(self._write, (), objs)
+
+    async def write(self, saves, deletes, appends=()):
+        await self._call(self._write, saves, deletes, appends)
+
+    async def get_events(self, guild_id, limit, user_id=None, subject=None):
+        return await self._read(self._get_events, guild_id, limit, user_id, subject)
+
+    async def get_event_counts(self, guild_id, since):
+        return await self._read(self._get_event_counts, guild_id, since)
+
+    async def acquire_lease(self, name, holder, ttl):
+        return await self._call(self._acquire_lease, name, holder, ttl)
+
+    async def release_lease(self, name, holder):
+        await self._call(self._release_lease, name, holder)
+
+    async def get_last_change(self):
+        return await self._read(self._get_last_change)
+
+    async def get_changes(self, after, limit=CHANGES_BATCH_SIZE):
+        return await self._read(self._get_changes, after, limit)
+
+    async def get_rows(self, name, keys):
+        return await self._read(self._get_rows, name, keys)
+
+    async def prune_changes(self, before):
+        await self._call(self._prune_changes, before)
+
+    async def prune_events(self, before, limit=RETENTION_BATCH_SIZE):
+        return await self._call(self._prune_events, before, limit)
+
+    async def get_pages(self):
+        return await self._call(self._get_pages)
+
+    async def analyze(self):
+        await self._call(self._connection.execute, "ANALYZE")
+
+    async def vacuum(self):
+        await self._call(self._connection.execute, "VACUUM")
+
+    async def checkpoint(self):
+        # only does something in WAL mode, where it also truncates the log file
+        return await self._call(self._checkpoint)
+
+    async def close(self):
+        if self._reader is not None:
+            await self._read(self._reader.close)
+            self._reader = None
+        if self._connection is not None:
+            await self._call(self._connection.close)
+            self._connection = None
+        self._reader_executor.shutdown(wait=False)
+        self._executor.shutdown(wait=False)
+
+    def _fetch(self, table, cursor, batch_size):
+        return [table.from_row(_row, self._ops) for _row in cursor.fetchmany(batch_size)]
+
+    def _get_events(self, guild_id, limit, user_id, subject):
+        # served by the (guild_id, user_id, created) and (guild_id, subject, created) indexes
+        _table = self._tables['Event']
+        if subject is not None:
+            _sql = f"{_table.select_sql} WHERE guild_id = ? AND subject = ? ORDER BY created DESC LIMIT ?"
+            _params = (guild_id, subject, limit)
+        else:
+            _sql = f"{_table.select_sql} WHERE guild_id = ? AND user_id = ? ORDER BY created DESC LIMIT ?"
+            _params = (guild_id, user_id, limit)
+        return [_table.from_row(_row, self._ops) for _row in self._reader.execute(_sql, _params)]
+
+    def _get_event_counts(self, guild_id, since):
+        _sql = f"SELECT kind, SUM(count), SUM(duration) FROM {self._tables['EventCount'].name} WHERE guild_id = ? AND day >= ? GROUP BY kind ORDER BY kind"
+        return self._reader.execute(_sql, (guild_id, since.isoformat())).fetchall()
+
+    def _acquire_lease(self, name, holder, ttl):
+        # the write lock taken by BEGIN IMMEDIATE makes the check and the takeover atomic across processes
+        _table = self._tables['Lease'].name
+        _now = time.time()
+        _connection = self._connection
+        _connection.execute("BEGIN IMMEDIATE")
+        try:
+            _connection.execute(
+                f"INSERT INTO {_table} (name, holder, expires) VALUES (?, ?, ?) "
+                f"ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires = excluded.expires "
+                f"WHERE {_table}.holder = excluded.holder OR {_table}.expires < ?",
+                (name, holder, _now + ttl, _now),
+            )
+            _holder, _expires = _connection.execute(f"SELECT holder, expires FROM {_table} WHERE name = ?", (name,)).fetchone()
+        except Exception:
+            _connection.execute("ROLLBACK")
+            raise
+        _connection.execute("COMMIT")
+        return _holder == holder, _expires
+
+    def _release_lease(self, name, holder):
+        self._connection.execute(f"DELETE FROM {self._tables['Lease'].name} WHERE name = ? AND holder = ?", (name, holder))
+
+    def _get_last_change(self):
+        return self._reader.execute(f"SELECT MAX(id) FROM {self._tables['Change'].name}").fetchone()[0] or 0
+
+    def _get_changes(self, after, limit):
+        return self._reader.execute(f"SELECT id, origin, model, key FROM {self._tables['Change'].name} WHERE id > ? ORDER BY id LIMIT ?", (after, limit)).fetchall()
+
+    def _get_rows(self, name, keys):
+        # the current row for every key, None for the ones deleted since
+        _table = self._tables[name]
+        _sql = f"{_table.select_sql} WHERE {' AND '.join(f'{_field.column} = ?' for _field in _table.key_fields)}"
+        _rows = []
+        for _key in keys:
+            _row = self._reader.execute(_sql, json.loads(_key)).fetchone()
+            _rows.append((_key, _table.from_row(_row, self._ops) if _row is not None else None))
+        return _rows
+
+    def _prune_changes(self, before):
+        self._connection.execute(f"DELETE FROM {self._tables['Change'].name} WHERE created < ?", (before,))
+
+    def _prune_events(self, before, limit):
+        # small batches keep the write lock short, the summaries live on in the counts
+        _table = self._tables['Event']
+        _before = _table.model._meta.get_field('created').get_db_prep_save(before, self._ops)
+        _sql = f"DELETE FROM {_table.name} WHERE id IN (SELECT id FROM {_table.name} WHERE created < ? LIMIT ?)"
+        return self._connection.execute(_sql, (_before, limit)).rowcount
+
+    def _get_pages(self):
+        _pages = self._connection.execute("PRAGMA page_count").fetchone()[0]
+        _free = self._connection.execute("PRAGMA freelist_count").fetchone()[0]
+        return _pages, _free
+
+    def _checkpoint(self):
+        return tuple(self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone())
+
+    def _get_changes_params(self, keys):
+        _now = time.time()
+        return [(self.origin, _name, json.dumps(_key), _now) for _name, _key in keys]
+
+    def _get_counts(self, events):
+        _counts = Counter()
+        _durations = Counter()
+        for _event in events:
+            _key = (_event['guild_id'], _event['created'].date(), _event['kind'])
+            _counts[_key] += 1
+            _durations[_key] += _event['duration'] or 0
+
+        _rows = []
+        for (_guild_id, _day, _kind), _count in _counts.items():
+            _rows.append({'guild_id': _guild_id, 'day': _day, 'kind': _kind, 'count': _count, 'duration': _durations[(_guild_id, _day, _kind)]})
+        return _rows
+
+    def _write(self, saves, deletes, appends=()):
+        _saves = defaultdict(list)
+        _deletes = defaultdict(list)
+        for _obj in saves:
+            _saves[type(_obj).__name__].append(get_values(_obj))
+        for _obj in deletes:
+            _deletes[type(_obj).__name__].append(get_values(_obj))
+
+        _connection = self._connection
+        _connection.execute("BEGIN IMMEDIATE")
+        try:
+            _changed = []
+            for _name, _values in _deletes.items():
+                _table = self._tables[_name]
+                _keys = [_table.get_key_params(_v, self._ops) for _v in _values]
+                _connection.executemany(_table.delete_sql, _keys)
+                if self.origin is not None and _name in SHARED_MODELS:
+                    _changed.extend((_name, _key) for _key in _keys)
+
+            for _name, _values in _saves.items():
+                _table = self._tables[_name]
+                _connection.executemany(_table.upsert_sql, [_table.get_params(_v, self._ops) for _v in _values])
+                if self.origin is not None and _name in SHARED_MODELS:
+                    _changed.extend((_name, _table.get_key_params(_v, self._ops)) for _v in _values)
+
+            if _changed:
+                # committed together with the rows, followers never see a change before its data
+                _connection.executemany(f"INSERT INTO {self._tables['Change'].name} (origin, model, key, created) VALUES (?, ?, ?, ?)", self._get_changes_params(_changed))
+
+            if appends:
+                _events = [get_values(_obj) for _obj in appends]
+                _table = self._tables['Event']
+                _connection.executemany(_table.insert_sql, [_table.get_params(_v, self._ops) for _v in _events])
+                # the per day aggregates move forward in the same transaction
+                _table = self._tables['EventCount']
+                _connection.executemany(_table.increment_sql, [_table.get_params(_v, self._ops) for _v in self._get_counts(_events)])
+        except Exception:
+            _connection.execute("ROLLBACK")
+            raise
+        _connection.execute("COMMIT")
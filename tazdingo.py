@@ -1,59 +1,243 @@
+import time
+# taken before the heavy imports so the cold start figure covers them
+STARTED = time.perf_counter()
+
+import argparse
 import asyncio
+import contextlib
 import discord
+import functools
+import heapq
 import io
+import itertools
+import json
 import os
 import re
+import socket
 import sqlite3
-from asgiref.sync import sync_to_async
+import traceback
+import uuid
+from collections import defaultdict
 from datetime import timedelta
-from django.utils import timezone
-from utils import get_human_time, get_member_name, is_tuple, parse_time
+from clock import TazdingoClock
+from dispatch import ArgumentError, CommandRegistry, PermissionDeniedError, UnknownCommandError
+from metrics import LAG_BUCKETS, TazdingoMetrics
+from outbox import TazdingoOutbox
+from persistence import TazdingoPersistence
+from reminders import DEFAULT_PREY_DURATIONS, DEFAULT_SHIELD_REMINDERS, format_seconds, get_observed, get_prey_durations, get_shield_reminders, is_valid, parse_seconds
+from scheduler import TazdingoScheduler
+from storage import RETENTION_BATCH_SIZE, TazdingoStorage
+from utils import MESSAGE_LIMIT, PAGE_SIZE, GridIndex, KeyedLock, SortedIndex, get_chunks, get_human_time, get_page_bounds
+from vision import VISION_WORKERS, TazdingoVision
 
 # Django
 from conf import settings
 from data import models
+import records
 
 
 ROBOT_FACE_EMOJI = '\N{ROBOT FACE}'
 CROSS_MARK_EMOJI = '\N{CROSS MARK}'
+NO_ENTRY_EMOJI = '\N{NO ENTRY}'
 SHIELD_EMOJI = '\N{SHIELD}'
 ALERTS_DELAY = 60
-TIMEDELTA_0 = timedelta(hours=0)
-TIMEDELTA_1 = timedelta(hours=1)
-TIMEDELTA_4 = timedelta(hours=4)
-TIMEDELTA_8 = timedelta(hours=8)
-TIMEDELTA_12 = timedelta(hours=12)
-TIMEDELTA_24 = timedelta(hours=24)
-DEFAULT_SHIELDS = set([4, 8, 12, 24])
+BOARD_DELAY = 2
+OUTBOX_SHUTDOWN_DELAY = 5
+SHIELD_EXPIRED_TEXT = "Hey! Your shield has expired!"
+SHIELD_EXPIRING_TEXT = "Hey! Your shield expires in {}!"
+CATCH_UP_TEXT = "Hey! You missed some alerts while I was offline:"
+# alerts handled this late are treated as missed during downtime and sent as a digest
+CATCH_UP_LAG = 5 * 60
+ROLES = ('all', 'commands', 'notifier')
+NOTIFIER_LEASE = 'notifier'
+# a dead notifier is replaced within LEASE_TTL, the live one renews well before that
+LEASE_TTL = 10
+LEASE_RENEW = 3
+CHANGES_DELAY = 1
+CHANGES_RETENTION = 3600
+MAINTENANCE_DELAY = 15 * 60
+# maintenance only runs once no command came in for this long
+QUIET_DELAY = 5 * 60
+SHIELD_RETENTION = timedelta(days=7)
+PREY_RETENTION = timedelta(days=7)
+EVENT_RETENTION_DAYS = 365
+ANALYZE_INTERVAL = timedelta(days=1)
+# the file is rebuilt once this share of its pages is free
+VACUUM_FREE_RATIO = 0.25
+BOARD_RESOLUTION = 60
+SHIELD_KEY = 'shield'
+PREY_KEY = 'prey'
+NEAR_RADIUS = 50
+HISTORY_SIZE = 20
+SUMMARY_DAYS = {'day': 1, 'week': 7, 'month': 30}
+EVENT_SHIELD = 'shield'
+EVENT_UNSHIELD = 'unshield'
+EVENT_REIN = 'rein'
+EVENT_RECALL = 'recall'
+EVENT_TRACK = 'track'
+EVENT_LOSE = 'lose'
+EVENT_MARK = 'mark'
+# a prey's own shield history only takes over once it has been seen this often
+ESTIMATE_MIN_OBSERVATIONS = 3
+ESTIMATE_MIN_SHARE = 0.15
+
+
+def get_shield_deadline(shield):
+    return shield.get_deadline()
+
+
+def get_prey_deadline(prey, now=None):
+    return prey.get_deadline(now)
+
+
+def format_marks(marks):
+    return " ".join(get_human_time(timedelta(seconds=_mark)) for _mark in marks)
+
+
+def make_file(data, filename):
+    return discord.File(io.BytesIO(data), filename)
 
 
 class TazdingoPoach(object):
-    def __init__(self):
+    def __init__(self, guild_id=None):
         super(TazdingoPoach, self).__init__()
+        self.guild_id = guild_id
         self.shields = {}
         self.reins = {}
         self.preys = {}
-
-    def load_from_db(self):
-        for _shield in models.Shield.objects.all():
+        self.estimates = {}
+        self.member_settings = {}
+        self.version = 0
+        self.listeners = []
+        self._view = None
+        self._shields_by_expiration = SortedIndex()
+        self._preys_by_deadline = SortedIndex()
+        self._preys_by_coords = GridIndex()
+
+    def _changed(self):
+        self.version += 1
+        for _listener in self.listeners:
+            _listener()
+
+    def get_view(self):
+        # readers that await get immutable copies, made again only after a change
+        if self._view is None or self._view[0] != self.version:
+            self._view = (self.version, tuple(self.shields.values()), tuple(self.reins.values()), tuple(self.preys.values()))
+        return self._view
+
+    def add_shield(self, shield):
+        self.shields[shield.user_id] = shield
+        self._shields_by_expiration.add(shield.user_id, shield.expires)
+        self._changed()
+
+    def add_shields(self, shields):
+        # a batch sorts into the index once and notifies the listeners once
+        for _shield in shields:
             self.shields[_shield.user_id] = _shield
+        self._shields_by_expiration.update((_shield.user_id, _shield.expires) for _shield in shields)
+        self._changed()
+
+    def pop_shield(self, user_id):
+        self._shields_by_expiration.remove(user_id)
+        _shield = self.shields.pop(user_id, None)
+        if _shield:
+            self._changed()
+        return _shield
+
+    def add_rein(self, rein):
+        self.reins[rein.user_id] = rein
+        self._changed()
+
+    def pop_rein(self, user_id):
+        _rein = self.reins.pop(user_id, None)
+        if _rein:
+            self._changed()
+        return _rein
+
+    def get_sorted_shields(self, start=None, stop=None):
+        return [self.shields[_user_id] for _user_id in self._shields_by_expiration.keys(start, stop)]
+
+    def get_expired_shields(self, now):
+        return [self.shields[_user_id] for _user_id in self._shields_by_expiration.before(now)]
 
-        for _rein in models.Reinforcement.objects.all():
-            self.reins[_rein.user_id] = _rein
+    def add_prey(self, prey):
+        self.preys[prey.prey_name] = prey
+        self._preys_by_coords.add(prey.prey_name, prey.coords)
+        self.update_prey(prey)
 
-        for _prey in models.Prey.objects.all():
+    def add_preys(self, preys):
+        for _prey in preys:
             self.preys[_prey.prey_name] = _prey
+            self._preys_by_coords.add(_prey.prey_name, _prey.coords)
+        self._preys_by_deadline.update((_prey.prey_name, get_prey_deadline(_prey)) for _prey in preys)
+        self._changed()
+
+    def update_prey(self, prey):
+        # records are immutable, the updated one replaces the stored one
+        self.preys[prey.prey_name] = prey
+        self._preys_by_deadline.add(prey.prey_name, get_prey_deadline(prey))
+        self._changed()
+
+    def pop_prey(self, prey_name):
+        self._preys_by_deadline.remove(prey_name)
+        self._preys_by_coords.remove(prey_name)
+        _prey = self.preys.pop(prey_name, None)
+        if _prey:
+            self._changed()
+        return _prey
+
+    def get_stale_preys(self, before):
+        return [self.preys[_prey_name] for _prey_name in self._preys_by_deadline.before(before)]
+
+    def count_tracked_preys(self):
+        return len(self._preys_by_deadline)
+
+    def count_overdue_preys(self, now):
+        return self._preys_by_deadline.count_before(now)
+
+    def get_near_preys(self, coords, radius):
+        return [(_distance_sq, self.preys[_prey_name]) for _distance_sq, _prey_name in self._preys_by_coords.near(coords, radius)]
+
+    def get_estimate(self, prey_name):
+        # estimates with too few observations are as good as none
+        _estimate = self.estimates.get(prey_name)
+        if _estimate is None or _estimate.total < ESTIMATE_MIN_OBSERVATIONS:
+            return None
+        return _estimate
+
+    def observe_prey(self, prey_name, mark):
+        _estimate = self.estimates.get(prey_name)
+        if _estimate is None:
+            _estimate = records.PreyEstimate(self.guild_id, prey_name, ())
+        _estimate = self.estimates[prey_name] = _estimate.observe(mark)
+        return _estimate
+
+    def iter_sorted_preys(self, start=0):
+        for _deadline, _prey_name in self._preys_by_deadline.iter_from(start):
+            yield _deadline, self.preys[_prey_name]
 
 
 class TazdingoCommands(object):
-    def __init__(self, poach=None):
+    def __init__(self, poach=None, scheduler=None, persistence=None, config=None, board=None, outbox=None, clock=None, vision=None, metrics=None):
         super(TazdingoCommands, self).__init__()
         self.poach = poach
-        self.start_time = timezone.now()
+        self.scheduler = scheduler
+        self.persistence = persistence
+        self.config = config
+        self.board = board
+        self.outbox = outbox
+        self.clock = clock or TazdingoClock()
+        self.vision = vision
+        self.metrics = metrics or TazdingoMetrics()
+        # commands on the same member or prey run in arrival order, the others run concurrently
+        self.locks = KeyedLock()
+        self.start_time = self.clock.now()
 
     def _is_owner(self, user):
         if user.id == settings.OWNER:
             return True
+        elif user.id == user.guild.owner_id:
+            return True
         else:
             for r in user.roles:
                 if settings.OWNERS_ROLE == r.id:
@@ -67,186 +251,231 @@ class TazdingoCommands(object):
 
         cmd, args = message_content[0].lower(), message_content[1:]
 
-        if cmd == '$commands':
-            await self._on_commands(message)
-        elif cmd == '$hive':
-            await self._on_hive(message)
-        elif cmd == '$status':
-            await self._on_status(message)
-        elif cmd in ['$shield', "shield"]:
-            if len(args) == 1:
-                _seconds = parse_time(args[0])
-                if _seconds is not None:
-                    await self._on_shield(message, _seconds)
-                else:
-                    await self._error(message)
-            else:
+        try:
+            _command, _kwargs = COMMANDS.resolve(cmd, args, message, self)
+        except UnknownCommandError:
+            if cmd.startswith('$'):
+                self.metrics.inc('commands_rejected_total', reason='unknown')
                 await self._error(message)
-        elif cmd == '$unshield':
-            await self._on_unshield(message)
-        elif cmd == '$rein':
-            await self._on_rein(message)
-        elif cmd == '$recall':
-            await self._on_recall(message)
-        elif cmd == '$notify':
-            await self._on_notify(message)
-        elif cmd == '$prune':
-            if self._is_owner(message.author):
-                await self._on_prune(message)
-            else:
-                await self._error(message)    
-        elif cmd == '$track':
-            if len(args) == 1:
-                _prey_name = get_member_name(args[0], message.mentions)
-                await self._on_track(message, prey_name=_prey_name)
-            elif len(args):
-                _prey_name = get_member_name(args[0], message.mentions)
-
-                if is_tuple(args[1]):
-                    _coords = args[1]
-                    _shields = args[2:]
-                else:
-                    _coords = None 
-                    _shields = args[1:]
-
-                try:
-                    _shields = set(map(int, _shields))
-                except ValueError:
-                    await self._error(message)    
-                else:
-                    await self._on_track(message, prey_name=_prey_name, coords=_coords, shields=_shields)
-            else:
-                await self._error(message)    
-        elif cmd == '$lose':
-            if len(args) == 1:
-                _prey_name = get_member_name(args[0], message.mentions)
-                await self._on_lose(message, prey_name=_prey_name)
-            else:
-                await self._error(message)
-        elif cmd == '$tracks':
-            await self._on_tracks(message)
-        elif cmd.startswith('$'):
+        except PermissionDeniedError:
+            self.metrics.inc('commands_rejected_total', reason='permission')
+            self.outbox.react(message, NO_ENTRY_EMOJI)
+        except ArgumentError as e:
+            self.metrics.inc('commands_rejected_total', reason='arguments')
+            self.outbox.send(message.channel, f"`{e}`")
             await self._error(message)
+        else:
+            _start = time.perf_counter()
+            try:
+                await getattr(self, _command.handler)(message, **_kwargs)
+            finally:
+                self.metrics.observe('command_seconds', time.perf_counter() - _start, command=_command.name)
 
     async def _on_commands(self, message):
-        available_commands = f"""```General commands:
-  $commands  shows this message
-  $status    shows bot status
-  $hive      shows all shields/reins
-
-Shield commands:
-  $shield <hours>  set a shield
-  $unshield        break a shield
-  $notify          notifies all expired shields
-
-Reinforcement commands:
-  $rein    reinforce
-  $recall  recall a reinforcement
-
-Moderator commands:
-  $prune  remove expired shields
-
-Track commands:
-  $tracks                                shows all tracks
-  $track <who> [<x>,<y>] [<shields>...]  tracks a given set of shields
-  $lose <who>                            stop tracking```"""
-        await message.channel.send(available_commands)
+        self.outbox.send(message.channel, f"```{COMMANDS.get_help()}```")
 
     async def _ack(self, message, text=""):
-        # await message.channel.send(text)
-        await message.add_reaction(ROBOT_FACE_EMOJI)
+        # self.outbox.send(message.channel, text)
+        self.outbox.react(message, ROBOT_FACE_EMOJI)
 
     async def _error(self, message, text=""):
-        # await message.channel.send(text)
-        await message.add_reaction(CROSS_MARK_EMOJI)
+        # self.outbox.send(message.channel, text)
+        self.outbox.react(message, CROSS_MARK_EMOJI)
 
     async def _on_status(self, message):
-        _now = timezone.now()
+        _now = self.clock.now()
         _up = get_human_time(_now - self.start_time)
-        await message.channel.send(f"Taz'dingo! Ye-e-es!\n{_now} up {_up}")
-
-    async def _on_hive(self, message):
-        if self.poach.shields or self.poach.reins:
-            if self.poach.shields:
-                _now = timezone.now()
-                _formatted_message = io.StringIO()
-                _formatted_message.write(f"Shields:```")
-                for _idx, _shield in enumerate(sorted(self.poach.shields.values(), key=lambda _s: _s.expires)):
-                    if _idx:
-                        _formatted_message.write(f"\n")
-
-                    if _shield.expires < _now:
-                        _human_time = "expired"
-                    else:
-                        _human_time = get_human_time(_shield.expires - _now)
-
-                    _formatted_message.write(f"{_human_time} {_shield.display_name}")
-                _formatted_message.write(f"```")
-                await message.channel.send(_formatted_message.getvalue())
-
-            if self.poach.reins:
-                _formatted_message = io.StringIO()
-                _formatted_message.write(f"Reins:```")
-                for _idx, _rein in enumerate(self.poach.reins.values()):
-                    if _idx:
-                        _formatted_message.write(f"\n")
-
-                    _formatted_message.write(f"{_rein.display_name}")
-                _formatted_message.write(f"```")
-                await message.channel.send(_formatted_message.getvalue())
+        _flush_ms = self.persistence.flush_latency * 1000
+        _flush_avg_ms = self.persistence.flush_latency_avg * 1000
+        _send_ms = self.outbox.latency_avg * 1000
+        self.outbox.send(message.channel, f"Taz'dingo! Ye-e-es!\n{_now} up {_up}\nflush {_flush_ms:.1f}ms (avg {_flush_avg_ms:.1f}ms, {len(self.persistence)} pending)\nsend {_send_ms:.1f}ms avg, {self.outbox.depth} queued")
+
+    async def _on_metrics(self, message):
+        _metrics = self.metrics
+        _lines = ["command        count   p50ms   p99ms   maxms"]
+        for _labels, _histogram in _metrics.get_histograms('command_seconds'):
+            _lines.append(f"{_labels['command']:<12} {_histogram.count:>7} {_histogram.quantile(0.5) * 1000:>7.2f} {_histogram.quantile(0.99) * 1000:>7.2f} {_histogram.max * 1000:>7.2f}")
+
+        _lag = _metrics.get_histogram('alerts_lag_seconds')
+        if _lag is not None:
+            _lines.append(f"alerts lag p50 {_lag.quantile(0.5):.2f}s p99 {_lag.quantile(0.99):.2f}s max {_lag.max:.2f}s over {_lag.count} ticks")
+        _flush = _metrics.get_histogram('db_flush_seconds')
+        if _flush is not None:
+            _lines.append(f"db flush p50 {_flush.quantile(0.5) * 1000:.1f}ms p99 {_flush.quantile(0.99) * 1000:.1f}ms over {_flush.count} flushes")
+        for _labels, _histogram in _metrics.get_histograms('db_call_seconds'):
+            _lines.append(f"db {_labels['call']} p50 {_histogram.quantile(0.5) * 1000:.1f}ms p99 {_histogram.quantile(0.99) * 1000:.1f}ms over {_histogram.count} calls")
+        _lines.append(f"queues: {self.outbox.depth} outbound ({self.outbox.throttled} throttled), {len(self.persistence)} pending writes, {len(self.scheduler)} scheduled")
+
+        for _chunk in get_chunks(_lines, "Metrics:"):
+            self.outbox.send(message.channel, _chunk)
+        await self._ack(message)
+
+    def _get_human_time(self, remaining, resolution=None):
+        if resolution:
+            _seconds = int(remaining.total_seconds()) // resolution * resolution
+            if not _seconds:
+                return f"<{get_human_time(timedelta(seconds=resolution))}"
+            remaining = timedelta(seconds=_seconds)
+        return get_human_time(remaining)
+
+    def render_shields(self, now, resolution=None, start=None, stop=None, header="Shields:", limit=MESSAGE_LIMIT):
+        _lines = []
+        for _shield in self.poach.get_sorted_shields(start, stop):
+            if _shield.expires < now:
+                _human_time = "expired"
+            else:
+                _human_time = self._get_human_time(_shield.expires - now, resolution)
+
+            _lines.append(f"{_human_time} {_shield.display_name}")
+        return get_chunks(_lines, header, limit)
+
+    def render_reins(self, start=None, stop=None, header="Reins:", limit=MESSAGE_LIMIT):
+        _lines = (f"{_rein.display_name}" for _rein in itertools.islice(self.poach.reins.values(), start, stop))
+        return get_chunks(_lines, header, limit)
+
+    def get_tracks(self, now):
+        # preys whose next mark already passed sit at the front of the index and
+        # are skipped in favour of their following mark, the rest is already sorted
+        _overdue_count = self.poach.count_overdue_preys(now)
+        _overdue = []
+        for _deadline, _prey in itertools.islice(self.poach.iter_sorted_preys(), _overdue_count):
+            _expires = get_prey_deadline(_prey, now)
+            if _expires is not None:
+                _overdue.append((_expires - now, _prey))
+        _overdue.sort(key=lambda _p: _p[0])
+        _upcoming = ((_deadline - now, _prey) for _deadline, _prey in self.poach.iter_sorted_preys(_overdue_count))
+
+        # overdue preys without a later mark are not listed, nor counted
+        _count = self.poach.count_tracked_preys() - _overdue_count + len(_overdue)
+        return _count, heapq.merge(_upcoming, _overdue, key=lambda _p: _p[0])
+
+    def render_tracks(self, now, resolution=None, start=None, stop=None, header="Tracks:", limit=MESSAGE_LIMIT, tracks=None):
+        if tracks is None:
+            _count, tracks = self.get_tracks(now)
+        _lines = (f"{self._get_human_time(_remaining, resolution)} {_prey.prey_name}{self._get_likely_suffix(_prey)}" for _remaining, _prey in itertools.islice(tracks, start, stop))
+        return get_chunks(_lines, header, limit)
+
+    def _get_likely_suffix(self, prey):
+        _estimate = self.poach.get_estimate(prey.prey_name)
+        if _estimate is None:
+            return ""
+        _marks = format_marks(_mark for _mark in _estimate.get_ranked(prey.marks) if not prey.is_notified(_mark))
+        return f" ({_marks})" if _marks else ""
+
+    async def _on_hive(self, message, page=1):
+        _bounds = get_page_bounds(page, max(len(self.poach.shields), len(self.poach.reins)))
+        if (self.poach.shields or self.poach.reins) and _bounds:
+            if self.board.shows(message.channel):
+                self.board.touch()
+            else:
+                _start, _stop, _pages = _bounds
+                _suffix = f" ({page}/{_pages})" if _pages > 1 else ""
+                if len(self.poach.shields) > _start:
+                    for _chunk in self.render_shields(self.clock.now(), start=_start, stop=_stop, header=f"Shields{_suffix}:"):
+                        self.outbox.send(message.channel, _chunk)
+
+                if len(self.poach.reins) > _start:
+                    for _chunk in self.render_reins(start=_start, stop=_stop, header=f"Reins{_suffix}:"):
+                        self.outbox.send(message.channel, _chunk)
 
             await self._ack(message)
         else:
             await self._error(message)
 
+    async def _read_timer(self, message):
+        if self.vision is None or not message.attachments:
+            return None
+        return await self.vision.read_timer(message.attachments)
+
+    def get_prey_durations(self):
+        return parse_seconds(self.config.prey_durations) or DEFAULT_PREY_DURATIONS
+
+    def get_shield_reminders(self, user_id):
+        # a member's own reminders win over the guild's
+        _settings = self.poach.member_settings.get(user_id)
+        if _settings is not None and _settings.shield_reminders:
+            return _settings.shield_reminders
+        return parse_seconds(self.config.shield_reminders) or DEFAULT_SHIELD_REMINDERS
+
+    def log_event(self, kind, user_id, subject, duration=None):
+        _event = records.Event(self.poach.guild_id, kind, user_id, subject, self.clock.now(), duration)
+        self.persistence.append(_event)
+
     async def _unshield(self, user_id):
-        _shield = self.poach.shields.pop(user_id, None)
+        _shield = self.poach.pop_shield(user_id)
+        self.scheduler.cancel((self.poach.guild_id, SHIELD_KEY, user_id))
         if _shield:
-            await sync_to_async(_shield.delete, thread_sensitive=True)()
+            self.persistence.delete(_shield)
+            self.log_event(EVENT_UNSHIELD, user_id, _shield.name, int((self.clock.now() - _shield.entered).total_seconds()))
+
+    def lock(self, kind, key):
+        if self.locks.locked((kind, key)):
+            self.metrics.inc('command_lock_waits_total', kind=kind)
+        return self.locks((kind, key))
+
+    async def _on_shield(self, message, duration=None):
+        async with self.lock(SHIELD_KEY, message.author.id):
+            await self._shield(message, duration)
+
+    async def _shield(self, message, duration):
+        if duration is None:
+            duration = await self._read_timer(message)
+            if duration is None:
+                await self._error(message)
+                return
 
-    async def _on_shield(self, message, seconds):
-        _now = timezone.now()
-        _expires = _now + timedelta(seconds=seconds)
-        _elapsed = _expires - _now
+        _now = self.clock.now()
+        _expires = _now + timedelta(seconds=duration)
         _user_id = message.author.id
-        _expired_notification = _expires < _now
-        _expiring_notification = _elapsed < timedelta(hours=1)
+        _reminders = self.get_shield_reminders(_user_id)
 
-        _shield = models.Shield(
+        _shield = records.Shield(
+          guild_id=self.poach.guild_id,
           name=message.author.name,
           user_id=message.author.id,
           display_name=message.author.display_name,
           entered=_now,
           expires=_expires,
-          expired_notification=_expired_notification,
-          expiring_notification=_expiring_notification,
+          reminders=_reminders,
+          notified=0,
         )
+        # reminders that would already have gone off are skipped
+        _shield = _shield._replace(notified=_shield.thresholds.get_passed(_expires, _now))
 
         await self._unshield(_user_id)
         await self._recall(_user_id)
-        await sync_to_async(_shield.save, thread_sensitive=True)()
-        self.poach.shields[_shield.user_id] = _shield
+        self.persistence.save(_shield)
+        self.poach.add_shield(_shield)
+        self.scheduler.schedule((self.poach.guild_id, SHIELD_KEY, _shield.user_id), get_shield_deadline(_shield))
+        self.log_event(EVENT_SHIELD, _user_id, _shield.name, duration)
 
         await self._ack(message, f"{message.author.mention} shield applied")
 
     async def _on_unshield(self, message):
         _user_id = message.author.id
-        if _user_id in self.poach.shields:
-            await self._unshield(_user_id)
-            await self._ack(message, f"{message.author.mention} shield removed")
-        else:
-            await self._error(message, f"{message.author.mention} shield not found")
+        async with self.lock(SHIELD_KEY, _user_id):
+            if _user_id in self.poach.shields:
+                await self._unshield(_user_id)
+                await self._ack(message, f"{message.author.mention} shield removed")
+            else:
+                await self._error(message, f"{message.author.mention} shield not found")
 
     async def _recall(self, user_id):
-        _rein = self.poach.reins.pop(user_id, None)
+        _rein = self.poach.pop_rein(user_id)
         if _rein:
-            await sync_to_async(_rein.delete, thread_sensitive=True)()
+            self.persistence.delete(_rein)
+            self.log_event(EVENT_RECALL, user_id, _rein.name, int((self.clock.now() - _rein.entered).total_seconds()))
 
     async def _on_rein(self, message):
-        _now = timezone.now()
+        async with self.lock(SHIELD_KEY, message.author.id):
+            await self._rein(message)
+
+    async def _rein(self, message):
+        _now = self.clock.now()
         _user_id = message.author.id
         
-        _rein = models.Reinforcement(
+        _rein = records.Reinforcement(
+          guild_id=self.poach.guild_id,
           name=message.author.name,
           user_id=message.author.id,
           display_name=message.author.display_name,
@@ -255,34 +484,28 @@ Track commands:
 
         await self._unshield(_user_id)
         if _user_id not in self.poach.reins:
-            await sync_to_async(_rein.save, thread_sensitive=True)()
-        self.poach.reins[_rein.user_id] = _rein
+            self.persistence.save(_rein)
+            self.log_event(EVENT_REIN, _user_id, _rein.name)
+        self.poach.add_rein(_rein)
 
         await self._ack(message, f"{message.author.mention} reinforcing")
 
     async def _on_recall(self, message):
         _user_id = message.author.id
-        if _user_id in self.poach.reins:
-            await self._recall(_user_id)
-            await self._ack(message, f"{message.author.mention} recalling")
-        else:
-            await self._error(message, f"{message.author.mention} reinforcement not found")
+        async with self.lock(SHIELD_KEY, _user_id):
+            if _user_id in self.poach.reins:
+                await self._recall(_user_id)
+                await self._ack(message, f"{message.author.mention} recalling")
+            else:
+                await self._error(message, f"{message.author.mention} reinforcement not found")
 
     async def _on_notify(self, message):
         if self.poach.shields:
-            _now = timezone.now()
-            _expired_shields = [_shield for _shield in self.poach.shields.values() if _shield.expires < _now]
+            _now = self.clock.now()
+            _expired_shields = self.poach.get_expired_shields(_now)
             if _expired_shields:
-                _formatted_message = io.StringIO()
-                for _idx, _shield in enumerate(_expired_shields):
-                    if _idx:
-                        _formatted_message.write(" ")
-
-                    if _shield.expires < _now:
-                        _formatted_message.write(f"<@!{_shield.user_id}>")
-
-                _formatted_message.write(f" Hey! Your shield has expired!")
-                await message.channel.send(_formatted_message.getvalue())
+                for _shield in _expired_shields:
+                    self.outbox.alert(message.channel, f"<@!{_shield.user_id}>", SHIELD_EXPIRED_TEXT)
                 await self._ack(message)
             else:
                 await self._error(message)
@@ -291,11 +514,15 @@ Track commands:
 
     async def _on_prune(self, message):
         if self.poach.shields:
-            _now = timezone.now()
-            _expired_shields = [_user_id for _user_id, _shield in self.poach.shields.items() if _shield.expires < _now]
+            _now = self.clock.now()
+            _expired_shields = self.poach.get_expired_shields(_now)
             if _expired_shields:
-                for _user_id in _expired_shields:
-                    await self._unshield(_user_id)
+                for _shield in _expired_shields:
+                    async with self.lock(SHIELD_KEY, _shield.user_id):
+                        # the member may have shielded again while the lock was awaited
+                        _current = self.poach.shields.get(_shield.user_id)
+                        if _current is not None and _current.expires <= _now:
+                            await self._unshield(_shield.user_id)
                 await self._ack(message)
             else:
                 await self._error(message)
@@ -303,178 +530,1006 @@ Track commands:
             await self._error(message)
 
     async def _lose(self, prey_name):
-        _prey = self.poach.preys.pop(prey_name, None)
+        _prey = self.poach.pop_prey(prey_name)
+        self.scheduler.cancel((self.poach.guild_id, PREY_KEY, prey_name))
         if _prey:
-            await sync_to_async(_prey.delete, thread_sensitive=True)()
-
-    async def _on_track(self, message, prey_name, coords=None, shields=DEFAULT_SHIELDS):
-        _four_notification = 4 not in shields
-        _eight_notification = 8 not in shields
-        _twelve_notification = 12 not in shields
-        _twenty_four_notification = 24 not in shields
+            self.persistence.delete(_prey)
+            _elapsed = int((self.clock.now() - _prey.entered).total_seconds())
+            self.log_event(EVENT_LOSE, _prey.user_id, prey_name, _elapsed)
+            # the prey's own marks, it may have been tracked with other shields than the defaults
+            self._observe(prey_name, get_observed(_prey.marks, _elapsed))
+
+    def _observe(self, prey_name, mark):
+        # every observation bumps a single counter, the ranking is read straight off the counts
+        if mark is not None:
+            self.persistence.save(self.poach.observe_prey(prey_name, mark))
+
+    async def _on_track(self, message, who, coords=None, shields=None):
+        async with self.lock(PREY_KEY, who):
+            await self._track(message, who, coords, shields)
+
+    async def _track(self, message, who, coords, shields):
+        _entered = self.clock.now()
+        _remaining = None
+        if shields is None:
+            _marks = self.get_prey_durations()
+            _estimate = self.poach.get_estimate(who)
+            if _estimate is not None:
+                # shields this prey was hardly ever seen under are not announced
+                _marks = _estimate.get_likely(_marks, ESTIMATE_MIN_SHARE) or _marks
+            _remaining = await self._read_timer(message)
+            if _remaining is not None:
+                # a screenshot of the prey's timer pins down which shield it is under
+                _mark = next((_m for _m in self.get_prey_durations() if _remaining <= _m), None)
+                if _mark is None:
+                    await self._error(message)
+                    return
+                _marks = (_mark,)
+                _entered = _entered + timedelta(seconds=_remaining - _mark)
+        else:
+            _marks = get_prey_durations(_hours * 3600 for _hours in shields)
 
-        if _four_notification and _eight_notification and _twelve_notification and _twenty_four_notification:
+        if not is_valid(_marks) or not all(_marks):
             await self._error(message)
         else:
-            _now = timezone.now()
             _user_id = message.author.id
 
-            _prey = models.Prey(
+            _prey = records.Prey(
+                guild_id=self.poach.guild_id,
                 user_id=_user_id,
-                prey_name=prey_name,
-                entered=_now,
-                four_notification=_four_notification,
-                eight_notification=_eight_notification,
-                twelve_notification=_twelve_notification,
-                twenty_four_notification=_twenty_four_notification,
+                prey_name=who,
+                coords=coords,
+                entered=_entered,
+                marks=_marks,
+                notified=0,
             )
 
-            if coords is not None:
-                _prey.coords = coords
+            await self._lose(who)
+            self.persistence.save(_prey)
+            self.poach.add_prey(_prey)
+            self.log_event(EVENT_TRACK, _user_id, who)
+            if _remaining is not None:
+                self._observe(who, _mark)
+            self.scheduler.schedule((self.poach.guild_id, PREY_KEY, _prey.prey_name), get_prey_deadline(_prey))
+            await self._ack(message)
+
+    async def _on_lose(self, message, who):
+        async with self.lock(PREY_KEY, who):
+            if who in self.poach.preys:
+                await self._lose(who)
+                await self._ack(message)
+            else:
+                await self._error(message)
 
-            await self._lose(prey_name)
-            await sync_to_async(_prey.save, thread_sensitive=True)()
-            self.poach.preys[_prey.prey_name] = _prey
+    async def _on_tracks(self, message, page=1):
+        _now = self.clock.now()
+        _count, _tracks = self.get_tracks(_now)
+        _bounds = get_page_bounds(page, _count)
+        if _count and _bounds:
+            if self.board.shows(message.channel):
+                self.board.touch()
+            else:
+                _start, _stop, _pages = _bounds
+                _suffix = f" ({page}/{_pages})" if _pages > 1 else ""
+                for _chunk in self.render_tracks(_now, start=_start, stop=_stop, header=f"Tracks{_suffix}:", tracks=_tracks):
+                    self.outbox.send(message.channel, _chunk)
             await self._ack(message)
+        else:
+            await self._error(message)
 
-    async def _on_lose(self, message, prey_name):
-        if prey_name in self.poach.preys:
-            await self._lose(prey_name)
+    async def _on_near(self, message, at, radius=NEAR_RADIUS):
+        _now = self.clock.now()
+        _near = []
+        for _distance_sq, _prey in self.poach.get_near_preys(at, radius):
+            _deadline = get_prey_deadline(_prey, _now)
+            _near.append((_distance_sq, _deadline is None, _deadline or _now, _prey))
+
+        if _near:
+            # closest first, then whichever shield drops first
+            _near.sort(key=lambda _n: _n[:3])
+            _lines = []
+            for _distance_sq, _unknown, _deadline, _prey in _near[:PAGE_SIZE]:
+                _remaining = "-" if _unknown else self._get_human_time(_deadline - _now, BOARD_RESOLUTION)
+                _lines.append(f"{_distance_sq ** 0.5:>5.1f} {_prey.coords[0]},{_prey.coords[1]} {_remaining} {_prey.prey_name}")
+            _suffix = f" ({PAGE_SIZE}/{len(_near)})" if len(_near) > PAGE_SIZE else ""
+            for _chunk in get_chunks(_lines, f"Near {at[0]},{at[1]}{_suffix}:"):
+                self.outbox.send(message.channel, _chunk)
             await self._ack(message)
         else:
             await self._error(message)
 
-    async def _on_tracks(self, message):
-        if self.poach.preys:
-            _now = timezone.now()
-            _expirations = []
-            for _prey in self.poach.preys.values():
-                if not _prey.four_notification and _prey.entered + TIMEDELTA_4 >= _now:
-                    _expires = _prey.entered + TIMEDELTA_4
-                elif not _prey.eight_notification and _prey.entered + TIMEDELTA_8 >= _now:
-                    _expires = _prey.entered + TIMEDELTA_8
-                elif not _prey.twelve_notification and _prey.entered + TIMEDELTA_12 >= _now:
-                    _expires = _prey.entered + TIMEDELTA_12
-                elif not _prey.twenty_four_notification and _prey.entered + TIMEDELTA_24 >= _now:
-                    _expires = _prey.entered + TIMEDELTA_24
-                else:
-                    continue
+    def _get_pending_events(self):
+        # events not written yet are merged in instead of forcing a flush
+        return [_event for _event in self.persistence.get_appended() if isinstance(_event, records.Event) and _event.guild_id == self.poach.guild_id]
+
+    async def _on_history(self, message, who=None):
+        _pending = self._get_pending_events()
+        if who is None:
+            _events = await self.persistence.storage.get_events(self.poach.guild_id, HISTORY_SIZE, user_id=message.author.id)
+            _pending = [_event for _event in _pending if _event.user_id == message.author.id]
+        else:
+            _events = await self.persistence.storage.get_events(self.poach.guild_id, HISTORY_SIZE, subject=who)
+            _pending = [_event for _event in _pending if _event.subject == who]
+        _events = (_pending[::-1] + _events)[:HISTORY_SIZE]
+
+        if _events:
+            _lines = []
+            for _event in _events:
+                _duration = get_human_time(timedelta(seconds=_event.duration)) if _event.duration else ""
+                _lines.append(f"{_event.created:%Y-%m-%d %H:%M} {_event.kind:<8} {_event.subject} {_duration}".rstrip())
+            for _chunk in get_chunks(_lines, f"History of {who or message.author.name}:"):
+                self.outbox.send(message.channel, _chunk)
+            await self._ack(message)
+        else:
+            await self._error(message)
 
-                # print(_prey, _prey.entered, _expires, _prey.four_notification, _prey.eight_notification, _prey.twelve_notification, _prey.twenty_four_notification)
-                _remaining = max(_expires - _now, TIMEDELTA_0)
-                _expirations.append((_remaining, _prey))
+    async def _on_summary(self, message, period='week'):
+        _since = (self.clock.now() - timedelta(days=SUMMARY_DAYS[period] - 1)).date()
+        _counts = defaultdict(lambda: [0, 0])
+        for _event in self._get_pending_events():
+            if _event.created.date() >= _since:
+                _counts[_event.kind][0] += 1
+                _counts[_event.kind][1] += _event.duration or 0
+        for _kind, _count, _duration in await self.persistence.storage.get_event_counts(self.poach.guild_id, _since):
+            _counts[_kind][0] += _count
+            _counts[_kind][1] += _duration
+
+        if _counts:
+            _lines = []
+            for _kind, (_count, _duration) in sorted(_counts.items()):
+                _average = f" avg {get_human_time(timedelta(seconds=_duration // _count))}" if _duration else ""
+                _lines.append(f"{_kind:<8} {_count:>6}{_average}")
+            for _chunk in get_chunks(_lines, f"Since {_since}:"):
+                self.outbox.send(message.channel, _chunk)
+            await self._ack(message)
+        else:
+            await self._error(message)
 
-            _formatted_message = io.StringIO()
-            _formatted_message.write(f"Tracks:```")
-            for _idx, (_remaining, _prey) in enumerate(sorted(_expirations, key=lambda _p: _p[0])):
-                if _idx:
-                    _formatted_message.write(f"\n")
+    async def _on_import(self, message, what):
+        from transfer import MAX_IMPORT_BYTES, ImportRowError, get_format, parse_import
+        _attachment = next((_a for _a in message.attachments if get_format(_a.filename)), None)
+        if _attachment is None or _attachment.size > MAX_IMPORT_BYTES:
+            await self._error(message)
+            return
 
-                _human_time = get_human_time(_remaining)
-                _formatted_message.write(f"{_human_time} {_prey.prey_name}")
+        _now = self.clock.now()
+        _data = await _attachment.read()
+        _args = (what, get_format(_attachment.filename), _data, _now, self.get_prey_durations(), message.author.id)
+        try:
+            # every row is validated before anything changes, a bad one rejects the file
+            _rows = await asyncio.get_event_loop().run_in_executor(None, parse_import, *_args)
+        except ImportRowError as e:
+            self.outbox.send(message.channel, f"`{e}`")
+            await self._error(message)
+            return
 
-            _formatted_message.write(f"```")
-            await message.channel.send(_formatted_message.getvalue())
+        _kind = PREY_KEY if what == 'tracks' else SHIELD_KEY
+        async with contextlib.AsyncExitStack() as _stack:
+            # every key of the batch is held until it is applied, taken in a fixed order so imports cannot deadlock
+            for _key in sorted(_row[0] for _row in _rows):
+                await _stack.enter_async_context(self.lock(_kind, _key))
+
+            if what == 'tracks':
+                _count = await self._import_tracks(_rows, _now)
+            else:
+                _count = await self._import_shields(_rows, _now)
+        await self.persistence.flush()
+        self.outbox.send(message.channel, f"{message.author.mention} imported {_count} {what}")
+        await self._ack(message)
+
+    async def _import_tracks(self, rows, now):
+        _preys = []
+        for _name, _coords, _marks, _entered, _user_id in rows:
+            _prey = records.Prey(
+                guild_id=self.poach.guild_id,
+                user_id=_user_id,
+                prey_name=_name,
+                coords=_coords,
+                entered=_entered or now,
+                marks=_marks,
+                notified=0,
+            )
+            # marks an exported track already went past are not announced again
+            _prey = _prey._replace(notified=_prey.thresholds.get_passed(_prey.entered, now))
+            if get_prey_deadline(_prey) is None:
+                continue
+
+            if _name in self.poach.preys:
+                await self._lose(_name)
+            self.persistence.save(_prey)
+            self.log_event(EVENT_TRACK, _user_id, _name)
+            _preys.append(_prey)
+
+        self.poach.add_preys(_preys)
+        for _prey in _preys:
+            self.scheduler.schedule((self.poach.guild_id, PREY_KEY, _prey.prey_name), get_prey_deadline(_prey))
+        return len(_preys)
+
+    async def _import_shields(self, rows, now):
+        _shields = []
+        for _user_id, _name, _display_name, _entered, _expires in rows:
+            if _expires <= now:
+                continue
+            _shield = records.Shield(
+                guild_id=self.poach.guild_id,
+                user_id=_user_id,
+                name=_name,
+                display_name=_display_name,
+                entered=_entered,
+                expires=_expires,
+                reminders=self.get_shield_reminders(_user_id),
+                notified=0,
+            )
+            _shield = _shield._replace(notified=_shield.thresholds.get_passed(_expires, now))
+
+            await self._unshield(_user_id)
+            await self._recall(_user_id)
+            self.persistence.save(_shield)
+            self.log_event(EVENT_SHIELD, _user_id, _name, int((_expires - _entered).total_seconds()))
+            _shields.append(_shield)
+
+        self.poach.add_shields(_shields)
+        for _shield in _shields:
+            self.scheduler.schedule((self.poach.guild_id, SHIELD_KEY, _shield.user_id), get_shield_deadline(_shield))
+        return len(_shields)
+
+    async def _on_export(self, message, what, format='csv'):
+        from transfer import export_rows
+        # the view is immutable, so the file is written on a worker thread
+        _version, _shields, _reins, _preys = self.poach.get_view()
+        _records = _preys if what == 'tracks' else _shields
+        _data = await asyncio.get_event_loop().run_in_executor(None, export_rows, what, format, _records)
+        _get_file = functools.partial(make_file, _data, f"{what}.{format}")
+        self.outbox.upload(message.channel, f"{message.author.mention} {len(_records)} {what}", _get_file)
+        await self._ack(message)
+
+    async def _on_reminders(self, message, action=None, leads=None):
+        _user_id = message.author.id
+        if action is None and leads is None:
+            _reminders = format_marks(_lead for _lead in self.get_shield_reminders(_user_id) if _lead) or "-"
+            self.outbox.send(message.channel, f"```Shield reminders: {_reminders}\nTrack marks: {format_marks(self.get_prey_durations())}```")
+            await self._ack(message)
+        elif action == 'reset':
+            if leads is not None:
+                await self._error(message)
+                return
+            _settings = self.poach.member_settings.pop(_user_id, None)
+            if _settings is not None:
+                self.persistence.delete(_settings)
             await self._ack(message)
         else:
+            _leads = get_shield_reminders(leads)
+            if not is_valid(_leads):
+                await self._error(message)
+                return
+            _settings = records.MemberSettings(self.poach.guild_id, _user_id, _leads)
+            self.poach.member_settings[_user_id] = _settings
+            self.persistence.save(_settings)
+            await self._ack(message)
+
+    async def _on_defaults(self, message, what, values=None):
+        # without values the guild goes back to the built-in defaults
+        if what == 'reminders':
+            _values = get_shield_reminders(values) if values else ()
+        else:
+            _values = get_prey_durations(values) if values else ()
+        if _values and (not is_valid(_values) or (what == 'durations' and not all(_values))):
             await self._error(message)
+            return
+
+        if what == 'reminders':
+            self.config.shield_reminders = format_seconds(_values)
+        else:
+            self.config.prey_durations = format_seconds(_values)
+        self.persistence.save(self.config)
+        await self._ack(message)
+
+    async def _on_bind(self, message, channel_type=None):
+        if channel_type in (None, 'shields'):
+            self.config.shields_channel_id = message.channel.id
+        if channel_type in (None, 'alerts'):
+            self.config.alerts_channel_id = message.channel.id
+        self.persistence.save(self.config)
+        await self._ack(message)
+
+    async def _on_board(self, message, state):
+        if state == 'on':
+            await self.board.create(message.channel)
+        else:
+            await self.board.remove()
+        self.persistence.save(self.config)
+        await self._ack(message)
+
+
+def require_owner(commands, message):
+    return commands._is_owner(message.author)
+
+
+COMMANDS = CommandRegistry()
+COMMANDS.register('$commands', '_on_commands', help="shows this message")
+COMMANDS.register('$status', '_on_status', help="shows bot status")
+COMMANDS.register('$hive', '_on_hive', "[<page:page>]", help="shows all shields/reins")
+COMMANDS.register('$shield', '_on_shield', "[<duration:time>]", aliases=['shield'], help="set a shield, or attach a screenshot of the timer", section="Shield")
+COMMANDS.register('$unshield', '_on_unshield', help="break a shield", section="Shield")
+COMMANDS.register('$reminders', '_on_reminders', "[<action:reset>] [<leads:time>...]", help="set how long before your shield expires you are reminded", section="Shield")
+COMMANDS.register('$notify', '_on_notify', help="notifies all expired shields", section="Shield")
+COMMANDS.register('$rein', '_on_rein', help="reinforce", section="Reinforcement")
+COMMANDS.register('$recall', '_on_recall', help="recall a reinforcement", section="Reinforcement")
+COMMANDS.register('$history', '_on_history', "[<who:member>]", help="shows recent shields, reins and tracks")
+COMMANDS.register('$export', '_on_export', "<what:tracks|shields> [<format:csv|jsonl>]", help="sends the current tracks or shields as a file")
+COMMANDS.register('$summary', '_on_summary', "[<period:day|week|month>]", help="shows activity counts for a period")
+COMMANDS.register('$metrics', '_on_metrics', permission=require_owner, help="shows latency, lag and queue metrics", section="Moderator")
+COMMANDS.register('$prune', '_on_prune', permission=require_owner, help="remove expired shields", section="Moderator")
+COMMANDS.register('$bind', '_on_bind', "[<channel_type:shields|alerts>]", permission=require_owner, help="use this channel for commands/alerts", section="Moderator")
+COMMANDS.register('$defaults', '_on_defaults', "<what:reminders|durations> [<values:time>...]", permission=require_owner, help="set the guild's shield reminders or track marks", section="Moderator")
+COMMANDS.register('$import', '_on_import', "<what:tracks|shields>", permission=require_owner, help="loads tracks or shields from an attached CSV or JSONL file", section="Moderator")
+COMMANDS.register('$board', '_on_board', "<state:on|off>", permission=require_owner, help="keep a live board in this channel", section="Moderator")
+COMMANDS.register('$tracks', '_on_tracks', "[<page:page>]", help="shows all tracks", section="Track")
+COMMANDS.register('$track', '_on_track', "<who:member> [<coords:coords>] [<shields:int>...]", help="tracks a given set of shields, or attach a screenshot of the timer", section="Track")
+COMMANDS.register('$near', '_on_near', "<at:coords> [<radius:radius>]", help="shows tracks around a location", section="Track")
+COMMANDS.register('$lose', '_on_lose', "<who:member>", help="stop tracking", section="Track")
+
+
+class TazdingoBoard(object):
+    def __init__(self, client, config, wakeup):
+        super(TazdingoBoard, self).__init__()
+        self.client = client
+        self.config = config
+        self.commands = None
+        self.dirty = False
+        self.edits = 0
+        self._wakeup = wakeup
+        self._message = None
+        self._render_key = None
+        self._rendered = None
+        self._sent = None
+
+    @property
+    def enabled(self):
+        return self.config.board_message_id is not None
+
+    def touch(self):
+        if self.enabled:
+            self.dirty = True
+            self._wakeup.set()
+
+    def shows(self, channel):
+        # the board lives in one channel, commands anywhere else are answered inline
+        return self.enabled and self.config.board_channel_id == channel.id
+
+    def render(self, now):
+        # countdowns are rounded to BOARD_RESOLUTION, so the text only changes
+        # when the poach does or when a countdown bucket rolls over
+        _render_key = (self.commands.poach.version, int(now.timestamp()) // BOARD_RESOLUTION)
+        if _render_key != self._render_key:
+            # each section gets an equal share of the message, only its first chunk is shown
+            _limit = MESSAGE_LIMIT // 3 - 1
+            _sections = []
+            if self.commands.poach.shields:
+                _sections.append(next(self.commands.render_shields(now, BOARD_RESOLUTION, limit=_limit)))
+            if self.commands.poach.reins:
+                _sections.append(next(self.commands.render_reins(limit=_limit)))
+            if self.commands.poach.preys:
+                _sections.append(next(self.commands.render_tracks(now, BOARD_RESOLUTION, limit=_limit)))
+            self._rendered = "\n".join(_sections) or "The hive is empty."
+            self._render_key = _render_key
+        return self._rendered
+
+    async def create(self, channel):
+        await self.remove()
+        self._sent = self.render(self.commands.clock.now())
+        self._message = await channel.send(self._sent)
+        await self._message.pin()
+        self.config.board_channel_id = channel.id
+        self.config.board_message_id = self._message.id
+        self.edits += 1
+
+    async def remove(self):
+        if self.enabled:
+            try:
+                _message = await self._fetch()
+                await _message.unpin()
+            except discord.HTTPException:
+                pass
+        self.config.board_channel_id = None
+        self.config.board_message_id = None
+        self._message = None
+        self._sent = None
+
+    async def _fetch(self):
+        if self._message is None:
+            _channel = self.client.get_channel(self.config.board_channel_id)
+            self._message = await _channel.fetch_message(self.config.board_message_id)
+        return self._message
+
+    async def refresh(self):
+        self.dirty = False
+        if not self.enabled:
+            return
+
+        _rendered = self.render(self.commands.clock.now())
+        if _rendered == self._sent:
+            return
+
+        try:
+            _message = await self._fetch()
+            await _message.edit(content=_rendered)
+        except discord.NotFound:
+            # the board message is gone, fall back to plain messages
+            self._message = None
+            self.config.board_channel_id = None
+            self.config.board_message_id = None
+            self.commands.persistence.save(self.config)
+            return
+        self._sent = _rendered
+        self.edits += 1
+
+
+class TazdingoPartition(object):
+    def __init__(self, client, config):
+        super(TazdingoPartition, self).__init__()
+        self.config = config
+        self.poach = TazdingoPoach(config.guild_id)
+        self.board = TazdingoBoard(client, config, client.boards_wakeup)
+        self.commands = TazdingoCommands(self.poach, client.scheduler, client.persistence, config, self.board, client.outbox, client.clock, client.vision, client.metrics)
+        self.board.commands = self.commands
+        self.poach.listeners.append(self.board.touch)
+        if client.api is not None:
+            self.poach.listeners.append(functools.partial(client.touch_snapshot, config.guild_id))
+
+    @property
+    def guild_id(self):
+        return self.config.guild_id
 
 
 class TazdingoClient(discord.Client):
-    def __init__(self):
-        super(TazdingoClient, self).__init__()
-        self.poach = TazdingoPoach()
-        self.commands = TazdingoCommands(self.poach)
+    def __init__(self, clock=None, role=None):
+        _role = role or getattr(settings, 'ROLE', 'all')
+        _shards = {}
+        if getattr(settings, 'SHARD_COUNT', None) and _role == 'commands':
+            # several command processes split the guilds between them, the notifier sees them all
+            _shards = {'shard_id': settings.SHARD_ID, 'shard_count': settings.SHARD_COUNT}
+        super(TazdingoClient, self).__init__(**_shards)
+        self.role = _role
+        self.origin = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.leader = False
+        self.lease_deadline = 0.0
+        self.leading = asyncio.Event()
+        self.lease_task = None
+        self.changes_task = None
+        self.changes_cursor = 0
+        self.partitions = {}
+        self.clock = clock or TazdingoClock()
+        self.scheduler = TazdingoScheduler(self.clock)
+        self.metrics = TazdingoMetrics()
+        self.metrics_server = None
+        self.snapshots = None
+        self.api = None
+        self.api_task = None
+        self.api_dirty = set()
+        self.api_wakeup = asyncio.Event()
+        if getattr(settings, 'API_PORT', None) is not None:
+            # the API and its HTTP server are only loaded when enabled
+            from api import API_HOST, SnapshotStore, TazdingoApi
+            self.snapshots = SnapshotStore()
+            self.api = TazdingoApi(self.snapshots, settings.API_PORT, getattr(settings, 'API_HOST', API_HOST))
+        self.storage = TazdingoStorage(metrics=self.metrics, origin=self.origin if getattr(settings, 'SYNC_CHANGES', False) else None, guild_id=getattr(settings, 'GUILD_ID', None))
+        self.persistence = TazdingoPersistence(self.storage, metrics=self.metrics)
+        self.outbox = TazdingoOutbox()
+        self.vision = TazdingoVision(getattr(settings, 'VISION_WORKERS', VISION_WORKERS))
+        self.boards_wakeup = asyncio.Event()
+        self.load_time = 0.0
+        self.ready_time = None
+        self.purged = 0
+        self.catch_ups = 0
+        self.last_command = None
+        self.analyzed = None
+        self.maintenances = 0
+        self.online = asyncio.Event()
         self.background_task = self.loop.create_task(self.notify_shield_state())
+        self.persistence_task = self.loop.create_task(self.persistence.run())
+        self.boards_task = self.loop.create_task(self.refresh_boards())
+        self.maintenance_task = self.loop.create_task(self.maintain_database())
+
+    def get_partition(self, guild_id):
+        _partition = self.partitions.get(guild_id)
+        if _partition is None:
+            _partition = TazdingoPartition(self, models.Guild(guild_id=guild_id))
+            self.partitions[guild_id] = _partition
+        return _partition
 
     def initialize(self):
-        self.poach.load_from_db()
-    
+        _start = time.perf_counter()
+        self.storage.open()
+        if self.storage.origin is not None:
+            # changes committed while the state loads are reapplied afterwards
+            self.changes_cursor = self.loop.run_until_complete(self.storage.get_last_change())
+        self.loop.run_until_complete(self.load_state())
+        self.load_time = time.perf_counter() - _start
+
+        if self.role in ('all', 'notifier'):
+            self.loop.run_until_complete(self.renew_lease())
+            self.lease_task = self.loop.create_task(self.hold_lease())
+        if self.storage.origin is not None:
+            self.changes_task = self.loop.create_task(self.follow_changes())
+
+        self.metrics.register('outbox_depth', lambda: self.outbox.depth)
+        self.metrics.register('outbox_sent_total', lambda: self.outbox.sent)
+        self.metrics.register('outbox_throttled_total', lambda: self.outbox.throttled)
+        self.metrics.register('outbox_merged_total', lambda: self.outbox.merged)
+        self.metrics.register('persistence_pending', lambda: len(self.persistence))
+        self.metrics.register('scheduler_entries', lambda: len(self.scheduler))
+        self.metrics.register('leader', lambda: int(self.is_leading()))
+        self.metrics.set('load_seconds', self.load_time)
+
+        _port = getattr(settings, 'METRICS_PORT', None)
+        if _port is not None:
+            from metrics import MetricsServer
+            self.metrics_server = MetricsServer(self.metrics, _port)
+            self.loop.run_until_complete(self.metrics_server.start())
+
+        if self.api is not None:
+            self.api.start()
+            for _guild_id in self.partitions:
+                self.touch_snapshot(_guild_id)
+            self.api_task = self.loop.create_task(self.publish_snapshots())
+
+    async def load_state(self):
+        async for _config in self.storage.load(models.Guild):
+            self.partitions[_config.guild_id] = TazdingoPartition(self, _config)
+
+        _guild_id = getattr(settings, 'GUILD_ID', 0)
+        if _guild_id and _guild_id not in self.partitions:
+            _partition = self.get_partition(_guild_id)
+            _partition.config.shields_channel_id = settings.SHIELDS_CHANNEL_ID
+            _partition.config.alerts_channel_id = settings.ALERTS_CHANNEL_ID
+            self.persistence.save(_partition.config)
+
+        async for _shield in self.storage.load(models.Shield):
+            _shield = records.Shield.from_model(_shield)
+            self.get_partition(_shield.guild_id).poach.add_shield(_shield)
+            self.scheduler.schedule((_shield.guild_id, SHIELD_KEY, _shield.user_id), get_shield_deadline(_shield))
+
+        async for _rein in self.storage.load(models.Reinforcement):
+            _rein = records.Reinforcement.from_model(_rein)
+            self.get_partition(_rein.guild_id).poach.add_rein(_rein)
+
+        async for _estimate in self.storage.load(models.PreyEstimate):
+            _estimate = records.PreyEstimate.from_model(_estimate)
+            self.get_partition(_estimate.guild_id).poach.estimates[_estimate.prey_name] = _estimate
+
+        async for _settings in self.storage.load(models.MemberSettings):
+            _settings = records.MemberSettings.from_model(_settings)
+            self.get_partition(_settings.guild_id).poach.member_settings[_settings.user_id] = _settings
+
+        async for _prey in self.storage.load(models.Prey):
+            _prey = records.Prey.from_model(_prey)
+            _deadline = get_prey_deadline(_prey)
+            if _deadline is None:
+                # every shield of this prey was already announced
+                self.persistence.delete(_prey)
+                self.purged += 1
+                continue
+            self.get_partition(_prey.guild_id).poach.add_prey(_prey)
+            self.scheduler.schedule((_prey.guild_id, PREY_KEY, _prey.prey_name), _deadline)
+
+    async def close(self):
+        await self.persistence.flush()
+        try:
+            await asyncio.wait_for(self.outbox.join(), OUTBOX_SHUTDOWN_DELAY)
+        except asyncio.TimeoutError:
+            pass
+        self.vision.shutdown()
+        for _task in (self.maintenance_task, self.lease_task, self.changes_task):
+            if _task is not None:
+                _task.cancel()
+        if self.leader:
+            # hand the alerts over right away instead of waiting for the lease to run out
+            self.leader = False
+            self.leading.clear()
+            await self.storage.release_lease(NOTIFIER_LEASE, self.origin)
+        if self.api is not None:
+            self.api.close()
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        await self.storage.close()
+        await super(TazdingoClient, self).close()
+
     async def on_ready(self):
         print(f'We have logged in as {self.user}')
+        self.online.set()
+        if self.ready_time is None:
+            self.ready_time = time.perf_counter() - STARTED
+            _shields = sum(len(_partition.poach.shields) for _partition in self.partitions.values())
+            _preys = sum(len(_partition.poach.preys) for _partition in self.partitions.values())
+            print(f'Ready in {self.ready_time:.2f}s (state loaded in {self.load_time:.2f}s: {_shields} shields, {_preys} preys, {self.purged} purged)')
+
+    async def on_disconnect(self):
+        # alerts pile up while the gateway is away and go out as a digest once it is back
+        self.online.clear()
+
+    async def on_resumed(self):
+        self.online.set()
 
     async def on_message(self, message):
-        if message.channel.id != settings.SHIELDS_CHANNEL_ID:
+        if message.guild is None or self.role == 'notifier':
             return
 
         if message.author == self.user:
             return
 
-        await self.commands.on_message(message)
+        self.last_command = self.clock.now()
+        _partition = self.partitions.get(message.guild.id)
+        if _partition is None or message.channel.id != _partition.config.shields_channel_id:
+            # unbound channels only listen to $bind
+            if not message.content.strip().lower().startswith('$bind'):
+                return
+            _partition = self.get_partition(message.guild.id)
+
+        await _partition.commands.on_message(message)
 
     async def notify_shield_state(self):
         await self.wait_until_ready()
-        _channel = self.get_channel(settings.ALERTS_CHANNEL_ID)
         while not self.is_closed():
-            _now = timezone.now()
-            _expired_mentions = []
-            _expiring_mentions = []
-
-            for _shield in self.poach.shields.values():
-                _remaining = _shield.expires - _now
-                if not _shield.expired_notification and _remaining < TIMEDELTA_0:
-                    _shield.expired_notification = True
-                    _shield.expiring_notification = True
-                    await sync_to_async(_shield.save, thread_sensitive=True)()
-                    _expired_mentions.append(f"<@!{_shield.user_id}>")
-                elif not _shield.expiring_notification and _remaining < TIMEDELTA_1:
-                    _shield.expiring_notification = True
-                    await sync_to_async(_shield.save, thread_sensitive=True)()
-                    _expiring_mentions.append(f"<@!{_shield.user_id}>")
-
-            if _expired_mentions:
-                _mentions = " ".join(_expired_mentions)
-                await _channel.send(f"{_mentions} Hey! Your shield has expired!")
-
-            if _expiring_mentions:
-                _mentions = " ".join(_expiring_mentions)
-                await _channel.send(f"{_mentions} Hey! Your shield has almost expired!")
-
-            _prey_mentions = []
-            _expired_preys = []
-            for _prey in self.poach.preys.values():
-                _save = False
-                _elapsed = _now - _prey.entered
-                # print(_prey.prey_name, _elapsed, _prey.four_notification, _prey.eight_notification, _prey.twelve_notification, _prey.twenty_four_notification)
-                if not _prey.twenty_four_notification and _elapsed >= TIMEDELTA_24:
-                    _prey.four_notification = True
-                    _prey.eight_notification = True
-                    _prey.twelve_notification = True
-                    _prey.twenty_four_notification = True
-                    _what = "24"
-                    _save = True
-                elif not _prey.twelve_notification and _elapsed >= TIMEDELTA_12:
-                    _prey.four_notification = True
-                    _prey.eight_notification = True
-                    _prey.twelve_notification = True
-                    _what = "12"
-                    _save = True
-                elif not _prey.eight_notification and _elapsed >= TIMEDELTA_8:
-                    _prey.four_notification = True
-                    _prey.eight_notification = True
-                    _what = "8"
-                    _save = True
-                elif not _prey.four_notification and _elapsed >= TIMEDELTA_4:
-                    _prey.four_notification = True
-                    _what = "4"
-                    _save = True
-
-                if _save:
-                    if _prey.four_notification and _prey.eight_notification and _prey.twelve_notification and _prey.twenty_four_notification:
+            await self.online.wait()
+            await self.leading.wait()
+            if not self.is_leading():
+                # the lease ran out before it could be renewed
+                self.leading.clear()
+                continue
+            _now = self.clock.now()
+
+            # only partitions with a due deadline are visited
+            _due = defaultdict(list)
+            for _guild_id, _kind, _key in self.scheduler.pop_due(_now):
+                _due[_guild_id].append((_kind, _key))
+
+            _catch_up = self.scheduler.lag >= CATCH_UP_LAG
+            if _due:
+                _start = time.perf_counter()
+                for _guild_id, _keys in _due.items():
+                    await self.notify_partition(self.partitions[_guild_id], _keys, _now, _catch_up)
+                self.metrics.observe('alerts_lag_seconds', self.scheduler.lag, buckets=LAG_BUCKETS)
+                self.metrics.observe('alerts_tick_seconds', time.perf_counter() - _start)
+                self.metrics.inc('alerts_due_total', sum(len(_keys) for _keys in _due.values()))
+
+            if _catch_up:
+                # every flag changed while catching up is written in a single transaction
+                self.catch_ups += 1
+                await self.persistence.flush()
+
+            # sleep until the earliest deadline, waking up early when a command reschedules
+            await self.scheduler.wait(self.clock.now(), max_delay=ALERTS_DELAY)
+
+    async def refresh_boards(self):
+        await self.wait_until_ready()
+        _bucket = None
+        while not self.is_closed():
+            # boards are edited by the same process that sends the alerts
+            await self.leading.wait()
+            _timeout = BOARD_RESOLUTION - self.clock.now().timestamp() % BOARD_RESOLUTION
+            if await self.clock.wait(self.boards_wakeup, _timeout):
+                # coalesce bursts of changes into a single edit
+                await self.clock.sleep(BOARD_DELAY)
+            self.boards_wakeup.clear()
+
+            _current_bucket = int(self.clock.now().timestamp()) // BOARD_RESOLUTION
+            _rollover = _current_bucket != _bucket
+            _bucket = _current_bucket
+
+            for _partition in list(self.partitions.values()):
+                if _partition.board.enabled and (_rollover or _partition.board.dirty):
+                    try:
+                        await _partition.board.refresh()
+                    except discord.HTTPException:
+                        traceback.print_exc()
+
+    async def maintain_database(self):
+        await self.wait_until_ready()
+        while not self.is_closed():
+            await self.clock.sleep(MAINTENANCE_DELAY)
+            # the shared database is maintained by the process sending the alerts
+            await self.leading.wait()
+            _now = self.clock.now()
+            if self.last_command is not None and _now - self.last_command < timedelta(seconds=QUIET_DELAY):
+                continue
+            try:
+                await self.maintain(_now)
+            except Exception:
+                traceback.print_exc()
+
+    async def maintain(self, now):
+        _start = time.perf_counter()
+        _purged = 0
+        for _partition in list(self.partitions.values()):
+            _purged += await self.purge_partition(_partition, now)
+        await self.persistence.flush()
+
+        _retention_days = getattr(settings, 'EVENT_RETENTION_DAYS', EVENT_RETENTION_DAYS)
+        if _retention_days:
+            _before = now - timedelta(days=_retention_days)
+            while True:
+                _deleted = await self.storage.prune_events(_before)
+                _purged += _deleted
+                if _deleted < RETENTION_BATCH_SIZE:
+                    break
+
+        if self.analyzed is None or now - self.analyzed >= ANALYZE_INTERVAL:
+            await self.storage.analyze()
+            self.analyzed = now
+        _pages, _free = await self.storage.get_pages()
+        if _pages and _free / _pages >= VACUUM_FREE_RATIO:
+            await self.storage.vacuum()
+            self.metrics.inc('db_vacuums_total')
+        await self.storage.checkpoint()
+
+        self.maintenances += 1
+        self.metrics.inc('db_purged_rows_total', _purged)
+        self.metrics.observe('db_maintenance_seconds', time.perf_counter() - _start)
+        return _purged
+
+    async def purge_partition(self, partition, now):
+        # rows long past their last alert, their history stays in the event log
+        _poach = partition.poach
+        _commands = partition.commands
+        _shields_before = now - SHIELD_RETENTION
+        _preys_before = now - PREY_RETENTION
+        _purged = 0
+
+        for _shield in _poach.get_expired_shields(_shields_before):
+            async with _commands.lock(SHIELD_KEY, _shield.user_id):
+                _shield = _poach.shields.get(_shield.user_id)
+                if _shield is None or _shield.expires >= _shields_before:
+                    continue
+                _poach.pop_shield(_shield.user_id)
+                self.scheduler.cancel((partition.guild_id, SHIELD_KEY, _shield.user_id))
+                self.persistence.delete(_shield)
+                _purged += 1
+            if len(self.persistence) >= RETENTION_BATCH_SIZE:
+                await self.persistence.flush()
+
+        for _prey in _poach.get_stale_preys(_preys_before):
+            async with _commands.lock(PREY_KEY, _prey.prey_name):
+                _prey = _poach.preys.get(_prey.prey_name)
+                _deadline = get_prey_deadline(_prey) if _prey is not None else None
+                if _deadline is None or _deadline >= _preys_before:
+                    continue
+                _poach.pop_prey(_prey.prey_name)
+                self.scheduler.cancel((partition.guild_id, PREY_KEY, _prey.prey_name))
+                self.persistence.delete(_prey)
+                _purged += 1
+            if len(self.persistence) >= RETENTION_BATCH_SIZE:
+                await self.persistence.flush()
+        return _purged
+
+    def is_leading(self):
+        return self.leader and time.monotonic() < self.lease_deadline
+
+    async def renew_lease(self):
+        # the local deadline starts before the call, so it always ends before the one the others see
+        _start = time.monotonic()
+        try:
+            _leader, _expires = await self.storage.acquire_lease(NOTIFIER_LEASE, self.origin, LEASE_TTL)
+        except Exception:
+            traceback.print_exc()
+            _leader = False
+
+        if _leader != self.leader:
+            print(f"{self.origin} {'took over' if _leader else 'lost'} the alerts")
+            self.leader = _leader
+        if _leader:
+            self.lease_deadline = _start + LEASE_TTL
+            self.leading.set()
+        else:
+            self.leading.clear()
+
+    async def hold_lease(self):
+        # the lease lives on wall time, whatever clock the alerts run on
+        while not self.is_closed():
+            await asyncio.sleep(LEASE_RENEW)
+            await self.renew_lease()
+
+    async def follow_changes(self):
+        _pruned = time.monotonic()
+        while not self.is_closed():
+            await asyncio.sleep(CHANGES_DELAY)
+            try:
+                await self.apply_changes()
+                if self.leader and time.monotonic() - _pruned > CHANGES_RETENTION / 10:
+                    await self.storage.prune_changes(time.time() - CHANGES_RETENTION)
+                    _pruned = time.monotonic()
+            except Exception:
+                traceback.print_exc()
+
+    async def apply_changes(self):
+        # rows written by the other processes are reloaded, each key once per batch
+        while True:
+            _changes = await self.storage.get_changes(self.changes_cursor)
+            if not _changes:
+                return
+
+            self.changes_cursor = _changes[-1][0]
+            _keys = defaultdict(dict)
+            for _id, _origin, _name, _key in _changes:
+                if _origin != self.origin:
+                    _keys[_name][_key] = None
+
+            for _name, _names_keys in _keys.items():
+                for _key, _obj in await self.storage.get_rows(_name, list(_names_keys)):
+                    self.apply_change(_name, json.loads(_key), _obj)
+                    self.metrics.inc('changes_applied_total', model=_name)
+
+    def apply_change(self, name, key, obj):
+        # every shared model is keyed by guild first, obj is None when the row was deleted
+        _guild_id = key[0]
+        _partition = self.get_partition(_guild_id)
+        _poach = _partition.poach
+        if name == 'Guild':
+            if obj is not None:
+                for _field in obj._meta.concrete_fields:
+                    setattr(_partition.config, _field.attname, getattr(obj, _field.attname))
+        elif name == 'Shield':
+            if obj is None:
+                _poach.pop_shield(key[1])
+                self.scheduler.cancel((_guild_id, SHIELD_KEY, key[1]))
+            else:
+                _shield = records.Shield.from_model(obj)
+                _poach.add_shield(_shield)
+                self.scheduler.schedule((_guild_id, SHIELD_KEY, _shield.user_id), get_shield_deadline(_shield))
+        elif name == 'Reinforcement':
+            if obj is None:
+                _poach.pop_rein(key[1])
+            else:
+                _poach.add_rein(records.Reinforcement.from_model(obj))
+        elif name == 'Prey':
+            if obj is None:
+                _poach.pop_prey(key[1])
+                self.scheduler.cancel((_guild_id, PREY_KEY, key[1]))
+            else:
+                _prey = records.Prey.from_model(obj)
+                _poach.add_prey(_prey)
+                self.scheduler.schedule((_guild_id, PREY_KEY, _prey.prey_name), get_prey_deadline(_prey))
+        elif name == 'PreyEstimate':
+            if obj is None:
+                _poach.estimates.pop(key[1], None)
+            else:
+                _poach.estimates[key[1]] = records.PreyEstimate.from_model(obj)
+        elif name == 'MemberSettings':
+            if obj is None:
+                _poach.member_settings.pop(key[1], None)
+            else:
+                _poach.member_settings[key[1]] = records.MemberSettings.from_model(obj)
+
+    def touch_snapshot(self, guild_id):
+        self.api_dirty.add(guild_id)
+        self.api_wakeup.set()
+
+    async def publish_snapshots(self):
+        # API clients only ever read the published snapshots, never the live state
+        from api import API_DELAY, build_snapshot
+        while not self.is_closed():
+            await self.clock.wait(self.api_wakeup)
+            await self.clock.sleep(API_DELAY)
+            self.api_wakeup.clear()
+
+            _dirty, self.api_dirty = self.api_dirty, set()
+            for _guild_id in _dirty:
+                # the records are immutable, the poach's view can be handed to a thread as is
+                _args = (_guild_id,) + self.partitions[_guild_id].poach.get_view() + (self.clock.now(), self.snapshots.nonce)
+                try:
+                    self.snapshots.publish(await self.loop.run_in_executor(None, build_snapshot, *_args))
+                except Exception:
+                    traceback.print_exc()
+
+    async def notify_partition(self, partition, keys, now, catch_up=False):
+        _guild_id = partition.guild_id
+        _poach = partition.poach
+        _shield_alerts = []
+        _prey_mentions = []
+        _expired_preys = []
+
+        _channel = self.get_channel(partition.config.alerts_channel_id)
+        if _channel is None:
+            # nothing is marked as sent, the alerts are tried again once the channel shows up
+            print(f"No alerts channel for guild {_guild_id}, {len(keys)} alerts held back")
+            for _kind, _key in keys:
+                self.scheduler.schedule((_guild_id, _kind, _key), now + timedelta(seconds=ALERTS_DELAY))
+            return
+
+        for _kind, _key in keys:
+            if _kind == SHIELD_KEY:
+                _shield = _poach.shields.get(_key)
+                if _shield is None:
+                    continue
+
+                _thresholds = _shield.thresholds
+                _idx = _thresholds.get_due(_shield.expires, _shield.notified, now)
+                if _idx is not None:
+                    _shield = _shield._replace(notified=_thresholds.fire(_shield.notified, _idx))
+                    _poach.add_shield(_shield)
+                    self.persistence.save(_shield)
+                    _shield_alerts.append((_shield, _shield.reminders[_idx]))
+
+                self.scheduler.schedule((_guild_id, SHIELD_KEY, _key), get_shield_deadline(_shield))
+
+            elif _kind == PREY_KEY:
+                _prey = _poach.preys.get(_key)
+                if _prey is None:
+                    continue
+
+                # the latest passed mark also covers the earlier ones
+                _idx = _prey.thresholds.get_due(_prey.entered, _prey.notified, now)
+                if _idx is not None:
+                    _prey = _prey.notify(_idx)
+                    _what = _prey.marks[_idx]
+                    if _prey.fully_notified:
                         _expired_preys.append(_prey)
                     _prey_mentions.append((_prey, _what))
-                    await sync_to_async(_prey.save, thread_sensitive=True)()
+                    self.persistence.save(_prey)
+                    partition.commands.log_event(EVENT_MARK, _prey.user_id, _prey.prey_name, _what)
+                    _poach.update_prey(_prey)
+
+                self.scheduler.schedule((_guild_id, PREY_KEY, _key), get_prey_deadline(_prey))
+
+        for _prey in _expired_preys:
+            _poach.pop_prey(_prey.prey_name)
+            self.scheduler.cancel((_guild_id, PREY_KEY, _prey.prey_name))
+            self.persistence.delete(_prey)
+
+        _likely_mentions = []
+        for _prey, _what in _prey_mentions:
+            _estimate = _poach.get_estimate(_prey.prey_name)
+            _share = _estimate.get_share(_what) if _estimate is not None else None
+            _likely_mentions.append((_prey, _what, _share))
+
+        # the marks most likely to be the real shield go out first
+        _likely_mentions.sort(key=lambda _m: -(_m[2] or 0))
+
+        if catch_up:
+            self.send_digest(_channel, _shield_alerts, _likely_mentions, now)
+            return
+
+        # expiry alerts first, then the reminders closest to it
+        _shield_alerts.sort(key=lambda _a: _a[1])
+        for _shield, _lead in _shield_alerts:
+            _text = SHIELD_EXPIRING_TEXT.format(get_human_time(timedelta(seconds=_lead))) if _lead else SHIELD_EXPIRED_TEXT
+            self.outbox.alert(_channel, f"<@!{_shield.user_id}>", _text)
+
+        for _prey, _what, _share in _likely_mentions:
+            _suffix = f" ({_share:.0%} likely)" if _share is not None else ""
+            self.outbox.send(_channel, f"<@!{_prey.user_id}> {_prey.prey_name}'s {format_marks([_what])} shield may have expired!{_suffix}", merge=True)
+
+    def send_digest(self, channel, shield_alerts, prey_alerts, now):
+        # one merged mention message and the missed alerts as a summary, however many there were
+        _lines = []
+        for _shield, _lead in shield_alerts:
+            self.outbox.alert(channel, f"<@!{_shield.user_id}>", CATCH_UP_TEXT)
+            _remaining = _shield.expires - now
+            if _remaining > timedelta(0):
+                _lines.append(f"{_shield.display_name}'s shield expires in {get_human_time(_remaining)}")
+            else:
+                _lines.append(f"{_shield.display_name}'s shield expired {get_human_time(-_remaining) or '0s'} ago")
+
+        for _prey, _what, _share in prey_alerts:
+            self.outbox.alert(channel, f"<@!{_prey.user_id}>", CATCH_UP_TEXT)
+            _ago = get_human_time(now - _prey.entered - timedelta(seconds=_what)) or '0s'
+            _suffix = f" ({_share:.0%} likely)" if _share is not None else ""
+            _lines.append(f"{_prey.prey_name}'s {format_marks([_what])} shield may have expired {_ago} ago{_suffix}")
+
+        if _lines:
+            for _chunk in get_chunks(_lines, "Missed while offline:"):
+                self.outbox.send(channel, _chunk)
 
-            for _prey, _what in _prey_mentions:
-                await _channel.send(f"<@!{_prey.user_id}> {_prey.prey_name}'s {_what} hour shield may have expired!")
 
-            for _prey in _expired_preys:
-                self.poach.preys.pop(_prey.prey_name, None)
-                await sync_to_async(_prey.delete, thread_sensitive=True)()
+def main():
+    _parser = argparse.ArgumentParser(description="Taz'dingo Discord bot.")
+    _parser.add_argument('--role', choices=ROLES, help="run only the command handlers or only the alert notifier, SYNC_CHANGES must be set")
+    _args, _ = _parser.parse_known_args()
 
-            await asyncio.sleep(ALERTS_DELAY)
+    client = TazdingoClient(role=_args.role)
+    client.initialize()
+    client.run(settings.TAZDINGO_TOKEN)
 
 
-client = TazdingoClient()
-client.initialize()
-client.run(settings.TAZDINGO_TOKEN)
+if __name__ == "__main__":
+    main()
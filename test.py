@@ -1,8 +1,23 @@
+import asyncio
+import importlib.util
+import json
+import os
 import re
+import sqlite3
+import tempfile
 import unittest
+import unittest.mock
+from datetime import datetime, timedelta, timezone
 
 
+from clock import VirtualClock
+from dispatch import ArgumentError, CommandRegistry, PermissionDeniedError, UnknownCommandError
+from metrics import Histogram, MetricsServer, TazdingoMetrics
+from outbox import TazdingoOutbox, TokenBucket
+from reminders import get_observed, get_shield_reminders, get_shield_thresholds, get_thresholds, parse_seconds
+from scheduler import TazdingoScheduler
 from utils import *
+from vision import TazdingoVision, get_timer_seconds
 
 
 class TestTimeRegex(unittest.TestCase):
@@ -100,5 +115,1269 @@ class TestParseTime(unittest.TestCase):
             self.assertIsNone(actual_second)
 
 
+class TestChunks(unittest.TestCase):
+
+    def test_single_chunk(self):
+        self.assertEqual(list(get_chunks(["a", "b"], "Tracks:")), ["Tracks:```a\nb```"])
+        self.assertEqual(list(get_chunks([], "Tracks:")), ["Tracks:``````"])
+
+    def test_split_on_lines(self):
+        lines = [str(i) * 10 for i in range(10)]
+        chunks = list(get_chunks(lines, "Head:", limit=40))
+        self.assertTrue(all(len(chunk) <= 40 for chunk in chunks))
+        self.assertTrue(chunks[0].startswith("Head:```"))
+        self.assertTrue(all(chunk.startswith("```") and chunk.endswith("```") for chunk in chunks[1:]))
+        self.assertEqual("\n".join(chunk.replace("Head:", "").strip("`") for chunk in chunks), "\n".join(lines))
+
+    def test_page_bounds(self):
+        self.assertEqual(get_page_bounds(1, 0, 10), (0, 10, 1))
+        self.assertEqual(get_page_bounds(2, 25, 10), (10, 20, 3))
+        self.assertIsNone(get_page_bounds(4, 25, 10))
+        self.assertIsNone(get_page_bounds(0, 25, 10))
+
+
+class TestSortedIndex(unittest.TestCase):
+
+    def test_ordering_and_updates(self):
+        index = SortedIndex()
+        index.add('b', 2)
+        index.add('a', 3)
+        index.add('c', 1)
+        self.assertEqual(index.keys(), ['c', 'b', 'a'])
+        index.add('a', 0)
+        index.remove('b')
+        self.assertEqual(index.keys(), ['a', 'c'])
+        self.assertNotIn('b', index)
+        index.add('c', None)
+        self.assertEqual(list(index), [(0, 'a')])
+
+    def test_before(self):
+        index = SortedIndex()
+        for key, sort_key in [('a', 1), ('b', 2), ('c', 2), ('d', 3)]:
+            index.add(key, sort_key)
+        self.assertEqual(index.before(2), ['a'])
+        self.assertEqual(index.before(3), ['a', 'b', 'c'])
+        self.assertEqual(index.before(0), [])
+
+
+class TestGridIndex(unittest.TestCase):
+
+    def test_parse_coords(self):
+        self.assertEqual(parse_coords("12,345"), (12, 345))
+        self.assertIsNone(parse_coords("12,x"))
+        self.assertEqual(format_coords((12, 345)), "12,345")
+
+    def test_near(self):
+        index = GridIndex(cell_size=10)
+        index.add('a', (0, 0))
+        index.add('b', (3, 4))
+        index.add('c', (100, 100))
+        index.add('d', (-8, 0))
+        self.assertEqual(index.near((0, 0), 10), [(0, 'a'), (25, 'b'), (64, 'd')])
+        self.assertEqual(index.near((0, 0), 7), [(0, 'a'), (25, 'b')])
+
+        index.add('a', (99, 99))
+        index.remove('b')
+        self.assertEqual(index.near((100, 100), 2), [(0, 'c'), (2, 'a')])
+        self.assertEqual(len(index.near((0, 0), 10 ** 6)), 3)
+        self.assertEqual(len(index), 3)
+
+
+class TestKeyedLock(unittest.TestCase):
+
+    def test_order(self):
+        locks = KeyedLock()
+        order = []
+
+        async def hold(key, name, delay):
+            async with locks(key):
+                order.append(f"{name}+")
+                await asyncio.sleep(delay)
+                order.append(f"{name}-")
+
+        async def run():
+            await asyncio.gather(hold('a', 'a1', 0.02), hold('a', 'a2', 0), hold('b', 'b1', 0.01))
+            return len(locks)
+
+        self.assertEqual(asyncio.run(run()), 0)
+        # same key in arrival order, the other key runs alongside
+        self.assertEqual(order, ['a1+', 'b1+', 'b1-', 'a1-', 'a2+', 'a2-'])
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.now = datetime(2020, 1, 1)
+
+    def test_pop_due_in_order(self):
+        scheduler = TazdingoScheduler()
+        scheduler.schedule('b', self.now + timedelta(hours=2))
+        scheduler.schedule('a', self.now + timedelta(hours=1))
+        scheduler.schedule('c', self.now + timedelta(hours=3))
+        self.assertEqual(scheduler.next_deadline(), self.now + timedelta(hours=1))
+        self.assertEqual(scheduler.pop_due(self.now), [])
+        self.assertEqual(scheduler.pop_due(self.now + timedelta(hours=2)), ['a', 'b'])
+        self.assertEqual(len(scheduler), 1)
+
+    def test_reschedule_and_cancel(self):
+        scheduler = TazdingoScheduler()
+        scheduler.schedule('a', self.now + timedelta(hours=1))
+        scheduler.schedule('a', self.now + timedelta(hours=5))
+        scheduler.schedule('b', self.now + timedelta(hours=2))
+        scheduler.cancel('b')
+        self.assertEqual(scheduler.pop_due(self.now + timedelta(hours=4)), [])
+        self.assertEqual(scheduler.deadline('a'), self.now + timedelta(hours=5))
+        scheduler.schedule('a', None)
+        self.assertIsNone(scheduler.next_deadline())
+
+    def test_wait_wakes_up_on_earlier_deadline(self):
+        async def run():
+            scheduler = TazdingoScheduler()
+            scheduler.schedule('a', self.now + timedelta(hours=1))
+            waiter = asyncio.ensure_future(scheduler.wait(self.now))
+            await asyncio.sleep(0)
+            scheduler.schedule('b', self.now)
+            await asyncio.wait_for(waiter, 1)
+            self.assertEqual(scheduler.pop_due(self.now), ['b'])
+
+        asyncio.run(run())
+
+    def test_wait_on_virtual_clock(self):
+        async def run():
+            clock = VirtualClock(self.now)
+            scheduler = TazdingoScheduler(clock)
+            scheduler.schedule('a', self.now + timedelta(hours=4))
+            waiter = asyncio.ensure_future(scheduler.wait(clock.now()))
+            await clock.run_until(self.now + timedelta(days=1))
+            self.assertTrue(waiter.done())
+            self.assertEqual(scheduler.pop_due(clock.now()), ['a'])
+            return clock.now()
+
+        self.assertEqual(asyncio.run(run()), self.now + timedelta(days=1))
+
+
+class FakeChannel(object):
+
+    def __init__(self, id=1):
+        self.id = id
+        self.sent = []
+
+    async def send(self, content):
+        self.sent.append(content)
+
+
+class FlakyChannel(FakeChannel):
+
+    def __init__(self, id=1, failures=0):
+        super(FlakyChannel, self).__init__(id)
+        self.failures = failures
+
+    async def send(self, content, file=None):
+        # yields like a real request, and fails the first few times
+        try:
+            await asyncio.sleep(0)
+            if self.failures:
+                self.failures -= 1
+                raise ConnectionError(content)
+            self.sent.append(content if file is None else (content, file.read()))
+        finally:
+            # discord.py closes the file whatever happens
+            if file is not None:
+                file.close()
+
+
+class FakeMessage(object):
+
+    def __init__(self, channel, id=1):
+        self.id = id
+        self.channel = channel
+        self.reactions = []
+
+    async def add_reaction(self, emoji):
+        self.reactions.append(emoji)
+
+
+class TestOutbox(unittest.TestCase):
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(2, 1.0)
+        now = bucket._updated
+        self.assertEqual(bucket.get_delay(now), 0)
+        bucket.consume()
+        bucket.consume()
+        self.assertAlmostEqual(bucket.get_delay(now), 0.5)
+        self.assertEqual(bucket.get_delay(now + 0.5), 0)
+
+    def test_alerts_are_merged(self):
+        async def run():
+            outbox = TazdingoOutbox()
+            channel = FakeChannel()
+            outbox.alert(channel, "<@!1>", "expired")
+            outbox.alert(channel, "<@!2>", "expired")
+            outbox.alert(channel, "<@!3>", "expiring")
+            outbox.send(channel, "a", merge=True)
+            outbox.send(channel, "b", merge=True)
+            await outbox.join()
+            return channel.sent, outbox.merged
+
+        sent, merged = asyncio.run(run())
+        self.assertEqual(sent, ["<@!1> <@!2> expired", "<@!3> expiring", "a\nb"])
+        self.assertEqual(merged, 2)
+
+    def test_overflowing_alerts_keep_merging(self):
+        content = "x" * 1980
+
+        async def run():
+            outbox = TazdingoOutbox(throttle=False)
+            channel = FlakyChannel()
+            outbox.alert(channel, "<@!1>", content)
+            outbox.alert(channel, "<@!2>", content)
+            outbox.alert(channel, "<@!300000>", content)
+            # the first message is on its way, the overflow one is still open
+            await asyncio.sleep(0)
+            outbox.alert(channel, "<@!4>", content)
+            await outbox.join()
+            return channel.sent
+
+        self.assertEqual(asyncio.run(run()), [f"<@!1> <@!2> {content}", f"<@!300000> <@!4> {content}"])
+
+    def test_failed_sends_are_retried(self):
+        async def run():
+            outbox = TazdingoOutbox(retry_delay=0)
+            retried = FlakyChannel(1, failures=2)
+            failing = FlakyChannel(2, failures=3)
+            outbox.send(retried, "a")
+            outbox.send(failing, "b")
+            await outbox.join()
+            return retried.sent, failing.sent, outbox.sent, outbox.dropped
+
+        with unittest.mock.patch('traceback.print_exc'):
+            self.assertEqual(asyncio.run(run()), (["a"], [], 1, 1))
+
+    def test_failed_uploads_are_retried(self):
+        import io
+
+        async def run():
+            outbox = TazdingoOutbox(retry_delay=0)
+            channel = FlakyChannel(1, failures=1)
+            outbox.upload(channel, "a", lambda: io.BytesIO(b"data"))
+            await outbox.join()
+            return channel.sent, outbox.sent
+
+        with unittest.mock.patch('traceback.print_exc'):
+            self.assertEqual(asyncio.run(run()), ([("a", b"data")], 1))
+
+    def test_redundant_reactions_are_dropped(self):
+        async def run():
+            outbox = TazdingoOutbox()
+            message = FakeMessage(FakeChannel())
+            outbox.react(message, "x")
+            outbox.react(message, "x")
+            await outbox.join()
+            return message.reactions, outbox.dropped
+
+        self.assertEqual(asyncio.run(run()), (["x"], 1))
+
+
+class TestCommandRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = CommandRegistry()
+        self.registry.register('$shield', '_on_shield', "<duration:time>", aliases=['shield'], help="set a shield")
+        self.registry.register('$track', '_on_track', "<who:member> [<coords:coords>] [<shields:int>...]", help="track")
+        self.registry.register('$board', '_on_board', "<state:on|off>", permission=lambda context, message: context, help="board")
+        self.message = FakeMessage(FakeChannel())
+        self.message.mentions = []
+
+    def test_aliases(self):
+        command, kwargs = self.registry.resolve('shield', ['2h'], self.message)
+        self.assertEqual(command.handler, '_on_shield')
+        self.assertEqual(kwargs, {'duration': 7200})
+        self.assertEqual(len(self.registry), 3)
+
+    def test_optional_and_variadic(self):
+        self.assertEqual(self.registry.resolve('$track', ['bob'], self.message)[1], {'who': 'bob'})
+        self.assertEqual(self.registry.resolve('$track', ['bob', '4', '8'], self.message)[1], {'who': 'bob', 'shields': [4, 8]})
+        self.assertEqual(self.registry.resolve('$track', ['bob', '1,2', '4'], self.message)[1], {'who': 'bob', 'coords': (1, 2), 'shields': [4]})
+
+    def test_errors(self):
+        with self.assertRaises(UnknownCommandError):
+            self.registry.resolve('$nope', [], self.message)
+        with self.assertRaises(ArgumentError):
+            self.registry.resolve('$shield', [], self.message)
+        with self.assertRaises(ArgumentError):
+            self.registry.resolve('$track', ['bob', 'x'], self.message)
+        with self.assertRaises(ArgumentError):
+            self.registry.resolve('$board', ['maybe'], self.message, True)
+        with self.assertRaises(PermissionDeniedError):
+            self.registry.resolve('$board', ['on'], self.message, False)
+
+    def test_help(self):
+        self.assertEqual(self.registry.get_help(), "\n".join([
+            "General commands:",
+            "  $shield <duration>                      set a shield",
+            "  $track <who> [<coords>] [<shields>...]  track",
+            "  $board on|off                           board",
+        ]))
+
+
+
+HAS_CV2 = importlib.util.find_spec('cv2') is not None
+
+
+def draw_timer(text):
+    # a screenshot of the timer as black text on white, PNG encoded
+    import cv2
+    import numpy
+    canvas = numpy.full((120, 480), 255, numpy.uint8)
+    cv2.putText(canvas, text, (20, 85), cv2.FONT_HERSHEY_SIMPLEX, 2, 0, 4)
+    return cv2.imencode('.png', canvas)[1].tobytes()
+
+
+class TestTimerText(unittest.TestCase):
+
+    def test_clock(self):
+        self.assertEqual(get_timer_seconds(["23:59:12"]), 86352)
+        self.assertEqual(get_timer_seconds(["07:45"]), 27900)
+
+    def test_units(self):
+        self.assertEqual(get_timer_seconds(["1d 4h"]), 100800)
+        self.assertEqual(get_timer_seconds(["3h 20m"]), 12000)
+
+    def test_clock_wins_over_labels(self):
+        self.assertEqual(get_timer_seconds(["sh:88d", "23:59:12"]), 86352)
+
+    def test_invalid(self):
+        self.assertIsNone(get_timer_seconds([]))
+        self.assertIsNone(get_timer_seconds(["99:99"]))
+        self.assertIsNone(get_timer_seconds(["sh 88d"]))
+        self.assertIsNone(get_timer_seconds(["30d"]))
+
+    @unittest.skipUnless(HAS_CV2, "opencv is not installed")
+    def test_screenshot(self):
+        from harness import FakeAttachment
+
+        async def run():
+            vision = TazdingoVision(1)
+            try:
+                return await vision.read_timer([FakeAttachment("timer.png", draw_timer("2:30:15")), FakeAttachment("notes.txt", b"2:30:15")])
+            finally:
+                vision.shutdown()
+
+        self.assertEqual(asyncio.run(run()), 9015)
+
+
+class FakeStorage(object):
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.writes = []
+
+    async def write(self, saves, deletes, appends=()):
+        await asyncio.sleep(0)
+        if self.failures:
+            self.failures -= 1
+            raise sqlite3.OperationalError("database is locked")
+        self.writes.append((list(saves), list(deletes), list(appends)))
+
+
+class TestPersistence(unittest.TestCase):
+
+    def get_prey(self, name, notified=0):
+        import records
+        return records.Prey(1, 2, name, None, datetime(2020, 1, 1, tzinfo=timezone.utc), (3600, 7200), notified)
+
+    def get_event(self, subject):
+        import records
+        return records.Event(1, 'track', 2, subject, datetime(2020, 1, 1, tzinfo=timezone.utc), None)
+
+    def test_coalescing(self):
+        from persistence import TazdingoPersistence
+
+        async def run():
+            storage = FakeStorage()
+            persistence = TazdingoPersistence(storage)
+            persistence.save(self.get_prey('a'))
+            persistence.save(self.get_prey('a', notified=1))
+            persistence.save(self.get_prey('b'))
+            persistence.delete(self.get_prey('b'))
+            persistence.append(self.get_event('a'))
+            persistence.append(self.get_event('a'))
+            pending = len(persistence)
+            await persistence.flush()
+            await persistence.flush()
+            return pending, storage.writes, len(persistence)
+
+        pending, writes, remaining = asyncio.run(run())
+        self.assertEqual((pending, remaining, len(writes)), (4, 0, 1))
+        saves, deletes, appends = writes[0]
+        # the last operation on a row wins, log rows are all kept
+        self.assertEqual([(p.prey_name, p.notified) for p in saves], [('a', 1)])
+        self.assertEqual([p.prey_name for p in deletes], ['b'])
+        self.assertEqual(len(appends), 2)
+
+    def test_threshold(self):
+        from persistence import TazdingoPersistence
+
+        async def run():
+            storage = FakeStorage()
+            persistence = TazdingoPersistence(storage, delay=60, threshold=3)
+            task = asyncio.ensure_future(persistence.run())
+            for name in 'ab':
+                persistence.save(self.get_prey(name))
+            await asyncio.sleep(0.05)
+            below = len(storage.writes)
+            persistence.save(self.get_prey('c'))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            return below, storage.writes
+
+        below, writes = asyncio.run(run())
+        # well before the delay, a full queue is flushed right away
+        self.assertEqual((below, len(writes)), (0, 1))
+        self.assertEqual(len(writes[0][0]), 3)
+
+    def test_failed_flush_is_requeued(self):
+        from persistence import TazdingoPersistence
+
+        async def run():
+            storage = FakeStorage(failures=1)
+            persistence = TazdingoPersistence(storage)
+            persistence.save(self.get_prey('a'))
+            persistence.append(self.get_event('first'))
+            with self.assertRaises(sqlite3.OperationalError):
+                await persistence.flush()
+            # newer writes made meanwhile win over the requeued ones
+            persistence.save(self.get_prey('a', notified=1))
+            persistence.append(self.get_event('second'))
+            pending = len(persistence)
+            await persistence.flush()
+            return pending, storage.writes, persistence.metrics.counters
+
+        pending, writes, counters = asyncio.run(run())
+        self.assertEqual(pending, 3)
+        saves, deletes, appends = writes[0]
+        self.assertEqual([(p.prey_name, p.notified) for p in saves], [('a', 1)])
+        self.assertEqual([e.subject for e in appends], ['first', 'second'])
+        self.assertEqual(counters[('db_flush_errors_total', ())], 1)
+
+    def test_failing_rows_are_dropped(self):
+        from persistence import FLUSH_RETRIES, TazdingoPersistence
+
+        async def run():
+            storage = FakeStorage(failures=FLUSH_RETRIES + 1)
+            persistence = TazdingoPersistence(storage)
+            persistence.save(self.get_prey('a'))
+            persistence.append(self.get_event('a'))
+            for attempt in range(FLUSH_RETRIES + 1):
+                if attempt == FLUSH_RETRIES:
+                    # the write that is not stuck yet gets its own retries
+                    persistence.save(self.get_prey('b'))
+                with self.assertRaises(sqlite3.OperationalError):
+                    await persistence.flush()
+            pending = len(persistence)
+            await persistence.flush()
+            return pending, storage.writes, persistence.metrics.counters
+
+        with unittest.mock.patch('builtins.print'):
+            pending, writes, counters = asyncio.run(run())
+        self.assertEqual(pending, 1)
+        self.assertEqual([[p.prey_name for p in saves] for saves, deletes, appends in writes], [['b']])
+        self.assertEqual(counters[('db_dropped_objects_total', ())], 2)
+
+
+class TestThresholds(unittest.TestCase):
+
+    def test_prey_marks(self):
+        base = datetime(2020, 1, 1)
+        thresholds = get_thresholds((4 * 3600, 8 * 3600, 12 * 3600))
+        self.assertEqual(thresholds.get_next(base, 0), base + timedelta(hours=4))
+        self.assertIsNone(thresholds.get_due(base, 0, base + timedelta(hours=3)))
+        # only the latest passed mark is due, and firing it covers the earlier ones
+        due = thresholds.get_due(base, 0, base + timedelta(hours=9))
+        self.assertEqual(due, 1)
+        fired = thresholds.fire(0, due)
+        self.assertEqual(fired, 0b011)
+        self.assertIsNone(thresholds.get_due(base, fired, base + timedelta(hours=9)))
+        self.assertEqual(thresholds.get_next(base, fired), base + timedelta(hours=12))
+        self.assertIsNone(thresholds.get_next(base, 0b111))
+        self.assertIsNone(thresholds.get_next(base, 0, base + timedelta(hours=13)))
+
+    def test_shield_reminders(self):
+        expires = datetime(2020, 1, 1, 12)
+        reminders = get_shield_reminders([1800, 7200, 300])
+        self.assertEqual(reminders, (7200, 1800, 300, 0))
+        thresholds = get_shield_thresholds(reminders)
+        self.assertEqual(thresholds.get_passed(expires, expires - timedelta(minutes=20)), 0b0011)
+        self.assertEqual(thresholds.get_next(expires, 0b0011), expires - timedelta(minutes=5))
+        self.assertEqual(thresholds.get_due(expires, 0b0011, expires), 3)
+
+    def test_observed(self):
+        durations = (4 * 3600, 8 * 3600, 24 * 3600)
+        self.assertIsNone(get_observed(durations, 3 * 3600))
+        self.assertEqual(get_observed(durations, 9 * 3600), 8 * 3600)
+        self.assertEqual(get_observed(durations, 30 * 3600), 24 * 3600)
+        self.assertEqual(parse_seconds("3600,0"), (3600, 0))
+        self.assertEqual(parse_seconds(""), ())
+
+
+class TestRecords(unittest.TestCase):
+
+    def test_notify(self):
+        import records
+        prey = records.Prey(1, 2, 'prey', None, datetime(2020, 1, 1), (14400, 28800, 43200, 86400), 0)
+        prey = prey.notify(1)
+        self.assertEqual(prey.notified, 0b0011)
+        self.assertTrue(prey.is_notified(14400))
+        self.assertFalse(prey.is_notified(86400))
+        self.assertFalse(prey.fully_notified)
+        self.assertTrue(prey.notify(3).fully_notified)
+        self.assertEqual(prey.to_values()['marks'], "14400,28800,43200,86400")
+
+    def test_estimate(self):
+        import records
+        estimate = records.PreyEstimate(1, 'prey', ())
+        for hours in (8, 8, 8, 24, 4, 8, 24):
+            estimate = estimate.observe(hours * 3600)
+        self.assertEqual(estimate.counts, ((14400, 1), (28800, 4), (86400, 2)))
+        marks = (14400, 28800, 43200, 86400)
+        self.assertEqual(estimate.get_ranked(marks), [28800, 86400, 14400, 43200])
+        self.assertEqual(estimate.get_likely(marks, 0.15), (28800, 86400))
+        self.assertEqual(records.PreyEstimate(1, 'prey', ()).get_share(14400), None)
+        self.assertEqual(estimate.to_values()['counts'], "14400,1,28800,4,86400,2")
+
+
+class TestStorage(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        from harness import setup_django
+        setup_django()
+
+    def test_roundtrip(self):
+        import records
+        from data import models
+        from storage import TazdingoStorage
+
+        storage = TazdingoStorage()
+        storage.open()
+
+        async def run():
+            now = datetime(2020, 1, 1, tzinfo=timezone.utc)
+            prey = records.Prey(guild_id=1, user_id=2, prey_name='prey', coords=None, entered=now, marks=(14400, 28800), notified=0)
+            shield = models.Shield(guild_id=1, user_id=2, name='a', display_name='a', entered=now, expires=now)
+            await storage.upsert([prey, shield])
+            prey = prey.notify(0)
+            await storage.upsert([prey])
+            preys = [_prey async for _prey in storage.load(models.Prey)]
+            shields = [_shield async for _shield in storage.load(models.Shield, batch_size=1)]
+            await storage.delete([prey, shield])
+            remaining = [_prey async for _prey in storage.load(models.Prey)]
+            await storage.close()
+            return preys, shields, remaining
+
+        preys, shields, remaining = asyncio.run(run())
+        self.assertEqual([(p.prey_name, p.entered, p.marks, p.notified) for p in preys], [('prey', datetime(2020, 1, 1, tzinfo=timezone.utc), "14400,28800", 1)])
+        self.assertEqual(shields[0].polymorphic_ctype.model, 'shield')
+        self.assertEqual(remaining, [])
+
+    def test_events(self):
+        import records
+        from storage import TazdingoStorage
+
+        storage = TazdingoStorage()
+        storage.open()
+
+        async def run():
+            day = datetime(2020, 2, 1, 12, tzinfo=timezone.utc)
+            await storage.write([], [], [
+                records.Event(7, 'shield', 1, 'bob', day, 3600),
+                records.Event(7, 'shield', 1, 'bob', day + timedelta(hours=1), 7200),
+                records.Event(7, 'track', 1, 'prey', day + timedelta(days=1), None),
+                records.Event(8, 'track', 1, 'prey', day, None),
+            ])
+            await storage.write([], [], [records.Event(7, 'lose', 2, 'prey', day + timedelta(days=1, hours=1), 60)])
+            history = await storage.get_events(7, 2, subject='prey')
+            mine = await storage.get_events(7, 10, user_id=1)
+            counts = await storage.get_event_counts(7, day.date())
+            recent = await storage.get_event_counts(7, (day + timedelta(days=1)).date())
+            await storage.close()
+            return history, mine, counts, recent
+
+        history, mine, counts, recent = asyncio.run(run())
+        self.assertEqual([e.kind for e in history], ['lose', 'track'])
+        self.assertEqual([e.kind for e in mine], ['track', 'shield', 'shield'])
+        self.assertEqual(counts, [('lose', 1, 60), ('shield', 2, 10800), ('track', 1, 0)])
+        self.assertEqual(recent, [('lose', 1, 60), ('track', 1, 0)])
+
+
+    def create_legacy(self, path):
+        # the schema from before guilds, on top of an otherwise current database
+        source = sqlite3.connect('file:tazdingo?mode=memory&cache=shared', uri=True)
+        connection = sqlite3.connect(path)
+        source.backup(connection)
+        source.close()
+        connection.executescript("""
+            DROP TABLE data_shield;
+            DROP TABLE data_reinforcement;
+            DROP TABLE data_prey;
+            CREATE TABLE data_shield (polymorphic_ctype_id integer NULL, name varchar(255) NOT NULL, user_id integer NOT NULL PRIMARY KEY, display_name varchar(255) NOT NULL, entered datetime NOT NULL, expires datetime NOT NULL, expired_notification bool NOT NULL, expiring_notification bool NOT NULL);
+            CREATE INDEX data_shield_polymorphic_ctype_id_56fc1368 ON data_shield (polymorphic_ctype_id);
+            CREATE TABLE data_reinforcement (polymorphic_ctype_id integer NULL, name varchar(255) NOT NULL, user_id integer NOT NULL PRIMARY KEY, display_name varchar(255) NOT NULL, entered datetime NOT NULL);
+            CREATE TABLE data_prey (user_id integer NOT NULL, prey_name varchar(255) NOT NULL PRIMARY KEY, coords varchar(255) NULL, entered datetime NOT NULL, four_notification bool NOT NULL, eight_notification bool NOT NULL, twelve_notification bool NOT NULL, twenty_four_notification bool NOT NULL);
+        """)
+        return connection
+
+    def test_upgrade(self):
+        import records
+        from data import models
+        from storage import TazdingoStorage
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'legacy.sqlite3')
+            connection = self.create_legacy(path)
+            connection.execute("INSERT INTO data_shield VALUES (NULL, 'a', 2, 'A', '2020-01-01 00:00:00', '2020-01-01 08:00:00', 0, 0)")
+            connection.execute("INSERT INTO data_reinforcement VALUES (NULL, 'b', 3, 'B', '2020-01-01 00:00:00')")
+            connection.execute("INSERT INTO data_prey VALUES (2, 'prey', '1,2', '2020-01-01 00:00:00', 0, 0, 0, 0)")
+            connection.commit()
+            connection.close()
+
+            storage = TazdingoStorage(database=path, guild_id=7)
+            storage.open()
+
+            async def run():
+                shields = [records.Shield.from_model(_s) async for _s in storage.load(models.Shield)]
+                reins = [records.Reinforcement.from_model(_r) async for _r in storage.load(models.Reinforcement)]
+                preys = [records.Prey.from_model(_p) async for _p in storage.load(models.Prey)]
+                # rows are matched on their new natural keys
+                await storage.upsert([preys[0]._replace(notified=1)])
+                updated = [_p.notified async for _p in storage.load(models.Prey)]
+                await storage.close()
+                return shields, reins, preys, updated
+
+            shields, reins, preys, updated = asyncio.run(run())
+
+        day = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        self.assertEqual([(s.guild_id, s.user_id, s.name, s.expires) for s in shields], [(7, 2, 'a', day + timedelta(hours=8))])
+        self.assertEqual([(r.guild_id, r.user_id, r.display_name) for r in reins], [(7, 3, 'B')])
+        self.assertEqual([(p.guild_id, p.prey_name, p.coords, p.entered) for p in preys], [(7, 'prey', (1, 2), day)])
+        self.assertEqual(updated, [1])
+
+    def test_upgrade_needs_guild(self):
+        from storage import LegacyDatabaseError, TazdingoStorage
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'legacy.sqlite3')
+            self.create_legacy(path).close()
+
+            storage = TazdingoStorage(database=path)
+            with self.assertRaises(LegacyDatabaseError):
+                storage.open()
+            asyncio.run(storage.close())
+
+            connection = sqlite3.connect(path)
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(data_shield)")]
+            connection.close()
+
+        self.assertNotIn('guild_id', columns)
+
+    def test_upgrade_flags(self):
+        from data import models
+        from storage import TazdingoStorage
+
+        recent = (datetime.now(timezone.utc) - timedelta(hours=1)).strftime('%Y-%m-%d %H:%M:%S')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'legacy.sqlite3')
+            connection = self.create_legacy(path)
+            connection.execute("INSERT INTO data_shield VALUES (NULL, 'a', 2, 'A', '2020-01-01 00:00:00', '2020-01-01 08:00:00', 0, 1)")
+            connection.execute("INSERT INTO data_shield VALUES (NULL, 'b', 3, 'B', '2020-01-01 00:00:00', '2020-01-01 08:00:00', 1, 1)")
+            # announced up to 8h
+            connection.execute("INSERT INTO data_prey VALUES (2, 'old', NULL, '2020-01-01 00:00:00', 1, 1, 0, 0)")
+            # only 8h and 24h tracked
+            connection.execute(f"INSERT INTO data_prey VALUES (2, 'new', NULL, '{recent}', 1, 0, 1, 0)")
+            connection.commit()
+            connection.close()
+
+            storage = TazdingoStorage(database=path, guild_id=7)
+            storage.open()
+
+            async def run():
+                shields = [_s async for _s in storage.load(models.Shield)]
+                preys = [_p async for _p in storage.load(models.Prey)]
+                await storage.close()
+                return shields, preys
+
+            shields, preys = asyncio.run(run())
+
+        self.assertEqual([(s.name, s.reminders, s.notified) for s in shields], [('a', "3600,0", 1), ('b', "3600,0", 3)])
+        self.assertEqual(sorted((p.prey_name, p.marks, p.notified) for p in preys), [('new', "28800,86400", 0), ('old', "14400,28800,43200,86400", 3)])
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = Histogram((0.001, 0.01, 0.1))
+        for value in (0.0005, 0.0005, 0.005, 0.05, 0.5):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1, 1])
+        self.assertEqual(histogram.quantile(0.5), 0.01)
+        self.assertEqual(histogram.quantile(0.99), 0.5)
+        self.assertEqual(Histogram().quantile(0.5), 0.0)
+
+    def test_render_and_serve(self):
+        metrics = TazdingoMetrics()
+        metrics.observe('command_seconds', 0.002, command='$track')
+        metrics.inc('commands_rejected_total', reason='unknown')
+        metrics.register('outbox_depth', lambda: 3)
+
+        async def run():
+            server = MetricsServer(metrics, 0)
+            await server.start()
+            reader, writer = await asyncio.open_connection(server.host, server.port)
+            writer.write(b"GET /metrics HTTP/1.0\r\n\r\n")
+            response = await reader.read()
+            writer.close()
+            await server.close()
+            return response.decode()
+
+        response = asyncio.run(run())
+        self.assertTrue(response.startswith("HTTP/1.0 200 OK"))
+        self.assertIn('tazdingo_command_seconds_bucket{command="$track",le="0.0025"} 1', response)
+        self.assertIn('tazdingo_command_seconds_count{command="$track"} 1', response)
+        self.assertIn('tazdingo_commands_rejected_total{reason="unknown"} 1', response)
+        self.assertIn("tazdingo_outbox_depth 3", response)
+
+
+class TestApi(unittest.TestCase):
+
+    def get(self, port, path, etag=None):
+        import urllib.error
+        import urllib.request
+        request = urllib.request.Request(f"http://127.0.0.1:{port}{path}", headers={'If-None-Match': etag} if etag else {})
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return response.status, response.headers.get('ETag'), json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers.get('ETag'), None
+
+    def test_snapshots(self):
+        import threading
+        import records
+        from api import SnapshotStore, TazdingoApi, build_snapshot
+
+        now = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        shield = records.Shield(1, 2, 'a', 'A', now, now + timedelta(hours=3), (3600, 0), 0)
+        prey = records.Prey(1, 2, 'bob', (1, 2), now, (14400, 28800), 0b01)
+        store = SnapshotStore()
+        store.publish(build_snapshot(1, 5, [shield], [], [prey], now, store.nonce))
+        api = TazdingoApi(store, 0)
+        api.start()
+        try:
+            status, etag, body = self.get(api.port, "/api/1")
+            self.assertEqual((status, etag, body['version']), (200, f'"{store.nonce}-1-5"', 5))
+            self.assertEqual(body['tracks'][0]['notified'], [14400])
+            self.assertEqual([d['kind'] for d in body['deadlines']], ['shield', 'track'])
+
+            status, etag, body = self.get(api.port, "/api/1/tracks")
+            self.assertEqual(set(body), {'guild_id', 'version', 'generated', 'tracks'})
+            self.assertEqual(self.get(api.port, "/api/1/shields", etag)[0], 304)
+            self.assertEqual(self.get(api.port, "/api/2")[0], 404)
+
+            # a long poll returns as soon as a newer snapshot is published
+            timer = threading.Timer(0.1, store.publish, [build_snapshot(1, 6, [], [], [], now, store.nonce)])
+            timer.start()
+            status, etag, body = self.get(api.port, "/api/1/shields?wait=5", etag)
+            self.assertEqual((status, etag, body['shields']), (200, f'"{store.nonce}-1-6"', []))
+
+            # after a restart the same version is a different snapshot
+            restarted = SnapshotStore()
+            store.publish(build_snapshot(1, 6, [shield], [], [], now, restarted.nonce))
+            self.assertEqual(self.get(api.port, "/api/1/shields", etag)[0], 200)
+        finally:
+            api.close()
+
+
+class ClientTestCase(unittest.TestCase):
+    # a harness client on its own event loop and an empty database
+    start = None
+
+    @classmethod
+    def setUpClass(cls):
+        from harness import setup_django
+        setup_django()
+
+    def setUp(self):
+        import harness
+        harness.reset_database()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.client = harness.get_client_class()(VirtualClock(self.start))
+        self.client.initialize()
+
+    def tearDown(self):
+        import harness
+        self.loop.run_until_complete(self.close_client())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        harness.reset_database()
+
+    async def close_client(self):
+        _client = self.client
+        for _task in (_client.background_task, _client.persistence_task, _client.boards_task, _client.lease_task, _client.maintenance_task):
+            _task.cancel()
+        await _client.outbox.join()
+        await _client.storage.close()
+        _client.vision.shutdown()
+
+    def send(self, author_id, content, channel=None):
+        import harness
+        _channel = channel or self.client.channels[harness.SHIELDS_CHANNEL_ID]
+        _message = harness.FakeMessage(content, self.client.get_member(author_id), _channel)
+        self.loop.run_until_complete(self.client.on_message(_message))
+        self.loop.run_until_complete(self.client.outbox.join())
+        return _message
+
+
+class TestSync(ClientTestCase):
+
+    def test_lease(self):
+        from storage import TazdingoStorage
+
+        storage = TazdingoStorage()
+        storage.open()
+
+        async def run():
+            first = await storage.acquire_lease('test', 'a', 10)
+            second = await storage.acquire_lease('test', 'b', 10)
+            renewed = await storage.acquire_lease('test', 'a', 10)
+            await storage.acquire_lease('test', 'a', -1)
+            expired = await storage.acquire_lease('test', 'b', 10)
+            await storage.release_lease('test', 'b')
+            released = await storage.acquire_lease('test', 'a', 10)
+            await storage.release_lease('test', 'a')
+            await storage.close()
+            return [_leader for _leader, _expires in (first, second, renewed, expired, released)]
+
+        self.assertEqual(self.loop.run_until_complete(run()), [True, False, True, True, True])
+
+    def test_changes(self):
+        import harness
+        import records
+        from storage import TazdingoStorage
+
+        client = self.client
+        other = TazdingoStorage(origin='other')
+        other.open()
+
+        async def run():
+            # nobody else holds the lease in an empty database
+            await client.renew_lease()
+            leader = client.is_leading()
+            now = client.clock.now()
+            cursor = await client.storage.get_last_change()
+            client.changes_cursor = cursor
+            prey = records.Prey(guild_id=harness.GUILD_ID, user_id=5, prey_name='synced', coords=None, entered=now, marks=(3600,), notified=0)
+            await other.upsert([prey])
+            await client.apply_changes()
+            added = client.partitions[harness.GUILD_ID].poach.preys.get('synced')
+            await other.delete([prey])
+            await client.apply_changes()
+            removed = client.partitions[harness.GUILD_ID].poach.preys.get('synced')
+            changes = await other.get_changes(cursor)
+            await other.close()
+            return leader, added, removed, changes
+
+        leader, added, removed, changes = self.loop.run_until_complete(run())
+
+        self.assertEqual((added.user_id, added.marks), (5, (3600,)))
+        self.assertIsNone(removed)
+        self.assertEqual([(origin, model, key) for _id, origin, model, key in changes], [('other', 'Prey', f'[{harness.GUILD_ID}, "synced"]')] * 2)
+        self.assertTrue(leader)
+
+
+class TestMaintenance(ClientTestCase):
+
+    def test_retention(self):
+        import harness
+        import records
+
+        client = self.client
+        now = client.clock.now()
+        poach = client.get_partition(harness.GUILD_ID).poach
+        old = now - timedelta(days=30)
+        poach.add_shield(records.Shield(harness.GUILD_ID, 5, 'a', 'a', old, old, (0,), 1))
+        poach.add_shield(records.Shield(harness.GUILD_ID, 6, 'b', 'b', now, now + timedelta(hours=1), (0,), 0))
+        poach.add_prey(records.Prey(harness.GUILD_ID, 5, 'stale', None, old, (3600,), 0))
+        poach.add_prey(records.Prey(harness.GUILD_ID, 5, 'fresh', None, now, (3600,), 0))
+        self.loop.run_until_complete(client.storage.write([], [], [
+            records.Event(harness.GUILD_ID, 'shield', 5, 'a', now - timedelta(days=400), 3600),
+            records.Event(harness.GUILD_ID, 'shield', 5, 'a', now, 3600),
+        ]))
+        purged = self.loop.run_until_complete(client.maintain(now))
+        events = [_event.created for _event in self.loop.run_until_complete(client.storage.get_events(harness.GUILD_ID, 10, user_id=5))]
+
+        # the stale shield, the stale prey and the 400 day old event
+        self.assertEqual(purged, 3)
+        self.assertEqual((sorted(poach.shields), sorted(poach.preys), events), ([6], ['fresh'], [now]))
+        self.assertEqual(client.maintenances, 1)
+
+
+class TestTransfer(unittest.TestCase):
+
+    def test_parse(self):
+        from transfer import ImportRowError, parse_import
+
+        now = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        data = b'name,coords,shields\nbob,"1,2",8 4h\nal,,\nbob,,1d\n'
+        self.assertEqual(parse_import('tracks', 'csv', data, now, (3600,), 7), [
+            ('bob', None, (86400,), None, 7),
+            ('al', None, (3600,), None, 7),
+        ])
+
+        data = b'{"user_id": 5, "name": "a", "remaining": "2h"}\n\n{"user_id": "6", "name": "b", "expires": "2020-01-02T00:00:00"}\n'
+        self.assertEqual(parse_import('shields', 'jsonl', data, now, (), 7), [
+            (5, 'a', 'a', now, now + timedelta(hours=2)),
+            (6, 'b', 'b', now, now + timedelta(days=1)),
+        ])
+
+        for format, data, message in [
+            ('csv', b'name,coords\nbob,"1;2"\n', "line 2: invalid coords '1;2'"),
+            ('csv', b'name,shields\nbob,0\n', "line 2: invalid shield '0'"),
+            ('csv', b'name\nbob al\n', "line 2: invalid name 'bob al'"),
+            ('jsonl', b'{"name": "bob"}\n[1]\n', "line 2: expected an object"),
+            ('csv', b'name\n\xff\n', "not UTF-8"),
+        ]:
+            with self.assertRaises(ImportRowError) as e:
+                parse_import('tracks', format, data, now, (3600,), 7)
+            self.assertEqual(str(e.exception), message)
+
+    def test_row_limit(self):
+        import transfer
+
+        now = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        data = b'name\n' + b'bob\n' * (transfer.MAX_IMPORT_ROWS + 1)
+        with self.assertRaises(transfer.ImportRowError) as e:
+            transfer.parse_import('tracks', 'csv', data, now, (3600,), 7)
+        self.assertEqual(e.exception.line, transfer.MAX_IMPORT_ROWS + 2)
+
+        data = b'name,user_id,remaining\n' + b'bob,5,1h\n' * transfer.MAX_IMPORT_ROWS
+        self.assertEqual(len(transfer.parse_import('shields', 'csv', data, now, (), 7)), 1)
+
+    def test_roundtrip(self):
+        import records
+        from transfer import export_rows, parse_import
+
+        now = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        preys = [records.Prey(1, 7, 'bob', (1, 2), now, (5400, 86400), 1)]
+        for format in ('csv', 'jsonl'):
+            data = export_rows('tracks', format, preys)
+            self.assertEqual(parse_import('tracks', format, data, now, (3600,), 9), [('bob', (1, 2), (5400, 86400), now, 7)])
+
+
+class TestImport(ClientTestCase):
+
+    def test_import_export(self):
+        import harness
+
+        client = self.client
+        channel = client.channels[harness.SHIELDS_CHANNEL_ID]
+        owner = client.get_member(harness.OWNER_ID)
+        self.send(harness.OWNER_ID, "$bind")
+        self.loop.run_until_complete(client.persistence.flush())
+
+        data = "name,coords,shields\n" + "".join(f'imported{i},"{i},{i}",4h 8h\n' for i in range(1000))
+        message = harness.FakeMessage("$import tracks", owner, channel)
+        message.attachments.append(harness.FakeAttachment("tracks.csv", data.encode('utf-8')))
+        flushes = client.persistence.flushes
+        self.loop.run_until_complete(client.on_message(message))
+        flushes = client.persistence.flushes - flushes
+
+        rejected = harness.FakeMessage("$import tracks", client.get_member(5), channel)
+        rejected.attachments.append(harness.FakeAttachment("tracks.csv", data.encode('utf-8')))
+        self.loop.run_until_complete(client.on_message(rejected))
+        export = self.send(5, "$export tracks jsonl")
+
+        poach = client.partitions[harness.GUILD_ID].poach
+        self.assertEqual(flushes, 1)
+        self.assertEqual(message.reactions, ['\N{ROBOT FACE}'])
+        self.assertEqual(rejected.reactions, ['\N{NO ENTRY}'])
+        self.assertEqual(export.reactions, ['\N{ROBOT FACE}'])
+        self.assertEqual(poach.get_near_preys((10, 10), 1), [(0, poach.preys['imported10'])])
+        self.assertEqual(poach.count_tracked_preys(), 1000)
+        self.assertEqual([prey.prey_name for _, prey in list(poach.iter_sorted_preys())[:2]], ['imported0', 'imported1'])
+
+        exported = [m for m in channel.messages.values() if m.attachments][-1]
+        lines = exported.attachments[0].fp.getvalue().decode('utf-8').splitlines()
+        self.assertEqual(exported.content, "<@!5> 1000 tracks")
+        self.assertEqual(len(lines), 1000)
+
+    def test_import_waits_for_keys(self):
+        import harness
+
+        client = self.client
+        self.send(harness.OWNER_ID, "$bind")
+        partition = client.partitions[harness.GUILD_ID]
+
+        message = harness.FakeMessage("$import tracks", client.get_member(harness.OWNER_ID), client.channels[harness.SHIELDS_CHANNEL_ID])
+        message.attachments.append(harness.FakeAttachment("tracks.csv", b"name,shields\nbob,4h\nal,4h\n"))
+
+        async def run():
+            # a command on one of the keys is still running when the import comes in
+            async with partition.commands.lock('prey', 'bob'):
+                task = asyncio.ensure_future(client.on_message(message))
+                await asyncio.sleep(0.2)
+                waiting = sorted(partition.poach.preys)
+                held = partition.commands.locks.locked(('prey', 'al'))
+            await task
+            return waiting, held
+
+        waiting, held = self.loop.run_until_complete(run())
+
+        # nothing is applied until every key is held, and every lock goes away afterwards
+        self.assertEqual((waiting, held, sorted(partition.poach.preys), len(partition.commands.locks)), ([], True, ['al', 'bob'], 0))
+
+
+class TestCommands(ClientTestCase):
+
+    @unittest.skipUnless(HAS_CV2, "opencv is not installed")
+    def test_shield_screenshot(self):
+        import harness
+
+        self.send(harness.OWNER_ID, "$bind")
+        message = harness.FakeMessage("$shield", self.client.get_member(5), self.client.channels[harness.SHIELDS_CHANNEL_ID])
+        message.attachments.append(harness.FakeAttachment("timer.png", draw_timer("2:30:15")))
+        self.loop.run_until_complete(self.client.on_message(message))
+
+        shield = self.client.partitions[harness.GUILD_ID].poach.shields[5]
+        self.assertEqual(message.reactions, ['\N{ROBOT FACE}'])
+        self.assertEqual(shield.expires - shield.entered, timedelta(seconds=9015))
+
+    def test_near_radius(self):
+        import harness
+
+        self.send(harness.OWNER_ID, "$bind")
+        self.send(5, "$track bob 10,12")
+
+        self.assertEqual(self.send(5, "$near 10,10 -5").reactions, ['\N{CROSS MARK}'])
+        self.assertEqual(self.send(5, "$near 10,10 2").reactions, ['\N{ROBOT FACE}'])
+
+    def test_marks_are_kept_notified(self):
+        import harness
+
+        self.send(harness.OWNER_ID, "$bind")
+        self.send(5, "$track bob 9 12")
+        self.loop.run_until_complete(self.client.clock.run_until(self.client.clock.now() + timedelta(hours=9, minutes=30)))
+        self.loop.run_until_complete(self.client.outbox.join())
+
+        alerts = [m.content for m in self.client.channels[harness.SHIELDS_CHANNEL_ID].messages.values()]
+        self.assertEqual(self.client.partitions[harness.GUILD_ID].poach.preys['bob'].notified, 1)
+        self.assertEqual(alerts, ["<@!5> bob's 9h shield may have expired!"])
+
+    def test_lose_observes_own_marks(self):
+        import harness
+
+        self.send(harness.OWNER_ID, "$bind")
+        self.send(5, "$track bob 9 12")
+        self.loop.run_until_complete(self.client.clock.run_until(self.client.clock.now() + timedelta(hours=9, minutes=30)))
+        self.send(5, "$lose bob")
+
+        estimate = self.client.partitions[harness.GUILD_ID].poach.estimates['bob']
+        self.assertEqual(estimate.counts, ((32400, 1),))
+
+    def test_unbound_channels_only_bind(self):
+        import harness
+
+        hive = self.send(5, "$hive")
+        bind = self.send(harness.OWNER_ID, "$bind")
+        config = self.client.partitions[harness.GUILD_ID].config
+
+        self.assertEqual(hive.reactions, [])
+        self.assertEqual(bind.reactions, ['\N{ROBOT FACE}'])
+        self.assertEqual((config.shields_channel_id, config.alerts_channel_id), (harness.SHIELDS_CHANNEL_ID, harness.SHIELDS_CHANNEL_ID))
+
+    def test_bind(self):
+        import harness
+
+        shields = self.client.channels[harness.SHIELDS_CHANNEL_ID]
+        alerts = self.client.channels[harness.ALERTS_CHANNEL_ID]
+        self.send(harness.OWNER_ID, "$bind shields")
+        self.send(harness.OWNER_ID, "$bind alerts", channel=alerts)
+        denied = self.send(5, "$bind", channel=alerts)
+        config = self.client.partitions[harness.GUILD_ID].config
+
+        self.assertEqual((config.shields_channel_id, config.alerts_channel_id), (shields.id, alerts.id))
+        self.assertEqual(denied.reactions, ['\N{NO ENTRY}'])
+        # only the shields channel takes commands
+        self.assertEqual(self.send(5, "$shield 2h", channel=alerts).reactions, [])
+        self.assertEqual(self.send(5, "$shield 2h", channel=shields).reactions, ['\N{ROBOT FACE}'])
+
+    def test_partitions(self):
+        import harness
+
+        other = harness.FakeChannel(3000, harness.FakeGuild(harness.GUILD_ID + 1), self.client.stats)
+        self.send(harness.OWNER_ID, "$bind")
+        self.send(harness.OWNER_ID, "$bind", channel=other)
+        self.send(5, "$shield 2h")
+        self.send(6, "$rein", channel=other)
+
+        first = self.client.partitions[harness.GUILD_ID].poach
+        second = self.client.partitions[harness.GUILD_ID + 1].poach
+        self.assertEqual((list(first.shields), list(first.reins)), ([5], []))
+        self.assertEqual((list(second.shields), list(second.reins)), ([], [6]))
+
+    def test_tracks_pages(self):
+        import harness
+        import records
+
+        self.send(harness.OWNER_ID, "$bind")
+        poach = self.client.partitions[harness.GUILD_ID].poach
+        now = self.client.clock.now()
+        for idx in range(PAGE_SIZE):
+            poach.add_prey(records.Prey(harness.GUILD_ID, 5, f"prey{idx:02}", None, now, (3600,), 0))
+        # past their only mark, they wait for the notifier and are not listed
+        for idx in range(5):
+            poach.add_prey(records.Prey(harness.GUILD_ID, 5, f"late{idx}", None, now - timedelta(hours=2), (3600,), 0))
+
+        channel = self.client.channels[harness.SHIELDS_CHANNEL_ID]
+        listed = self.send(5, "$tracks")
+        sent = [m.content for m in channel.messages.values()]
+        missing = self.send(5, "$tracks 2")
+
+        self.assertEqual(listed.reactions, ['\N{ROBOT FACE}'])
+        self.assertEqual(len(sent), 1)
+        self.assertTrue(sent[0].startswith("Tracks:```"))
+        self.assertNotIn("late", sent[0])
+        self.assertEqual(missing.reactions, ['\N{CROSS MARK}'])
+
+
+class TestNotifier(ClientTestCase):
+
+    def test_only_commands_are_sharded(self):
+        import tazdingo
+        from conf import settings
+
+        with unittest.mock.patch.multiple(settings, SHARD_ID=1, SHARD_COUNT=2):
+            commands = tazdingo.TazdingoClient(role='commands')
+            notifier = tazdingo.TazdingoClient(role='notifier')
+        for client in (commands, notifier):
+            for task in (client.background_task, client.persistence_task, client.boards_task, client.maintenance_task):
+                task.cancel()
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+        self.assertEqual((commands.shard_id, commands.shard_count), (1, 2))
+        self.assertEqual((notifier.shard_id, notifier.shard_count), (None, None))
+
+    def test_alerts_wait_for_their_channel(self):
+        import harness
+        import tazdingo
+
+        self.send(harness.OWNER_ID, "$bind shields")
+        self.send(5, "$shield 3h")
+        partition = self.client.partitions[harness.GUILD_ID]
+        self.loop.run_until_complete(self.client.persistence.flush())
+
+        now = self.client.clock.now() + timedelta(hours=4)
+        self.loop.run_until_complete(self.client.notify_partition(partition, [(tazdingo.SHIELD_KEY, 5)], now))
+
+        self.assertEqual(partition.poach.shields[5].notified, 0)
+        self.assertEqual(len(self.client.persistence), 0)
+        self.assertEqual(self.client.scheduler.deadline((harness.GUILD_ID, tazdingo.SHIELD_KEY, 5)), now + timedelta(seconds=tazdingo.ALERTS_DELAY))
+
+
+class TestBoard(ClientTestCase):
+    # a second into a countdown bucket, so only changes trigger edits
+    start = datetime(2020, 1, 1, 0, 0, 1, tzinfo=timezone.utc)
+
+    def setUp(self):
+        import harness
+        super(TestBoard, self).setUp()
+        self.send(harness.OWNER_ID, "$bind")
+        self.send(harness.OWNER_ID, "$board on")
+        self.board = self.client.partitions[harness.GUILD_ID].board
+        self.channel = self.client.channels[harness.SHIELDS_CHANNEL_ID]
+
+    def run_for(self, seconds):
+        self.loop.run_until_complete(self.client.clock.run_until(self.client.clock.now() + timedelta(seconds=seconds)))
+
+    def test_render_is_cached(self):
+        self.send(5, "$shield 2h")
+        commands = self.board.commands
+        with unittest.mock.patch.object(commands, 'render_shields', wraps=commands.render_shields) as render_shields:
+            now = self.client.clock.now()
+            first = self.board.render(now)
+            self.assertIs(self.board.render(now + timedelta(seconds=30)), first)
+            self.send(6, "$shield 3h")
+            self.board.render(now)
+
+        self.assertEqual(render_shields.call_count, 2)
+        self.assertIn("member5", first)
+
+    def test_edits_are_debounced(self):
+        import tazdingo
+
+        for author in (5, 6, 7):
+            self.send(author, "$shield 2h")
+        hive = self.send(8, "$hive")
+        self.run_for(tazdingo.BOARD_DELAY)
+
+        board = self.channel.messages[self.board.config.board_message_id]
+        self.assertEqual(hive.reactions, ['\N{ROBOT FACE}'])
+        self.assertEqual(len(self.channel.messages), 1)
+        self.assertEqual(self.client.stats['edits'], 1)
+        self.assertIn("member7", board.content)
+
+    def test_other_channels_are_answered_inline(self):
+        import harness
+
+        self.send(5, "$shield 2h")
+        # commands moved to another channel, the board stays where it was
+        alerts = self.client.channels[harness.ALERTS_CHANNEL_ID]
+        self.send(harness.OWNER_ID, "$bind shields", channel=alerts)
+        self.send(5, "$hive", channel=alerts)
+
+        self.assertEqual(len(self.channel.messages), 1)
+        self.assertEqual([m.content.split("```")[0] for m in alerts.messages.values()], ["Shields:"])
+
+    def test_missing_board_posts_again(self):
+        import discord
+        import tazdingo
+
+        board = self.channel.messages[self.board.config.board_message_id]
+        error = discord.NotFound(unittest.mock.Mock(status=404, reason="Not Found"), "Unknown Message")
+        with unittest.mock.patch.object(board, 'edit', side_effect=error):
+            self.send(5, "$shield 2h")
+            self.run_for(tazdingo.BOARD_DELAY)
+        self.assertFalse(self.board.enabled)
+
+        self.send(5, "$hive")
+        self.assertEqual([m.content.split("```")[0] for m in self.channel.messages.values()], ["The hive is empty.", "Shields:"])
+
+
+class TestCatchUp(ClientTestCase):
+
+    def test_digest_after_outage(self):
+        import harness
+
+        client = self.client
+        for author, content in [(harness.OWNER_ID, "$bind"), (5, "$shield 3h"), (6, "$shield 9h"), (5, "$track bob 1,1"), (7, "$track al 2,2 1 9")]:
+            self.send(author, content)
+        client.partitions[harness.GUILD_ID].config.alerts_channel_id = harness.ALERTS_CHANNEL_ID
+        self.loop.run_until_complete(client.persistence.flush())
+        flushes = client.persistence.flushes
+        self.loop.run_until_complete(harness.simulate(client, 0, outage=10))
+        self.loop.run_until_complete(client.outbox.join())
+
+        alerts = [m.content for m in client.channels[harness.ALERTS_CHANNEL_ID].messages.values()]
+        self.assertEqual(client.persistence.flushes - flushes, 1)
+        self.assertEqual(client.catch_ups, 1)
+        self.assertEqual(len(alerts), 2)
+        self.assertTrue(alerts[0].startswith("<@!5> <@!6> <@!7> "))
+        # only the latest passed mark of each prey is reported
+        self.assertIn("bob's 8h shield may have expired 2h ago", alerts[1])
+        self.assertNotIn("bob's 4h", alerts[1])
+        self.assertIn("al's 9h shield may have expired 1h ago", alerts[1])
+        self.assertIn("member6's shield expired 1h ago", alerts[1])
+
+
 if __name__ == '__main__':
     unittest.main()
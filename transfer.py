@@ -0,0 +1,201 @@
+import codecs
+import csv
+import io
+import json
+from datetime import datetime, timedelta, timezone
+
+from reminders import get_prey_durations, is_valid
+from utils import format_coords, is_tuple, parse_coords, parse_time
+
+
+FORMATS = ('csv', 'jsonl')
+MAX_IMPORT_BYTES = 8 * 1024 * 1024
+MAX_IMPORT_ROWS = 20000
+MAX_NAME_LENGTH = 255
+TRACK_COLUMNS = ('name', 'coords', 'shields', 'entered', 'user_id')
+SHIELD_COLUMNS = ('user_id', 'name', 'display_name', 'entered', 'expires')
+
+
+class ImportRowError(Exception):
+    def __init__(self, line, message):
+        super(ImportRowError, self).__init__(f"line {line}: {message}" if line else message)
+        self.line = line
+
+
+def get_format(filename):
+    _extension = filename.rsplit('.', 1)[-1].lower()
+    return _extension if _extension in FORMATS else None
+
+
+def format_time(seconds):
+    # the compact form parse_time reads back, 1d2h30m
+    _parts = []
+    for _unit, _size in (('d', 86400), ('h', 3600), ('m', 60), ('s', 1)):
+        _value, seconds = divmod(seconds, _size)
+        if _value:
+            _parts.append(f"{_value}{_unit}")
+    return "".join(_parts) or "0s"
+
+
+def parse_datetime(value):
+    # timestamps without an offset are taken as UTC, like everything stored
+    _value = datetime.fromisoformat(value)
+    if _value.tzinfo is None:
+        _value = _value.replace(tzinfo=timezone.utc)
+    return _value
+
+
+def iter_rows(data, format):
+    # lines are decoded and parsed one at a time, the file is never held as text
+    _lines = codecs.getreader('utf-8-sig')(io.BytesIO(data))
+    if format == 'csv':
+        _reader = csv.DictReader(_lines)
+        for _row in _reader:
+            yield _reader.line_num, {_key.strip().lower(): (_value or "").strip() for _key, _value in _row.items() if _key is not None}
+    else:
+        for _line_num, _line in enumerate(_lines, 1):
+            if not _line.strip():
+                continue
+            try:
+                _row = json.loads(_line)
+            except ValueError:
+                raise ImportRowError(_line_num, "invalid JSON")
+            if not isinstance(_row, dict):
+                raise ImportRowError(_line_num, "expected an object")
+            yield _line_num, {str(_key).lower(): _value for _key, _value in _row.items()}
+
+
+def limit_rows(rows):
+    # every row read counts, repeated keys included
+    for _count, (_line, _row) in enumerate(rows):
+        if _count >= MAX_IMPORT_ROWS:
+            raise ImportRowError(_line, f"more than {MAX_IMPORT_ROWS} rows")
+        yield _line, _row
+
+
+def _get_name(row, line):
+    _name = str(row.get('name') or "").strip()
+    if not _name or len(_name) > MAX_NAME_LENGTH or _name.split() != [_name]:
+        raise ImportRowError(line, f"invalid name {_name!r}")
+    return _name
+
+
+def _get_user_id(row, line, default=None):
+    _user_id = str(row.get('user_id') or "").strip()
+    if not _user_id and default is not None:
+        return default
+    if not _user_id.isdigit():
+        raise ImportRowError(line, f"invalid user_id {_user_id!r}")
+    return int(_user_id)
+
+
+def _get_time(value, line, what):
+    _seconds = parse_time(str(value).strip())
+    if not _seconds:
+        raise ImportRowError(line, f"invalid {what} {value!r}")
+    return _seconds
+
+
+def _get_datetime(row, column, line):
+    _value = row.get(column)
+    if not _value:
+        return None
+    try:
+        return parse_datetime(str(_value))
+    except ValueError:
+        raise ImportRowError(line, f"invalid {column} {_value!r}")
+
+
+def _get_times(value):
+    # a space separated list in CSV, a list or the same string in JSONL
+    if isinstance(value, (list, tuple)):
+        return [str(_value) for _value in value]
+    return str(value or "").replace(",", " ").split()
+
+
+def parse_tracks(rows, default_marks, user_id):
+    # name, optional coords and shields, optional entered and user_id for exported tracks
+    _tracks = {}
+    for _line, _row in limit_rows(rows):
+        _name = _get_name(_row, _line)
+
+        _coords = None
+        _value = str(_row.get('coords') or "").replace(" ", "")
+        if _value:
+            if not is_tuple(_value):
+                raise ImportRowError(_line, f"invalid coords {_value!r}")
+            _coords = parse_coords(_value)
+
+        _times = _get_times(_row.get('shields'))
+        _marks = get_prey_durations(_get_time(_time, _line, "shield") for _time in _times) if _times else default_marks
+        if not is_valid(_marks):
+            raise ImportRowError(_line, "invalid shields")
+
+        # later rows for the same prey win, like repeated $track
+        _tracks[_name] = (_name, _coords, _marks, _get_datetime(_row, 'entered', _line), _get_user_id(_row, _line, user_id))
+    return list(_tracks.values())
+
+
+def parse_shields(rows, now):
+    # user_id, name and either the remaining time or when it expires
+    _shields = {}
+    for _line, _row in limit_rows(rows):
+        _user_id = _get_user_id(_row, _line)
+        _name = _get_name(_row, _line)
+        _display_name = str(_row.get('display_name') or _name)[:MAX_NAME_LENGTH]
+
+        _expires = _get_datetime(_row, 'expires', _line)
+        if _expires is None:
+            if not _row.get('remaining'):
+                raise ImportRowError(_line, "missing remaining or expires")
+            _expires = now + timedelta(seconds=_get_time(_row['remaining'], _line, "remaining"))
+        _entered = _get_datetime(_row, 'entered', _line) or now
+
+        _shields[_user_id] = (_user_id, _name, _display_name, _entered, _expires)
+    return list(_shields.values())
+
+
+def parse_import(what, format, data, now, default_marks, user_id):
+    # runs on a worker thread, every row is checked before anything is applied
+    _rows = iter_rows(data, format)
+    try:
+        if what == 'tracks':
+            return parse_tracks(_rows, default_marks, user_id)
+        return parse_shields(_rows, now)
+    except UnicodeDecodeError:
+        raise ImportRowError(None, "not UTF-8")
+    except csv.Error as e:
+        raise ImportRowError(None, str(e))
+
+
+def export_rows(what, format, records):
+    # runs on a worker thread over the poach's immutable view
+    if what == 'tracks':
+        _columns = TRACK_COLUMNS
+        _rows = ({
+            'name': _prey.prey_name,
+            'coords': format_coords(_prey.coords) or "",
+            'shields': " ".join(format_time(_mark) for _mark in _prey.marks),
+            'entered': _prey.entered.isoformat(),
+            'user_id': _prey.user_id,
+        } for _prey in sorted(records, key=lambda _p: _p.prey_name))
+    else:
+        _columns = SHIELD_COLUMNS
+        _rows = ({
+            'user_id': _shield.user_id,
+            'name': _shield.name,
+            'display_name': _shield.display_name,
+            'entered': _shield.entered.isoformat(),
+            'expires': _shield.expires.isoformat(),
+        } for _shield in sorted(records, key=lambda _s: _s.expires))
+
+    _buffer = io.StringIO()
+    if format == 'csv':
+        _writer = csv.DictWriter(_buffer, _columns, lineterminator="\n")
+        _writer.writeheader()
+        _writer.writerows(_rows)
+    else:
+        for _row in _rows:
+            _buffer.write(json.dumps(_row))
+            _buffer.write("\n")
+    return _buffer.getvalue().encode('utf-8')
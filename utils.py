@@ -1,3 +1,6 @@
+import asyncio
+import bisect
+import contextlib
 import io
 import re
 
@@ -6,6 +9,10 @@ COMPLEX_TIME_RE = re.compile(r"^(?:(?P<days>\d+)\s*(d|D|day|days))?\s*(?:(?P<hou
 SIMPLE_TIME_RE = re.compile(r"^(?P<hours>\d+)$")
 TUPLE_RE = re.compile(r"^\d+,\d+\Z")
 MENTION_RE = re.compile(r"^<@!(\d)+>$")
+MESSAGE_LIMIT = 2000
+CODE_BLOCK = "```"
+PAGE_SIZE = 40
+GRID_CELL_SIZE = 32
 
 
 def get_human_time(elapsed_time):
@@ -64,6 +71,19 @@ def is_tuple(string):
         return False
 
 
+def parse_coords(string):
+    if not string or not TUPLE_RE.match(string):
+        return None
+    _x, _y = string.split(",")
+    return int(_x), int(_y)
+
+
+def format_coords(coords):
+    if coords is None:
+        return None
+    return f"{coords[0]},{coords[1]}"
+
+
 def is_mention(string):
     if MENTION_RE.match(string):
         return True
@@ -84,3 +104,181 @@ def get_member_name(mention_string, mentions):
                 return _mention.id
 
         return mention_string
+
+
+def get_chunks(lines, header="", limit=MESSAGE_LIMIT):
+    # wraps lines in code blocks, only the first chunk carries the header
+    _opening = f"{header}{CODE_BLOCK}"
+    _chunk = io.StringIO()
+    _empty = True
+    for _line in lines:
+        _budget = limit - len(_opening) - len(CODE_BLOCK)
+        _line = _line[:_budget]
+        if not _empty and _chunk.tell() + 1 + len(_line) > _budget:
+            yield f"{_opening}{_chunk.getvalue()}{CODE_BLOCK}"
+            _opening = CODE_BLOCK
+            _chunk = io.StringIO()
+            _empty = True
+
+        if not _empty:
+            _chunk.write("\n")
+        _chunk.write(_line)
+        _empty = False
+
+    yield f"{_opening}{_chunk.getvalue()}{CODE_BLOCK}"
+
+
+def get_page_bounds(page, total, page_size=PAGE_SIZE):
+    _pages = max((total + page_size - 1) // page_size, 1)
+    if page < 1 or page > _pages:
+        return None
+    return (page - 1) * page_size, page * page_size, _pages
+
+
+class SortedIndex(object):
+    def __init__(self):
+        super(SortedIndex, self).__init__()
+        self._items = []
+        self._sort_keys = {}
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __contains__(self, key):
+        return key in self._sort_keys
+
+    def add(self, key, sort_key):
+        self.remove(key)
+        if sort_key is not None:
+            self._sort_keys[key] = sort_key
+            bisect.insort(self._items, (sort_key, key))
+
+    def remove(self, key):
+        _sort_key = self._sort_keys.pop(key, None)
+        if _sort_key is not None:
+            _idx = bisect.bisect_left(self._items, (_sort_key, key))
+            del self._items[_idx]
+
+    def update(self, pairs):
+        # a batch is sorted in once instead of an insort per key
+        _pairs = dict(pairs)
+        if any(_key in self._sort_keys for _key in _pairs):
+            self._items = [_item for _item in self._items if _item[1] not in _pairs]
+        for _key, _sort_key in _pairs.items():
+            self._sort_keys.pop(_key, None)
+            if _sort_key is not None:
+                self._sort_keys[_key] = _sort_key
+                self._items.append((_sort_key, _key))
+        self._items.sort()
+
+    def clear(self):
+        self._items = []
+        self._sort_keys = {}
+
+    def get_sort_key(self, key):
+        return self._sort_keys.get(key)
+
+    def keys(self, start=None, stop=None):
+        return [_key for _sort_key, _key in self._items[start:stop]]
+
+    def iter_from(self, start=0):
+        for _idx in range(start, len(self._items)):
+            yield self._items[_idx]
+
+    def count_before(self, sort_key):
+        return bisect.bisect_left(self._items, (sort_key,))
+
+    def before(self, sort_key):
+        _idx = bisect.bisect_left(self._items, (sort_key,))
+        return [_key for _sort_key, _key in self._items[:_idx]]
+
+
+class KeyedLock(object):
+    # one lock per key, kept only while it is held or awaited
+    def __init__(self):
+        super(KeyedLock, self).__init__()
+        self._locks = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    def locked(self, key):
+        _entry = self._locks.get(key)
+        return _entry is not None and _entry[0].locked()
+
+    @contextlib.asynccontextmanager
+    async def __call__(self, key):
+        _entry = self._locks.get(key)
+        if _entry is None:
+            _entry = self._locks[key] = [asyncio.Lock(), 0]
+        _entry[1] += 1
+        try:
+            async with _entry[0]:
+                yield
+        finally:
+            _entry[1] -= 1
+            if not _entry[1]:
+                del self._locks[key]
+
+
+class GridIndex(object):
+    # buckets points into square cells so a radius query only visits nearby cells
+    def __init__(self, cell_size=GRID_CELL_SIZE):
+        super(GridIndex, self).__init__()
+        self.cell_size = cell_size
+        self._cells = {}
+        self._points = {}
+
+    def __len__(self):
+        return len(self._points)
+
+    def __contains__(self, key):
+        return key in self._points
+
+    def _get_cell(self, point):
+        return point[0] // self.cell_size, point[1] // self.cell_size
+
+    def add(self, key, point):
+        self.remove(key)
+        if point is not None:
+            self._points[key] = point
+            self._cells.setdefault(self._get_cell(point), set()).add(key)
+
+    def remove(self, key):
+        _point = self._points.pop(key, None)
+        if _point is not None:
+            _cell = self._get_cell(_point)
+            _keys = self._cells[_cell]
+            _keys.discard(key)
+            if not _keys:
+                del self._cells[_cell]
+
+    def get_point(self, key):
+        return self._points.get(key)
+
+    def near(self, point, radius):
+        _x, _y = point
+        _radius_sq = radius * radius
+        _min_x, _min_y = self._get_cell((_x - radius, _y - radius))
+        _max_x, _max_y = self._get_cell((_x + radius, _y + radius))
+
+        if (_max_x - _min_x + 1) * (_max_y - _min_y + 1) > len(self._cells):
+            # a huge radius covers more cells than are occupied
+            _cells = [_keys for (_cx, _cy), _keys in self._cells.items() if _min_x <= _cx <= _max_x and _min_y <= _cy <= _max_y]
+        else:
+            _cells = [self._cells.get((_cx, _cy)) for _cx in range(_min_x, _max_x + 1) for _cy in range(_min_y, _max_y + 1)]
+
+        _found = []
+        for _keys in _cells:
+            if not _keys:
+                continue
+            for _key in _keys:
+                _px, _py = self._points[_key]
+                _distance_sq = (_px - _x) ** 2 + (_py - _y) ** 2
+                if _distance_sq <= _radius_sq:
+                    _found.append((_distance_sq, _key))
+        _found.sort()
+        return _found
@@ -0,0 +1,191 @@
+import asyncio
+import importlib.util
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import parse_time
+
+# opencv and numpy are only imported inside the worker processes
+cv2 = None
+numpy = None
+
+
+VISION_WORKERS = 2
+MAX_IMAGE_BYTES = 8 * 1024 * 1024
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp')
+TEMPLATE_CHARACTERS = "0123456789dhms"
+TEMPLATE_SIZE = (20, 30)
+TARGET_HEIGHT = 400
+MIN_SCORE = 0.4
+MAX_TIMER_SECONDS = 7 * 24 * 3600
+CLOCK_RE = re.compile(r"(?<![\d:])(\d{1,2}):(\d{2})(?::(\d{2}))?(?![\d:])")
+UNITS_RE = re.compile(r"^\s*(?:\d+\s*[dhms]\s*)+$")
+
+_templates = None
+
+
+def load_cv2():
+    global cv2, numpy
+    if cv2 is None:
+        import cv2
+        import numpy
+
+
+def get_templates():
+    global _templates
+    if _templates is None:
+        _templates = []
+        for _font in (cv2.FONT_HERSHEY_SIMPLEX, cv2.FONT_HERSHEY_DUPLEX, cv2.FONT_HERSHEY_TRIPLEX):
+            for _character in TEMPLATE_CHARACTERS:
+                _canvas = numpy.zeros((80, 80), numpy.uint8)
+                cv2.putText(_canvas, _character, (10, 60), _font, 2, 255, 4)
+                _x, _y, _w, _h = cv2.boundingRect(_canvas)
+                _templates.append((_character, normalize_glyph(_canvas[_y:_y + _h, _x:_x + _w])))
+    return _templates
+
+
+def normalize_glyph(glyph):
+    return cv2.resize(glyph, TEMPLATE_SIZE, interpolation=cv2.INTER_AREA).astype(numpy.float32)
+
+
+def classify_glyph(glyph):
+    _glyph = normalize_glyph(glyph)
+    _best, _best_score = None, MIN_SCORE
+    for _character, _template in get_templates():
+        _score = cv2.matchTemplate(_glyph, _template, cv2.TM_CCOEFF_NORMED)[0][0]
+        if _score > _best_score:
+            _best, _best_score = _character, _score
+    return _best
+
+
+def preprocess(image):
+    _scale = TARGET_HEIGHT / max(image.shape[0], 1)
+    if _scale > 1:
+        image = cv2.resize(image, None, fx=_scale, fy=_scale, interpolation=cv2.INTER_CUBIC)
+    image = cv2.GaussianBlur(image, (3, 3), 0)
+    _, _binary = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    # text is assumed to be the minority colour
+    if cv2.countNonZero(_binary) > _binary.size // 2:
+        _binary = cv2.bitwise_not(_binary)
+    return _binary
+
+
+def get_rows(binary):
+    _contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    _boxes = sorted((cv2.boundingRect(_contour) for _contour in _contours), key=lambda _b: _b[1])
+
+    _rows = []
+    for _box in _boxes:
+        _x, _y, _w, _h = _box
+        for _row in _rows:
+            _top, _bottom = _row[0], _row[1]
+            if _y < _bottom and _y + _h > _top:
+                _row[0], _row[1] = min(_top, _y), max(_bottom, _y + _h)
+                _row[2].append(_box)
+                break
+        else:
+            _rows.append([_y, _y + _h, [_box]])
+    return [sorted(_row[2]) for _row in _rows]
+
+
+def read_row(binary, boxes):
+    _height = max(_h for _x, _y, _w, _h in boxes)
+    _glyphs = [_box for _box in boxes if _box[3] >= _height * 0.5]
+    if not _glyphs:
+        return ""
+    _widths = sorted(_w for _x, _y, _w, _h in _glyphs)
+    _gap = _widths[len(_widths) // 2] * 0.6
+
+    _text = []
+    _last = None
+    for _x, _y, _w, _h in boxes:
+        if _last is not None and _x - _last > _gap:
+            _text.append(" ")
+
+        if _h < _height * 0.35:
+            # colons are two small stacked dots, keep a single one
+            if not _text or _text[-1] != ":":
+                _text.append(":")
+        elif _h >= _height * 0.5:
+            _character = classify_glyph(binary[_y:_y + _h, _x:_x + _w])
+            if _character is not None:
+                _text.append(_character)
+        _last = max(_last or 0, _x + _w)
+    return "".join(_text)
+
+
+def get_timer_seconds(texts):
+    # clock-like readings win over rows made only of 1d 2h 3m 4s units
+    _seconds = None
+    for _text in texts:
+        _m = CLOCK_RE.search(_text)
+        if _m:
+            _hours, _minutes, _secs = int(_m.group(1)), int(_m.group(2)), int(_m.group(3) or 0)
+            if _minutes < 60 and _secs < 60:
+                _seconds = _hours * 3600 + _minutes * 60 + _secs
+                break
+
+    if _seconds is None:
+        for _text in texts:
+            if UNITS_RE.match(_text):
+                _seconds = parse_time(_text.replace(" ", ""))
+                break
+
+    if not _seconds or _seconds > MAX_TIMER_SECONDS:
+        return None
+    return _seconds
+
+
+def read_timer(data):
+    if not data or len(data) > MAX_IMAGE_BYTES:
+        return None
+
+    load_cv2()
+    _image = cv2.imdecode(numpy.frombuffer(data, numpy.uint8), cv2.IMREAD_GRAYSCALE)
+    if _image is None:
+        return None
+
+    _binary = preprocess(_image)
+    return get_timer_seconds([read_row(_binary, _boxes) for _boxes in get_rows(_binary)])
+
+
+def is_image(attachment):
+    return attachment.filename.lower().endswith(IMAGE_EXTENSIONS) and attachment.size <= MAX_IMAGE_BYTES
+
+
+class TazdingoVision(object):
+    def __init__(self, workers=VISION_WORKERS):
+        super(TazdingoVision, self).__init__()
+        self.workers = workers
+        self._executor = None
+
+    @property
+    def available(self):
+        return importlib.util.find_spec('cv2') is not None
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    async def read_timers(self, attachments):
+        # every screenshot is decoded in its own worker process, in parallel
+        _attachments = [_attachment for _attachment in attachments if is_image(_attachment)]
+        if not self.available or not _attachments:
+            return []
+
+        _loop = asyncio.get_event_loop()
+        _images = await asyncio.gather(*(_attachment.read() for _attachment in _attachments))
+        _executor = self._get_executor()
+        return await asyncio.gather(*(_loop.run_in_executor(_executor, read_timer, _image) for _image in _images))
+
+    async def read_timer(self, attachments):
+        for _seconds in await self.read_timers(attachments):
+            if _seconds:
+                return _seconds
+        return None
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None